@@ -104,6 +104,7 @@ Note that you can only replace the ``processors`` dict wholesale this way, not u
 import re
 import sys
 import tempfile
+import zlib
 from urllib import unquote_plus
 
 import cherrypy
@@ -865,6 +866,72 @@ class SizedReader:
                     raise
 
 
+class GzipReader(object):
+    """Inflate a gzip-encoded request body as it is read.
+    
+    The given fp must return an empty string once the (compressed) body is
+    exhausted, as SizedReader does. No single read inflates more than 'size'
+    bytes, so a small but highly-compressed body cannot make us allocate
+    much memory at once; wrap this in a SizedReader to limit the total.
+    
+    Concatenated gzip members are inflated one after another. A body which
+    ends before its last member does (including its CRC and length
+    trailer) is rejected with a 400, rather than taken as a shorter entity.
+    """
+    
+    def __init__(self, fp, bufsize=8192):
+        self.fp = fp
+        self.bufsize = bufsize
+        # 16 + MAX_WBITS tells zlib to expect (and check) a gzip wrapper.
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.done = False
+    
+    def _ended(self):
+        """Return True if the current gzip member is complete."""
+        decompressor = self.decompressor
+        eof = getattr(decompressor, 'eof', None)
+        if eof is not None:
+            return eof
+        # Python 2's decompressobj has no 'eof'. Input past the end of a
+        # stream is set aside in unused_data, so feed a copy a byte to see.
+        if decompressor.unused_data:
+            return True
+        probe = decompressor.copy()
+        try:
+            probe.decompress(ntob('\x00'))
+        except zlib.error:
+            return False
+        return bool(probe.unused_data)
+    
+    def read(self, size=None):
+        """Return up to 'size' inflated bytes (or '' at the end of the body)."""
+        if not size or size < 0:
+            size = self.bufsize
+        while True:
+            data = self.decompressor.unconsumed_tail
+            if not data and self.decompressor.unused_data:
+                # Another gzip member follows the one just finished.
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if not data:
+                if self.done:
+                    return ntob('')
+                data = self.fp.read(self.bufsize)
+                if not data:
+                    self.done = True
+                    if not self._ended():
+                        raise cherrypy.HTTPError(400, "The request entity "
+                                                 "ended in mid gzip stream.")
+                    return self.decompressor.flush()
+            try:
+                chunk = self.decompressor.decompress(data, size)
+            except zlib.error:
+                raise cherrypy.HTTPError(400, "The request entity could not "
+                                         "be decompressed.")
+            if chunk:
+                return chunk
+
+
 class RequestBody(Entity):
     """The entity of the HTTP request."""
     
@@ -886,6 +953,14 @@ class RequestBody(Entity):
     maxbytes = None
     """Raise ``MaxSizeExceeded`` if more bytes than this are read from the socket."""
     
+    decompress = False
+    """If True, request entities with a ``Content-Encoding`` of gzip (or
+    x-gzip) are inflated incrementally as they are read, so that processors
+    (and handlers) see the decoded bytes. The decoded size is limited to
+    ``maxbytes`` or, if that is not set, to the server's
+    ``max_request_body_size``, so a small compressed body cannot expand
+    without bound. Other content-codings are passed through untouched."""
+    
     def __init__(self, fp, headers, params=None, request_params=None):
         Entity.__init__(self, fp, headers, params)
         
@@ -923,6 +998,14 @@ class RequestBody(Entity):
         self.fp = SizedReader(self.fp, self.length,
                               self.maxbytes, bufsize=self.bufsize,
                               has_trailers='Trailer' in h)
+        if self.decompress:
+            coding = h.get('Content-Encoding', '').strip().lower()
+            if coding in ('gzip', 'x-gzip'):
+                # The decoded length is unknown until we've read it all.
+                maxbytes = self.maxbytes or cherrypy.server.max_request_body_size
+                self.fp = SizedReader(GzipReader(self.fp, self.bufsize), None,
+                                      maxbytes, bufsize=self.bufsize)
+                self.length = None
         super(RequestBody, self).process()
         
         # Body params should also be a part of the request_params
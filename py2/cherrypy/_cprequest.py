@@ -5,7 +5,7 @@ import time
 import warnings
 
 import cherrypy
-from cherrypy._cpcompat import basestring, copykeys, ntob, unicodestr
+from cherrypy._cpcompat import basestring, bytestr, copykeys, ntob, unicodestr
 from cherrypy._cpcompat import SimpleCookie, CookieError
 from cherrypy import _cpreqbody, _cpconfig
 from cherrypy._cperror import format_exc, bare_error
@@ -356,6 +356,9 @@ class Request(object):
     starting at request.app.root, and is then passed all HTTP params
     (from the query string and POST body) as keyword arguments."""
     
+    handler_time = None
+    """The number of seconds the handler took to return (if it was called)."""
+    
     toolmaps = {}
     """
     A nested dict of all Toolboxes and Tools in effect for this request,
@@ -642,7 +645,11 @@ class Request(object):
                     self.hooks.run('before_handler')
                     if self.handler:
                         self.stage = 'handler'
-                        response.body = self.handler()
+                        start = time.time()
+                        try:
+                            response.body = self.handler()
+                        finally:
+                            self.handler_time = time.time() - start
                     
                     # Finalize
                     self.stage = 'before_finalize'
@@ -767,6 +774,18 @@ class Request(object):
     :attr:`request.body.params<cherrypy._cprequest.RequestBody.params>`.""")
 
 
+def _chunks_length(body):
+    """Return the total length of a list or tuple of byte strings, else None."""
+    if not isinstance(body, (list, tuple)):
+        return None
+    length = 0
+    for chunk in body:
+        if not isinstance(chunk, bytestr):
+            return None
+        length += len(chunk)
+    return length
+
+
 class ResponseBody(object):
     """The body of the HTTP response (the response entity)."""
     
@@ -841,6 +860,10 @@ class Response(object):
     stream = False
     """If False, buffer the response body."""
     
+    _measured_length = None
+    # The Content-Length finalize measured from a list of body chunks, if
+    # it did (rather than one declared by user code or a collapsed body).
+    
     def __init__(self):
         self.status = None
         self.header_list = None
@@ -894,8 +917,12 @@ class Response(object):
             # Responses which are not streamed should have a Content-Length,
             # but allow user code to set Content-Length if desired.
             if dict.get(headers, 'Content-Length') is None:
-                content = self.collapse_body()
-                dict.__setitem__(headers, 'Content-Length', len(content))
+                # Measure a list of chunks in place, rather than joining
+                # them into a copy of the whole body just to take its len.
+                length = self._measured_length = _chunks_length(self.body)
+                if length is None:
+                    length = len(self.collapse_body())
+                dict.__setitem__(headers, 'Content-Length', length)
         
         # Transform our header dict into a list of tuples.
         self.header_list = h = headers.output()
@@ -260,6 +260,14 @@ class SessionTool(Tool):
         a large upload would block the session, denying an AJAX
         progress meter (see http://www.cherrypy.org/ticket/630).
         
+        When 'shared', a shared lock is taken just before running the
+        page handler, so that handlers which only read the session can
+        run at the same time. Changed data is saved only if no other
+        request saved the session meanwhile (else "409 Conflict").
+        
+        When 'optimistic', no lock is taken, but changed data is saved
+        under the same check as for 'shared'.
+        
         When 'explicit' (or any other value), you need to call
         cherrypy.session.acquire_lock() yourself before using
         session data.
@@ -270,7 +278,14 @@ class SessionTool(Tool):
         Tool.__init__(self, 'before_request_body', _sessions.init)
     
     def _lock_session(self):
-        cherrypy.serving.session.acquire_lock()
+        sess = cherrypy.serving.session
+        sess.verify()
+        sess.acquire_lock()
+    
+    def _lock_session_shared(self):
+        sess = cherrypy.serving.session
+        sess.verify()
+        sess.acquire_shared_lock()
     
     def _setup(self):
         """Hook this tool into cherrypy.request.
@@ -295,6 +310,8 @@ class SessionTool(Tool):
             # Lock before the request body (but after _sessions.init runs!)
             hooks.attach('before_request_body', self._lock_session,
                          priority=60)
+        elif locking == 'shared':
+            hooks.attach('before_handler', self._lock_session_shared)
         else:
             # Don't lock
             pass
@@ -398,6 +415,12 @@ class CachingTool(Tool):
                 # Note the devious technique here of adding hooks on the fly
                 request.hooks.attach('before_finalize', _caching.tee_output,
                                      priority = 90)
+            if getattr(request, 'stale_cache_data', None) is not None:
+                # Before gzip (80) and tee_output, so they see request.cached.
+                request.hooks.attach('before_finalize', _caching.serve_stale,
+                                     priority = 70)
+                request.hooks.attach('after_error_response',
+                                     _caching.serve_stale)
     _wrapper.priority = 20
     
     def _setup(self):
@@ -487,6 +510,7 @@ _d.sessions = SessionTool()
 _d.xmlrpc = ErrorTool(_xmlrpc.on_error)
 _d.caching = CachingTool('before_handler', _caching.get, 'caching')
 _d.expires = Tool('before_finalize', _caching.expires)
+_d.validate = Tool('before_handler', _caching.validate, priority=55)
 _d.tidy = DeprecatedTool('before_finalize',
     "The tidy tool has been removed from the standard distribution of CherryPy. "
     "The most recent version can be found at http://tools.cherrypy.org/browser.")
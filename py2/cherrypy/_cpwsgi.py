@@ -12,7 +12,7 @@ import sys as _sys
 import cherrypy as _cherrypy
 from cherrypy._cpcompat import BytesIO
 from cherrypy import _cperror
-from cherrypy.lib import httputil
+from cherrypy.lib import coalesce_chunks, httputil
 
 
 def downgrade_wsgi_ux_to_1x(environ):
@@ -167,10 +167,10 @@ class _TrappedResponse(object):
         except StopIteration:
             raise
         except:
-            tb = _cperror.format_exc()
-            #print('trapped (started %s):' % self.started_response, tb)
-            _cherrypy.log(tb, severity=40)
-            if not _cherrypy.request.show_tracebacks:
+            _cherrypy.log(severity=40, traceback=True)
+            if _cherrypy.request.show_tracebacks:
+                tb = _cperror.format_exc()
+            else:
                 tb = ""
             s, h, b = _cperror.bare_error(tb)
             if self.started_response:
@@ -213,7 +213,16 @@ class AppResponse(object):
             self.close()
             raise
         r = _cherrypy.serving.response
-        self.iter_response = iter(r.body)
+        if (r._measured_length is not None
+            and isinstance(r.body, (list, tuple)) and len(r.body) > 1):
+            # Hand the server a few large writes, not many small ones.
+            # (Only when finalize measured the chunks itself: if user code
+            # declared the Content-Length, it may be wrong, so keep the
+            # chunks as they are and the server truncates the body at the
+            # same place it always has.)
+            self.iter_response = coalesce_chunks(r.body)
+        else:
+            self.iter_response = iter(r.body)
         self.write = start_response(r.output_status, r.header_list)
     
     def __iter__(self):
@@ -1,5 +1,7 @@
 """CherryPy Library"""
 
+from cherrypy._cpcompat import bytestr, ntob
+
 # Deprecated in CherryPy 3.2 -- remove in CherryPy 3.3
 from cherrypy.lib.reprconf import _Builder, unrepr, modules, attributes
 
@@ -36,6 +38,34 @@ def file_generator_limited(fileobj, count, chunk_size=65536):
         remaining -= chunklen
         yield chunk
 
+def coalesce_chunks(chunks, bufsize=65536):
+    """Yield the given byte strings, joined into pieces of about bufsize
+    bytes. Chunks of bufsize or more (and non-bytes) are yielded as is. (Core)
+    
+    Writing many small chunks costs a socket write for each one, while
+    joining all of them costs a copy of the whole body; this bounds the
+    extra memory to a single piece.
+    """
+    buf = []
+    buflen = 0
+    for chunk in chunks:
+        if isinstance(chunk, bytestr) and len(chunk) < bufsize:
+            if buflen + len(chunk) <= bufsize:
+                buf.append(chunk)
+                buflen += len(chunk)
+                continue
+        if buf:
+            yield ntob('').join(buf)
+            buf = []
+            buflen = 0
+        if isinstance(chunk, bytestr) and len(chunk) < bufsize:
+            buf.append(chunk)
+            buflen += len(chunk)
+        else:
+            yield chunk
+    if buf:
+        yield ntob('').join(buf)
+
 def set_vary_header(response, header_name):
     "Add a Vary header to a response"
     varies = response.headers.get("Vary", "")
@@ -447,6 +447,15 @@ class StatsPage(object):
             'Connections/second': '%.3f',
             'Start time': iso_format,
         },
+        'CherryPy Compression': {
+            'Enabled': pause_resume('CherryPy Compression'),
+            'Ratio': '%.3f',
+            'Time': '%.3f',
+            'Levels': {
+                'Ratio': '%.3f',
+                'Time': '%.3f',
+                },
+        },
     }
     
     
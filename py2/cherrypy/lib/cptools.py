@@ -1,5 +1,6 @@
 """Functions for builtin CherryPy tools."""
 
+from itertools import chain
 import logging
 import re
 
@@ -10,13 +11,59 @@ from cherrypy.lib import httputil as _httputil
 
 #                     Conditional HTTP request support                     #
 
-def validate_etags(autotags=False, debug=False):
+def _autotag(response, max_size):
+    """Return an automatic ETag for the response body, or None.
+    
+    The body is hashed chunk by chunk. A body which is not streamed is kept
+    as it is, unless it can only be iterated over once (it is then buffered
+    in a list). A streamed body is buffered only up to max_size bytes; if
+    it is longer, the rest is left to stream unread, and the tag is a weak
+    one made from response.etag_version (which the handler may set to
+    anything that changes whenever the body does). Without an
+    etag_version, no tag is made for such a body.
+    """
+    m = md5()
+    if not response.stream or max_size is None:
+        body = response.body
+        if iter(body) is body:
+            # An iterator would be used up by hashing it.
+            body = response.body = list(body)
+        for chunk in body:
+            m.update(chunk)
+        return '"%s"' % m.hexdigest()
+    
+    buffered = []
+    size = 0
+    chunks = iter(response.body)
+    for chunk in chunks:
+        buffered.append(chunk)
+        m.update(chunk)
+        size += len(chunk)
+        if size > max_size:
+            response.body = chain(buffered, chunks)
+            version = getattr(response, 'etag_version', None)
+            if version is None:
+                return None
+            return 'W/"%s"' % md5(ntob(str(version))).hexdigest()
+    response.body = buffered
+    return '"%s"' % m.hexdigest()
+
+
+def _opaque_tag(etag):
+    """Return the given entity tag without any weakness indicator."""
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
+
+def validate_etags(autotags=False, debug=False, autotags_max_size=1048576):
     """Validate the current ETag against If-Match, If-None-Match headers.
     
     If autotags is True, an ETag response-header value will be provided
     from an MD5 hash of the response body (unless some other code has
     already provided an ETag header). If False (the default), the ETag
-    will not be automatic.
+    will not be automatic. Streamed responses are only buffered up to
+    autotags_max_size bytes to compute the hash; longer ones get a weak
+    ETag from response.etag_version instead, if the handler set one.
     
     WARNING: the autotags feature is not designed for URL's which allow
     methods other than GET. For example, if a POST to the same URL returns
@@ -47,11 +94,11 @@ def validate_etags(autotags=False, debug=False):
         if debug:
             cherrypy.log('Status not 200', 'TOOLS.ETAGS')
     else:
-        etag = response.collapse_body()
-        etag = '"%s"' % md5(etag).hexdigest()
+        etag = _autotag(response, autotags_max_size)
         if debug:
             cherrypy.log('Setting ETag: %s' % etag, 'TOOLS.ETAGS')
-        response.headers['ETag'] = etag
+        if etag:
+            response.headers['ETag'] = etag
     
     response.ETag = etag
     
@@ -68,7 +115,10 @@ def validate_etags(autotags=False, debug=False):
         if debug:
             cherrypy.log('If-Match conditions: %s' % repr(conditions),
                          'TOOLS.ETAGS')
-        if conditions and not (conditions == ["*"] or etag in conditions):
+        # If-Match uses the strong comparison function.
+        strong = etag and not etag.startswith('W/')
+        if conditions and not (conditions == ["*"] or
+                               (strong and etag in conditions)):
             raise cherrypy.HTTPError(412, "If-Match failed: ETag %r did "
                                      "not match %r" % (etag, conditions))
         
@@ -77,7 +127,10 @@ def validate_etags(autotags=False, debug=False):
         if debug:
             cherrypy.log('If-None-Match conditions: %s' % repr(conditions),
                          'TOOLS.ETAGS')
-        if conditions == ["*"] or etag in conditions:
+        # If-None-Match uses the weak comparison function, so that a tag
+        # weakened by tools.gzip still matches the strong one it came from.
+        if conditions == ["*"] or (etag and _opaque_tag(etag) in
+                                   [_opaque_tag(c) for c in conditions]):
             if debug:
                 cherrypy.log('request.method: %s' % request.method, 'TOOLS.ETAGS')
             if request.method in ("GET", "HEAD"):
@@ -1,4 +1,6 @@
+import logging
 import struct
+import threading
 import time
 
 import cherrypy
@@ -236,8 +238,54 @@ class ResponseEncoder:
 
 # GZIP
 
-def compress(body, compress_level):
-    """Compress 'body' at the given compress_level."""
+if not hasattr(logging, 'statistics'): logging.statistics = {}
+gzipstats = logging.statistics.setdefault('CherryPy Compression', {})
+gzipstats.update({
+    'Enabled': False,
+    'Skipped (Small Body)': 0,
+    'Responses': lambda s: sum([r['Responses'] for r in s['Levels'].values()]),
+    'Bytes In': lambda s: sum([r['Bytes In'] for r in s['Levels'].values()]),
+    'Bytes Out': lambda s: sum([r['Bytes Out'] for r in s['Levels'].values()]),
+    'Ratio': lambda s: _ratio(
+        sum([r['Bytes Out'] for r in s['Levels'].values()]),
+        sum([r['Bytes In'] for r in s['Levels'].values()])),
+    'Time': lambda s: sum([r['Time'] for r in s['Levels'].values()]),
+    'Levels': {},
+    })
+"""Statistics about the gzip tool, for :mod:`cherrypy.lib.cpstats`.
+
+The 'Levels' collection holds a record for each compression level used,
+with the number of responses, bytes in, bytes out, compressed/original
+ratio and seconds spent in zlib. Nothing is collected until 'Enabled' is
+set to True (as the cpstats page's resume control does)."""
+
+# Serializes updates to gzipstats from the worker threads.
+_stats_lock = threading.Lock()
+
+def _ratio(bytes_out, bytes_in):
+    if bytes_in:
+        return bytes_out / float(bytes_in)
+    return 0.0
+
+def _level_stats(level):
+    """Return the gzipstats record for the given level (creating it)."""
+    levels = gzipstats['Levels']
+    record = levels.get(level)
+    if record is None:
+        record = levels.setdefault(level, {
+            'Responses': 0, 'Bytes In': 0, 'Bytes Out': 0, 'Time': 0.0,
+            'Ratio': lambda r: _ratio(r['Bytes Out'], r['Bytes In']),
+            })
+    return record
+
+
+def compress(body, compress_level, stats=None):
+    """Compress 'body' at the given compress_level.
+    
+    If stats is given, it must be a dict with 'Responses', 'Bytes In',
+    'Bytes Out' and 'Time' entries, which are incremented once the whole
+    body has been compressed. Only time spent in zlib is counted.
+    """
     import zlib
     
     # See http://www.gzip.org/zlib/rfc-gzip.html
@@ -254,11 +302,38 @@ def compress(body, compress_level):
     zobj = zlib.compressobj(compress_level,
                             zlib.DEFLATED, -zlib.MAX_WBITS,
                             zlib.DEF_MEM_LEVEL, 0)
-    for line in body:
-        size += len(line)
-        crc = zlib.crc32(line, crc)
-        yield zobj.compress(line)
-    yield zobj.flush()
+    if stats is None:
+        for line in body:
+            size += len(line)
+            crc = zlib.crc32(line, crc)
+            yield zobj.compress(line)
+        yield zobj.flush()
+    else:
+        # Header and trailer are 10 and 8 bytes.
+        outsize = 18
+        elapsed = 0.0
+        for line in body:
+            size += len(line)
+            start = time.time()
+            crc = zlib.crc32(line, crc)
+            chunk = zobj.compress(line)
+            elapsed += time.time() - start
+            outsize += len(chunk)
+            yield chunk
+        start = time.time()
+        chunk = zobj.flush()
+        elapsed += time.time() - start
+        outsize += len(chunk)
+        
+        _stats_lock.acquire()
+        try:
+            stats['Responses'] += 1
+            stats['Bytes In'] += size
+            stats['Bytes Out'] += outsize
+            stats['Time'] += elapsed
+        finally:
+            _stats_lock.release()
+        yield chunk
     
     # CRC32: 4 bytes
     yield struct.pack("<L", crc & int('FFFFFFFF', 16))
@@ -277,7 +352,67 @@ def decompress(body):
     return data
 
 
-def gzip(compress_level=5, mime_types=['text/html', 'text/plain'], debug=False):
+def worker_load():
+    """Return the fraction (0.0 to 1.0) of busy HTTP worker threads, or None.
+    
+    Any connection waiting in the ThreadPool queue means every worker is
+    busy. None is returned if the server has no thread pool to inspect
+    (for example, when CherryPy is hosted by another WSGI server).
+    """
+    pool = getattr(getattr(cherrypy.server, 'httpserver', None), 'requests', None)
+    if pool is None or not hasattr(pool, 'idle'):
+        return None
+    if getattr(pool, 'qsize', 0):
+        return 1.0
+    # The pool may have grown past pool.min, so count the threads it has.
+    threads = getattr(pool, 'threads', pool.min)
+    return max(0.0, 1.0 - pool.idle / float(max(threads, 1)))
+
+def _body_size(response):
+    """Return the size of the response body in bytes, or None if unknown."""
+    cl = response.headers.get('Content-Length')
+    if cl is not None:
+        try:
+            return int(cl)
+        except ValueError:
+            pass
+    if isinstance(response.body, (list, tuple)):
+        return sum([len(chunk) for chunk in response.body])
+    return None
+
+_compressible_suffixes = ('json', 'xml', 'javascript')
+
+def adaptive_compress_level(compress_level, size, content_type, load,
+                            min_size=1400):
+    """Return the zlib level to use for a response, or 0 to not compress it.
+    
+    compress_level is the level to use when the server is idle. It is
+    lowered towards 1 as the worker load (0.0 to 1.0, or None if unknown)
+    rises, so that a busy server trades some bandwidth for CPU. Bodies
+    smaller than min_size bytes (about one MTU) gain nothing from
+    compression; very large bodies and non-text content types are
+    capped at lower levels, where the higher levels cost far more CPU
+    for very little gain.
+    """
+    if size is not None and size < min_size:
+        return 0
+    
+    level = compress_level
+    if load is not None:
+        level -= int(round((compress_level - 1) * load))
+    
+    if size is not None and size > 1000000:
+        level = min(level, 6)
+    
+    ct = content_type.lower()
+    if not (ct.startswith('text/') or ct.endswith(_compressible_suffixes)):
+        level = min(level, 3)
+    
+    return max(level, 1)
+
+
+def gzip(compress_level=5, mime_types=['text/html', 'text/plain'], debug=False,
+         adaptive=False, min_size=1400):
     """Try to gzip the response body if Content-Type in mime_types.
     
     cherrypy.response.headers['Content-Type'] must be set to one of the
@@ -294,6 +429,12 @@ def gzip(compress_level=5, mime_types=['text/html', 'text/plain'], debug=False):
         * No 'gzip' or 'x-gzip' with a qvalue > 0 is present
         * The 'identity' value is given with a qvalue > 0.
     
+    If adaptive is True, compress_level is the level used while the server
+    is idle; each response is then compressed at the level chosen by
+    :func:`adaptive_compress_level` from its size, its Content-Type and the
+    current :func:`worker_load`, and bodies smaller than min_size bytes are
+    not compressed at all. Levels, ratios and time spent compressing are
+    recorded in :data:`gzipstats` either way, if it is enabled.
     """
     request = cherrypy.serving.request
     response = cherrypy.serving.response
@@ -306,13 +447,23 @@ def gzip(compress_level=5, mime_types=['text/html', 'text/plain'], debug=False):
             cherrypy.log('No response body', context='TOOLS.GZIP')
         return
     
-    # If returning cached content (which should already have been gzipped),
-    # don't re-zip.
-    if getattr(request, "cached", False):
+    # If returning cached content, reuse any gzipped form the cache kept
+    # for it. If the cache didn't give us any (so the cached body may
+    # already have been gzipped), don't re-zip.
+    cached_encodings = getattr(request, "cached_encodings", None)
+    if getattr(request, "cached", False) and cached_encodings is None:
         if debug:
             cherrypy.log('Not gzipping cached response', context='TOOLS.GZIP')
         return
     
+    # If the body is already encoded (e.g. a precompressed static file),
+    # don't encode it again.
+    if 'Content-Encoding' in response.headers:
+        if debug:
+            cherrypy.log('Response already has Content-Encoding',
+                         context='TOOLS.GZIP')
+        return
+    
     acceptable = request.headers.elements('Accept-Encoding')
     if not acceptable:
         # If no Accept-Encoding field is present in a request,
@@ -371,14 +522,56 @@ def gzip(compress_level=5, mime_types=['text/html', 'text/plain'], debug=False):
                                      (ct, mime_types), context='TOOLS.GZIP')
                     return
             
+            level = compress_level
+            if adaptive:
+                size = _body_size(response)
+                if size is not None and size < min_size:
+                    if debug:
+                        cherrypy.log('Body size %s < min_size %s' %
+                                     (size, min_size), context='TOOLS.GZIP')
+                    if gzipstats.get('Enabled', False):
+                        _stats_lock.acquire()
+                        try:
+                            gzipstats['Skipped (Small Body)'] += 1
+                        finally:
+                            _stats_lock.release()
+                    return
+                if cached_encodings is None:
+                    # A cached gzip form is reused, so that one should
+                    # be compressed at the full compress_level.
+                    level = adaptive_compress_level(
+                        compress_level, size, ct, worker_load(), min_size)
+            
+            stats = None
+            if gzipstats.get('Enabled', False):
+                stats = _level_stats(level)
+            
             if debug:
-                cherrypy.log('Gzipping', context='TOOLS.GZIP')
-            # Return a generator that compresses the page
+                cherrypy.log('Gzipping at level %s' % level, context='TOOLS.GZIP')
             response.headers['Content-Encoding'] = 'gzip'
-            response.body = compress(response.body, compress_level)
-            if "Content-Length" in response.headers:
-                # Delete Content-Length header so finalize() recalcs it.
-                del response.headers["Content-Length"]
+            etag = response.headers.get('ETag')
+            if etag and not etag.startswith('W/'):
+                # A strong tag names the exact bytes of the identity body
+                # (a static file's, say); the gzipped bytes are only
+                # semantically equivalent to those.
+                response.headers['ETag'] = 'W/' + etag
+            if cached_encodings is not None:
+                # Compress the cached body once, then keep serving that.
+                body = cached_encodings.get('gzip')
+                if body is None:
+                    body = ntob('').join(compress(response.body, level, stats))
+                    cherrypy._cache.add_encoding(cached_encodings, 'gzip',
+                                                 body)
+                response.body = body
+                # The cached form may be a file the cache has memory-mapped;
+                # its length is known, so finalize() needn't collapse it.
+                response.headers['Content-Length'] = str(len(body))
+            else:
+                # Return a generator that compresses the page
+                response.body = compress(response.body, level, stats)
+                if "Content-Length" in response.headers:
+                    # Delete Content-Length header so finalize() recalcs it.
+                    del response.headers["Content-Length"]
             
             return
     
@@ -31,6 +31,43 @@ Then call ``cherrypy.session.acquire_lock()`` and ``cherrypy.session.release_loc
 Regardless of which mode you use, the session is guaranteed to be unlocked when
 the request is complete.
 
+Handlers which mostly read the session need not wait for each other. With
+``tools.sessions.locking = 'shared'``, a shared lock is taken before the
+handler instead, which any number of such handlers may hold at once (on
+backends which support it; others take an exclusive lock). With
+``tools.sessions.locking = 'optimistic'``, no lock is taken at all. In both
+modes, changed data is saved under a brief exclusive lock, and only if no
+other request saved the session since it was loaded; otherwise the request
+fails with "409 Conflict", and the client may retry it. A streamed response
+has already been sent by the time its session is saved, so there the
+conflict can only be logged (as a warning in the error log); the client
+is not told that its changes to the session were lost.
+
+===========
+Saving data
+===========
+
+Session data is only written back to storage when it has changed. Changes
+made through the session itself (``cherrypy.session['key'] = value``,
+``pop``, ``update`` and so on) are noticed automatically, but changes to a
+mutable value *inside* the session are not::
+
+    cherrypy.session['cart'].append(item)
+    cherrypy.session.mark_dirty()
+
+If the data has not changed, only its expiration time is refreshed, and then
+at most once every ``touch_freq`` minutes (or a tenth of the timeout, if that
+is shorter).
+
+Backends other than RAM serialize the data with pickle by default (with
+``tools.sessions.pickle_protocol``, if that is set). Set
+``tools.sessions.serializer`` to ``'marshal'`` or ``'json'`` for a faster (but
+less general) format, or to any object with ``dumps`` and ``loads`` methods.
+With ``tools.sessions.compress_threshold`` set, serialized data of at least
+that many bytes is compressed with zlib. The dbapi and sqlite backends can
+also store each key separately (``tools.sessions.per_key = True``), so that
+saving a large session only rewrites the keys which changed.
+
 =================
 Expiring Sessions
 =================
@@ -84,21 +121,140 @@ expiration date, although this was on a system with an inaccurate system time.
 Maybe FF doesn't trust system time.
 """
 
+import bisect
 import datetime
+import logging
+import marshal
 import os
 import random
+import socket
+import sys
+import tempfile
 import time
 import threading
 import types
 from warnings import warn
+import zlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import cherrypy
-from cherrypy._cpcompat import copyitems, pickle, random20
+from cherrypy._cpcompat import basestring, bytestr, get_thread_ident
+from cherrypy._cpcompat import json_decode, json_encode, md5, ntob, pickle
+from cherrypy._cpcompat import random20, set
 from cherrypy.lib import httputil
 
 
 missing = object()
 
+
+class PickleSerializer(object):
+    """Serialize session data with pickle, which handles most values."""
+    
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+    
+    def dumps(self, value):
+        return pickle.dumps(value, self.protocol)
+    
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MarshalSerializer(object):
+    """Serialize session data with marshal.
+    
+    This is faster than pickle, but only handles the built-in types
+    (None, bools, numbers, strings, and tuples, lists, sets and dicts of
+    them). Its format may change between Python versions.
+    """
+    
+    def dumps(self, value):
+        return marshal.dumps(value)
+    
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class JsonSerializer(object):
+    """Serialize session data as JSON.
+    
+    Only None, bools, numbers, strings, lists and dicts with string keys
+    can be stored (and tuples come back as lists), but other programs can
+    read the data.
+    """
+    
+    def dumps(self, value):
+        return ntob('').join(json_encode(value))
+    
+    def loads(self, data):
+        return json_decode(data.decode('utf-8'))
+
+
+class ZlibSerializer(object):
+    """Compress the output of another serializer, when it is large.
+    
+    Compressed data is recognized on loading by its zlib header, so data
+    stored before compression was turned on can still be read.
+    """
+    
+    def __init__(self, serializer, threshold=0, level=6):
+        self.serializer = serializer
+        self.threshold = threshold
+        self.level = level
+    
+    def dumps(self, value):
+        data = self.serializer.dumps(value)
+        if len(data) >= self.threshold:
+            data = zlib.compress(data, self.level)
+        return data
+    
+    def loads(self, data):
+        # Every zlib stream (with the default window) starts with 'x'.
+        if data[:1] == ntob('x'):
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                pass
+        return self.serializer.loads(data)
+
+
+serializers = {'pickle': PickleSerializer(),
+               'marshal': MarshalSerializer(),
+               'json': JsonSerializer(),
+               }
+"""A map from serializer names to serializer objects."""
+
+_serializer_cache = {}
+
+def get_serializer(serializer='pickle', compress_threshold=None,
+                   compress_level=6, pickle_protocol=None):
+    """Return a serializer for the given name (or object) and compression.
+    
+    If pickle_protocol is not None, the 'pickle' serializer uses it.
+    """
+    key = (serializer, compress_threshold, compress_level, pickle_protocol)
+    try:
+        return _serializer_cache[key]
+    except KeyError:
+        pass
+    if serializer == 'pickle' and pickle_protocol is not None:
+        result = PickleSerializer(pickle_protocol)
+    elif isinstance(serializer, basestring):
+        try:
+            result = serializers[serializer]
+        except KeyError:
+            raise ValueError("Unknown session serializer %r." % serializer)
+    else:
+        result = serializer
+    if compress_threshold is not None:
+        result = ZlibSerializer(result, compress_threshold, compress_level)
+    _serializer_cache[key] = result
+    return result
+
+
 class Session(object):
     """A CherryPy dict-like Session object (one per request)."""
     
@@ -121,13 +277,53 @@ class Session(object):
     locked = False
     """
     If True, this session instance has exclusive read/write access
-    to session data."""
+    to session data (or shared read access, if shared_lock is True)."""
+    
+    shared_lock = False
+    "If True, the lock held by this session instance is a shared one."
+    
+    locking = 'implicit'
+    """
+    The locking mode (see SessionTool). In the 'shared' and 'optimistic'
+    modes, data is only saved if nobody else saved it since it was loaded."""
     
     loaded = False
     """
     If True, data has been retrieved from storage. This should happen
     automatically on the first attempt to access session data."""
     
+    dirty = False
+    """
+    If True, session data has changed since it was loaded, and will be
+    written back to storage by save()."""
+    
+    touch_freq = 1
+    """
+    The minimum number of minutes between refreshing the expiration time of
+    unchanged session data (capped at a tenth of the timeout)."""
+    
+    _expiration = None
+    
+    # The keys changed since the data was loaded, or None for all of them.
+    _changed_keys = None
+    
+    serializer = 'pickle'
+    """
+    The name of a serializer ('pickle', 'marshal' or 'json'; see the
+    'serializers' map), or an object with dumps and loads methods, with
+    which backends other than RAM store session data."""
+    
+    compress_threshold = None
+    "If not None, serialized data of at least this many bytes is compressed."
+    
+    compress_level = 6
+    "The zlib compression level, from 1 (fastest) to 9 (smallest)."
+    
+    pickle_protocol = None
+    """
+    If not None, the pickle protocol with which the 'pickle' serializer
+    stores data (by default, the highest one available)."""
+    
     clean_thread = None
     "Class-level Monitor which calls self.clean_up."
     
@@ -138,7 +334,17 @@ class Session(object):
     "The session id passed by the client. May be missing or unsafe."
     
     missing = False
-    "True if the session requested by the client did not exist."
+    """
+    True if the session requested by the client did not exist. This is not
+    known until the session data has been loaded."""
+    
+    verified = True
+    """
+    False if the current id was supplied by the client and has not yet been
+    looked up in storage. The lookup is deferred until the data is loaded, so
+    that checking the id and fetching its data take a single trip to storage;
+    call verify() (or load()) first if you need a trustworthy id before then.
+    The id observers are not told of an unverified id."""
     
     regenerated = False
     """
@@ -154,6 +360,12 @@ class Session(object):
         for k, v in kwargs.items():
             setattr(self, k, v)
         
+        self._serializer = get_serializer(self.serializer,
+                                          self.compress_threshold,
+                                          self.compress_level,
+                                          self.pickle_protocol)
+        self._changed_keys = set()
+        
         self.originalid = id
         self.missing = False
         if id is None:
@@ -162,26 +374,47 @@ class Session(object):
             self._regenerate()
         else:
             self.id = id
-            if not self._exists():
-                if self.debug:
-                    cherrypy.log('Expired or malicious session %r; '
-                                 'making a new one' % id, 'TOOLS.SESSIONS')
-                # Expired or malicious session. Make a new one.
-                # See http://www.cherrypy.org/ticket/709.
-                self.id = None
-                self.missing = True
-                self._regenerate()
+            self.verified = False
+    
+    def verify(self):
+        """Look the client's id up in storage, replacing it if it is missing.
+        
+        Call this before locking the session (the session tool does), so
+        that no lock is taken on an id the client made up.
+        """
+        if not self.verified:
+            self._check_id(self._exists())
+    
+    def _check_id(self, found):
+        if found:
+            self.verified = True
+            # The id can be trusted now; let the observers have it.
+            for o in self.id_observers:
+                o(self.id)
+        else:
+            if self.debug:
+                cherrypy.log('Expired or malicious session %r; '
+                             'making a new one' % self.id, 'TOOLS.SESSIONS')
+            # Expired or malicious session. Make a new one.
+            self.missing = True
+            self._regenerate()
     
     def regenerate(self):
         """Replace the current session (with a new id)."""
         self.regenerated = True
+        self.verified = True
         self._regenerate()
     
     def _regenerate(self):
-        if self.id is not None:
+        # An unverified id has nothing in storage to delete.
+        if self.id is not None and self.verified:
             self.delete()
+        self.verified = True
+        # Whatever data we have must be stored under the new id.
+        self.mark_dirty()
         
         old_session_was_locked = self.locked
+        old_lock_was_shared = self.shared_lock
         if old_session_was_locked:
             self.release_lock()
         
@@ -193,7 +426,10 @@ class Session(object):
                 self.id = None
         
         if old_session_was_locked:
-            self.acquire_lock()
+            if old_lock_was_shared:
+                self.acquire_shared_lock()
+            else:
+                self.acquire_lock()
     
     def clean_up(self):
         """Clean up expired sessions."""
@@ -203,34 +439,90 @@ class Session(object):
         """Return a new session id."""
         return random20()
     
+    def mark_dirty(self, key=None):
+        """Note that session data has changed, so that save() will store it.
+        
+        If the key whose value changed is given, backends which store each
+        key separately only rewrite that one.
+        """
+        if key is None:
+            self.dirty = True
+            self._changed_keys = None
+        else:
+            self._changed(key)
+    
+    def _changed(self, key):
+        self.dirty = True
+        if self._changed_keys is not None:
+            self._changed_keys.add(key)
+    
     def save(self):
-        """Save session data."""
+        """Save session data (or just its expiration time, if unchanged)."""
         try:
             # If session data has never been loaded then it's never been
             #   accessed: no need to save it
             if self.loaded:
                 t = datetime.timedelta(seconds = self.timeout * 60)
                 expiration_time = datetime.datetime.now() + t
-                if self.debug:
-                    cherrypy.log('Saving with expiry %s' % expiration_time,
-                                 'TOOLS.SESSIONS')
-                self._save(expiration_time)
+                if self.dirty:
+                    if self.debug:
+                        cherrypy.log('Saving with expiry %s' % expiration_time,
+                                     'TOOLS.SESSIONS')
+                    self._write(expiration_time)
+                    self.dirty = False
+                    self._changed_keys = set()
+                else:
+                    freq = min(self.touch_freq, self.timeout / 10.0)
+                    if (expiration_time - self._expiration >=
+                        datetime.timedelta(seconds = freq * 60)):
+                        if self.debug:
+                            cherrypy.log('Touching with expiry %s' %
+                                         expiration_time, 'TOOLS.SESSIONS')
+                        self._write(expiration_time, touch=True)
+                self._expiration = expiration_time
             
         finally:
             if self.locked:
                 # Always release the lock if the user didn't release it
                 self.release_lock()
     
+    def _write(self, expiration_time, touch=False):
+        """Call _save (or _touch), checking for conflicts if need be."""
+        if self.locking in ('shared', 'optimistic'):
+            # Others may have saved since we loaded. Check, and write,
+            # under an exclusive lock.
+            if self.locked:
+                self.release_lock()
+            self.acquire_lock()
+            if self._changed_since_load():
+                if touch:
+                    # Whoever saved it refreshed its expiration time, too.
+                    return
+                raise cherrypy.HTTPError(
+                    409, "The session was changed by another request.")
+        if touch:
+            self._touch(expiration_time)
+        else:
+            self._save(expiration_time)
+    
     def load(self):
-        """Copy stored session data into this session instance."""
+        """Copy stored session data into this session instance.
+        
+        If the id was supplied by the client but is not in storage, a new
+        one is made (see http://www.cherrypy.org/ticket/709).
+        """
         data = self._load()
         # data is either None or a tuple (session_data, expiration_time)
+        if not self.verified:
+            self._check_id(data is not None)
         if data is None or data[1] < datetime.datetime.now():
             if self.debug:
                 cherrypy.log('Expired session, flushing data', 'TOOLS.SESSIONS')
             self._data = {}
+            # Not in storage (any longer), so it must be saved.
+            self.mark_dirty()
         else:
-            self._data = data[0]
+            self._data, self._expiration = data
         self.loaded = True
         
         # Stick the clean_thread in the class, not the instance.
@@ -250,6 +542,36 @@ class Session(object):
         """Delete stored session data."""
         self._delete()
     
+    def _timestamp(self, expiration_time):
+        """Return the given datetime in seconds since the epoch."""
+        return (time.mktime(expiration_time.timetuple()) +
+                expiration_time.microsecond / 1000000.0)
+    
+    def _touch(self, expiration_time):
+        """Store a new expiration time for unchanged session data.
+        
+        Backends which can update the expiration time alone should
+        override this; by default, the data is saved again.
+        """
+        self._save(expiration_time)
+    
+    def _changed_since_load(self):
+        """Return True if the stored data was saved by another request since
+        this instance loaded it. Called with the exclusive lock held.
+        
+        Backends which cannot tell should return False (the default), in
+        which case the last writer wins.
+        """
+        return False
+    
+    def acquire_shared_lock(self):
+        """Acquire a lock on the session data, which other readers may share.
+        
+        By default this takes an exclusive lock; backends which can share
+        a lock between readers should override it.
+        """
+        self.acquire_lock()
+    
     def __getitem__(self, key):
         if not self.loaded: self.load()
         return self._data[key]
@@ -257,10 +579,12 @@ class Session(object):
     def __setitem__(self, key, value):
         if not self.loaded: self.load()
         self._data[key] = value
+        self._changed(key)
     
     def __delitem__(self, key):
         if not self.loaded: self.load()
         del self._data[key]
+        self._changed(key)
     
     def pop(self, key, default=missing):
         """Remove the specified key and return the corresponding value.
@@ -268,6 +592,8 @@ class Session(object):
         otherwise KeyError is raised.
         """
         if not self.loaded: self.load()
+        if key in self._data:
+            self._changed(key)
         if default is missing:
             return self._data.pop(key)
         else:
@@ -291,15 +617,24 @@ class Session(object):
         """D.update(E) -> None.  Update D from E: for k in E: D[k] = E[k]."""
         if not self.loaded: self.load()
         self._data.update(d)
+        if hasattr(d, 'keys'):
+            for key in d.keys():
+                self._changed(key)
+        else:
+            self.mark_dirty()
     
     def setdefault(self, key, default=None):
         """D.setdefault(k[,d]) -> D.get(k,d), also set D[k]=d if k not in D."""
         if not self.loaded: self.load()
+        if key not in self._data:
+            self._changed(key)
         return self._data.setdefault(key, default)
     
     def clear(self):
         """D.clear() -> None.  Remove all items from D."""
         if not self.loaded: self.load()
+        if self._data:
+            self.mark_dirty()
         self._data.clear()
     
     def keys(self):
@@ -318,47 +653,305 @@ class Session(object):
         return self._data.values()
 
 
+class _SessionLock(object):
+    """A reentrant lock which may instead be held shared, by many readers."""
+    
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.owner = None
+        self.depth = 0
+        self.readers = 0
+    
+    def acquire(self, shared=False):
+        me = get_thread_ident()
+        self.cond.acquire()
+        try:
+            if shared:
+                while self.owner not in (None, me):
+                    self.cond.wait()
+                self.readers += 1
+            elif self.owner == me:
+                self.depth += 1
+            else:
+                while self.owner is not None or self.readers:
+                    self.cond.wait()
+                self.owner = me
+                self.depth = 1
+        finally:
+            self.cond.release()
+    
+    def release(self, shared=False):
+        self.cond.acquire()
+        try:
+            if shared:
+                self.readers -= 1
+            else:
+                if self.owner != get_thread_ident():
+                    raise RuntimeError("cannot release un-acquired lock")
+                self.depth -= 1
+                if not self.depth:
+                    self.owner = None
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+class _RamShard(object):
+    """One slice of a RamStore, with its own mutex."""
+    
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.data = {}
+        # {bucket number: set of ids}, and {id: bucket number}.
+        self.buckets = {}
+        self.bucket_of = {}
+        # {id: version}, from a counter bumped on every save.
+        self.version = 0
+        self.versions = {}
+        # {id: [_SessionLock, number of holders and waiters]}.
+        self.locks = {}
+
+
+class RamStore(object):
+    """A dict-like, thread-safe store of {id: (data, expiration_time)}.
+    
+    Ids are spread over a number of shards, each with its own mutex, so
+    that requests for different sessions rarely contend. Each shard also
+    files its ids into buckets of bucket_size seconds by expiration time,
+    so that expire() only visits the sessions which are due, rather than
+    every session in the store.
+    
+    Every save of an id gives it a new version number (see
+    get_versioned), by which a session can tell whether anyone saved it
+    since it was loaded.
+    
+    The store also holds the per-session locks; a lock is discarded as
+    soon as nobody holds or waits for it.
+    """
+    
+    shards = 16
+    """The number of shards to spread sessions over."""
+    
+    bucket_size = 1
+    """The width, in seconds, of each expiry bucket."""
+    
+    def __init__(self, shards=None, bucket_size=None):
+        if shards is not None:
+            self.shards = shards
+        if bucket_size is not None:
+            self.bucket_size = bucket_size
+        self._shards = [_RamShard() for i in range(self.shards)]
+    
+    def _shard(self, id):
+        return self._shards[hash(id) % self.shards]
+    
+    def _bucket(self, expiration_time):
+        return int(time.mktime(expiration_time.timetuple()) // self.bucket_size)
+    
+    def _unfile(self, shard, id):
+        b = shard.bucket_of.pop(id, None)
+        if b is not None:
+            ids = shard.buckets[b]
+            ids.discard(id)
+            if not ids:
+                del shard.buckets[b]
+    
+    def __getitem__(self, id):
+        return self._shard(id).data[id]
+    
+    def get(self, id, default=None):
+        return self._shard(id).data.get(id, default)
+    
+    def get_versioned(self, id):
+        """Return ((data, expiration_time) or None, version) for the given id.
+        
+        The version is None if the id is not present.
+        """
+        shard = self._shard(id)
+        shard.mutex.acquire()
+        try:
+            return shard.data.get(id), shard.versions.get(id)
+        finally:
+            shard.mutex.release()
+    
+    def version(self, id):
+        """Return the version of the given id, or None if it is not present."""
+        return self._shard(id).versions.get(id)
+    
+    def __contains__(self, id):
+        return id in self._shard(id).data
+    
+    def __setitem__(self, id, value):
+        b = self._bucket(value[1])
+        shard = self._shard(id)
+        shard.mutex.acquire()
+        try:
+            shard.data[id] = value
+            if shard.bucket_of.get(id) != b:
+                self._unfile(shard, id)
+                shard.bucket_of[id] = b
+                shard.buckets.setdefault(b, set()).add(id)
+            shard.version += 1
+            shard.versions[id] = shard.version
+        finally:
+            shard.mutex.release()
+    
+    def pop(self, id, default=missing):
+        shard = self._shard(id)
+        shard.mutex.acquire()
+        try:
+            self._unfile(shard, id)
+            shard.versions.pop(id, None)
+            if default is missing:
+                return shard.data.pop(id)
+            return shard.data.pop(id, default)
+        finally:
+            shard.mutex.release()
+    
+    def __delitem__(self, id):
+        self.pop(id)
+    
+    def clear(self):
+        """Remove all sessions (but not their locks)."""
+        for shard in self._shards:
+            shard.mutex.acquire()
+            try:
+                shard.data.clear()
+                shard.buckets.clear()
+                shard.bucket_of.clear()
+                shard.versions.clear()
+            finally:
+                shard.mutex.release()
+    
+    def keys(self):
+        """Return a list of all session ids."""
+        keys = []
+        for shard in self._shards:
+            keys.extend(list(shard.data.keys()))
+        return keys
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return sum([len(shard.data) for shard in self._shards])
+    
+    def touch(self, id, expiration_time):
+        """Set a new expiration time for the given id, if it is present."""
+        b = self._bucket(expiration_time)
+        shard = self._shard(id)
+        shard.mutex.acquire()
+        try:
+            entry = shard.data.get(id)
+            if entry is not None:
+                shard.data[id] = (entry[0], expiration_time)
+                if shard.bucket_of.get(id) != b:
+                    self._unfile(shard, id)
+                    shard.bucket_of[id] = b
+                    shard.buckets.setdefault(b, set()).add(id)
+        finally:
+            shard.mutex.release()
+    
+    def expire(self, now=None):
+        """Remove all sessions whose expiration_time is not after now."""
+        if now is None:
+            now = datetime.datetime.now()
+        cutoff = self._bucket(now)
+        for shard in self._shards:
+            shard.mutex.acquire()
+            try:
+                for b in [b for b in shard.buckets if b <= cutoff]:
+                    ids = shard.buckets[b]
+                    for id in list(ids):
+                        if shard.data[id][1] <= now:
+                            ids.discard(id)
+                            del shard.bucket_of[id]
+                            del shard.data[id]
+                            shard.versions.pop(id, None)
+                    if not ids:
+                        del shard.buckets[b]
+            finally:
+                shard.mutex.release()
+    
+    def acquire_lock(self, id, shared=False):
+        """Acquire the (reentrant) lock for the given session id.
+        
+        If shared is True, other shared holders are let in as well.
+        """
+        shard = self._shard(id)
+        shard.mutex.acquire()
+        try:
+            entry = shard.locks.get(id)
+            if entry is None:
+                entry = shard.locks[id] = [_SessionLock(), 0]
+            entry[1] += 1
+        finally:
+            shard.mutex.release()
+        entry[0].acquire(shared)
+    
+    def release_lock(self, id, shared=False):
+        """Release the lock for the given session id."""
+        shard = self._shard(id)
+        shard.mutex.acquire()
+        try:
+            entry = shard.locks[id]
+            entry[0].release(shared)
+            entry[1] -= 1
+            if not entry[1]:
+                del shard.locks[id]
+        finally:
+            shard.mutex.release()
+
+
 class RamSession(Session):
     
     # Class-level objects. Don't rebind these!
-    cache = {}
-    locks = {}
+    cache = RamStore()
     
     def clean_up(self):
         """Clean up expired sessions."""
-        now = datetime.datetime.now()
-        for id, (data, expiration_time) in copyitems(self.cache):
-            if expiration_time <= now:
-                try:
-                    del self.cache[id]
-                except KeyError:
-                    pass
-                try:
-                    del self.locks[id]
-                except KeyError:
-                    pass
+        self.cache.expire()
     
     def _exists(self):
         return self.id in self.cache
     
     def _load(self):
-        return self.cache.get(self.id)
+        entry, self._version = self.cache.get_versioned(self.id)
+        if entry is not None and self.locking in ('shared', 'optimistic'):
+            # Work on a copy; _write checks it back in.
+            entry = (entry[0].copy(), entry[1])
+        return entry
     
     def _save(self, expiration_time):
         self.cache[self.id] = (self._data, expiration_time)
     
+    def _touch(self, expiration_time):
+        self.cache.touch(self.id, expiration_time)
+    
+    def _changed_since_load(self):
+        # Implicit-mode requests save the very dict they loaded, so
+        # compare versions rather than the identity of the data.
+        return self.cache.version(self.id) != getattr(self, '_version', None)
+    
     def _delete(self):
         self.cache.pop(self.id, None)
     
     def acquire_lock(self):
         """Acquire an exclusive lock on the currently-loaded session data."""
+        self.cache.acquire_lock(self.id)
         self.locked = True
-        self.locks.setdefault(self.id, threading.RLock()).acquire()
+    
+    def acquire_shared_lock(self):
+        """Acquire a shared lock on the currently-loaded session data."""
+        self.cache.acquire_lock(self.id, shared=True)
+        self.locked = True
+        self.shared_lock = True
     
     def release_lock(self):
         """Release the lock on the currently-loaded session data."""
-        self.locks[self.id].release()
+        self.cache.release_lock(self.id, self.shared_lock)
         self.locked = False
+        self.shared_lock = False
     
     def __len__(self):
         """Return the number of active sessions."""
@@ -370,18 +963,36 @@ class FileSession(Session):
     
     storage_path
         The folder where session data will be saved. Each session
-        will be saved as pickle.dump(data, expiration_time) in its own file;
-        the filename will be self.SESSION_PREFIX + self.id.
-    
+        will be saved as serializer.dumps((data, expiration_time)) in its
+        own file, with expiration_time in seconds since the epoch; the
+        filename will be self.SESSION_PREFIX + self.id.
+    
+    shard_levels
+        If not 0, session files are spread over this many levels of
+        subdirectories (of up to 256 each), named from a hash of the id,
+        so that no one directory grows too large.
+    
+    Each file's modification time is set to the session's expiration
+    time, so that clean_up only needs to read the files which are due,
+    and an unchanged session can be kept alive without rewriting it.
+    Files are written under a temporary name and renamed into place.
+    
+    Where the fcntl module is available, locks are held with flock() on
+    a lock file beside each session file, and are handed over as soon as
+    they are released; shared locks are supported too. Elsewhere, a
+    lock is the existence of the lock file, which is polled for.
     """
     
     SESSION_PREFIX = 'session-'
     LOCK_SUFFIX = '.lock'
-    pickle_protocol = pickle.HIGHEST_PROTOCOL
+    TEMP_PREFIX = '.tmp-'
+    shard_levels = 0
     
     def __init__(self, id=None, **kwargs):
         # The 'storage_path' arg is required for file-based sessions.
         kwargs['storage_path'] = os.path.abspath(kwargs['storage_path'])
+        # {lock file path: open file descriptor} (when using fcntl).
+        self._lockfds = {}
         Session.__init__(self, id=id, **kwargs)
     
     def setup(cls, **kwargs):
@@ -396,10 +1007,16 @@ class FileSession(Session):
         for k, v in kwargs.items():
             setattr(cls, k, v)
         
+        if fcntl is not None:
+            # Left-over lock files are harmless when locks are flock()s.
+            return
+        
         # Warn if any lock files exist at startup.
-        lockfiles = [fname for fname in os.listdir(cls.storage_path)
-                     if (fname.startswith(cls.SESSION_PREFIX)
-                         and fname.endswith(cls.LOCK_SUFFIX))]
+        lockfiles = []
+        for dirpath, dirnames, filenames in os.walk(cls.storage_path):
+            lockfiles.extend([fname for fname in filenames
+                              if (fname.startswith(cls.SESSION_PREFIX)
+                                  and fname.endswith(cls.LOCK_SUFFIX))])
         if lockfiles:
             plural = ('', 's')[len(lockfiles) > 1]
             warn("%s session lockfile%s found at startup. If you are "
@@ -408,34 +1025,123 @@ class FileSession(Session):
                  % (len(lockfiles), plural, cls.storage_path))
     setup = classmethod(setup)
     
+    def _files(self):
+        """Yield the paths of all session files."""
+        dirs = [self.storage_path]
+        for i in range(self.shard_levels):
+            subdirs = []
+            for d in dirs:
+                try:
+                    names = os.listdir(d)
+                except OSError:
+                    continue
+                subdirs.extend([os.path.join(d, name) for name in names
+                                if len(name) == 2])
+            dirs = subdirs
+        for d in dirs:
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for fname in names:
+                if (fname.startswith(self.SESSION_PREFIX)
+                    and not fname.endswith(self.LOCK_SUFFIX)):
+                    yield os.path.join(d, fname)
+    
     def _get_file_path(self):
-        f = os.path.join(self.storage_path, self.SESSION_PREFIX + self.id)
+        dir = self.storage_path
+        if self.shard_levels:
+            digest = md5(ntob(self.id, 'utf-8')).hexdigest()
+            for i in range(self.shard_levels):
+                dir = os.path.join(dir, digest[i * 2:i * 2 + 2])
+        f = os.path.join(dir, self.SESSION_PREFIX + self.id)
         if not os.path.abspath(f).startswith(self.storage_path):
             raise cherrypy.HTTPError(400, "Invalid session id in cookie.")
         return f
     
+    def _makedirs(self, path):
+        dir = os.path.dirname(path)
+        if not os.path.isdir(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # Another thread or process may have just made it.
+                if not os.path.isdir(dir):
+                    raise
+    
     def _exists(self):
         path = self._get_file_path()
         return os.path.exists(path)
     
     def _load(self, path=None):
-        if path is None:
+        own = path is None
+        if own:
             path = self._get_file_path()
+        contents = self._read(path)
+        if own:
+            # Kept for _changed_since_load.
+            self._stored_data = contents and contents[0]
+        if contents is None:
+            return None
+        stored_data, mtime = contents
+        try:
+            data, expiration_time = self._serializer.loads(stored_data)
+        except (EOFError, ValueError):
+            return None
+        if not isinstance(expiration_time, datetime.datetime):
+            # Older files hold a datetime; newer ones, a timestamp.
+            expiration_time = datetime.datetime.fromtimestamp(expiration_time)
+        # The mtime is moved on by _touch; older files may not have it.
+        return data, max(expiration_time, datetime.datetime.fromtimestamp(mtime))
+    
+    def _read(self, path):
+        """Return (serialized data, mtime) from the given path, or None."""
         try:
             f = open(path, "rb")
             try:
-                return pickle.load(f)
+                return f.read(), os.fstat(f.fileno()).st_mtime
             finally:
                 f.close()
-        except (IOError, EOFError):
+        except (IOError, OSError):
             return None
     
+    def _changed_since_load(self):
+        contents = self._read(self._get_file_path())
+        return ((contents and contents[0]) !=
+                getattr(self, '_stored_data', None))
+    
     def _save(self, expiration_time):
-        f = open(self._get_file_path(), "wb")
+        path = self._get_file_path()
+        self._makedirs(path)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix=self.TEMP_PREFIX)
         try:
-            pickle.dump((self._data, expiration_time), f, self.pickle_protocol)
-        finally:
-            f.close()
+            t = self._timestamp(expiration_time)
+            f = os.fdopen(fd, "wb")
+            try:
+                f.write(self._serializer.dumps((self._data, t)))
+            finally:
+                f.close()
+            os.utime(tmppath, (time.time(), t))
+            try:
+                os.rename(tmppath, path)
+            except OSError:
+                # Windows won't rename over an existing file.
+                os.unlink(path)
+                os.rename(tmppath, path)
+        except:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+    
+    def _touch(self, expiration_time):
+        t = time.mktime(expiration_time.timetuple())
+        try:
+            os.utime(self._get_file_path(), (time.time(), t))
+        except OSError:
+            pass
     
     def _delete(self):
         try:
@@ -443,55 +1149,96 @@ class FileSession(Session):
         except OSError:
             pass
     
-    def acquire_lock(self, path=None):
+    def acquire_lock(self, path=None, shared=False):
         """Acquire an exclusive lock on the currently-loaded session data."""
-        if path is None:
+        own = path is None
+        if own:
+            # Don't make directories or lock files for a made-up id.
+            self.verify()
             path = self._get_file_path()
+            self._makedirs(path)
         path += self.LOCK_SUFFIX
-        while True:
-            try:
-                lockfd = os.open(path, os.O_CREAT|os.O_WRONLY|os.O_EXCL)
-            except OSError:
-                time.sleep(0.1)
-            else:
-                os.close(lockfd) 
-                break
-        self.locked = True
+        if fcntl is None:
+            while True:
+                try:
+                    lockfd = os.open(path, os.O_CREAT|os.O_WRONLY|os.O_EXCL)
+                except OSError:
+                    time.sleep(0.1)
+                else:
+                    os.close(lockfd) 
+                    break
+        else:
+            op = shared and fcntl.LOCK_SH or fcntl.LOCK_EX
+            while True:
+                lockfd = os.open(path, os.O_CREAT|os.O_RDWR)
+                fcntl.flock(lockfd, op)
+                # If the lock file was removed while we waited, our lock
+                # is on a file nobody else will look at: try again.
+                try:
+                    if os.stat(path).st_ino == os.fstat(lockfd).st_ino:
+                        break
+                except OSError:
+                    pass
+                os.close(lockfd)
+            self._lockfds[path] = lockfd
+        if own:
+            self.locked = True
+            self.shared_lock = shared and fcntl is not None
+    
+    def acquire_shared_lock(self):
+        """Acquire a shared lock on the currently-loaded session data."""
+        self.acquire_lock(shared=True)
     
     def release_lock(self, path=None):
         """Release the lock on the currently-loaded session data."""
-        if path is None:
+        own = path is None
+        if own:
             path = self._get_file_path()
-        os.unlink(path + self.LOCK_SUFFIX)
-        self.locked = False
+        lockpath = path + self.LOCK_SUFFIX
+        if fcntl is None:
+            os.unlink(lockpath)
+        else:
+            lockfd = self._lockfds.pop(lockpath)
+            try:
+                if not (own and self.shared_lock) and not os.path.exists(path):
+                    # No session file left to guard: tidy up the lock file
+                    # (anyone waiting on it will notice, and try again).
+                    os.unlink(lockpath)
+            finally:
+                os.close(lockfd)
+        if own:
+            self.locked = False
+            self.shared_lock = False
     
     def clean_up(self):
         """Clean up expired sessions."""
-        now = datetime.datetime.now()
-        # Iterate over all session files in self.storage_path
-        for fname in os.listdir(self.storage_path):
-            if (fname.startswith(self.SESSION_PREFIX)
-                and not fname.endswith(self.LOCK_SUFFIX)):
-                # We have a session file: lock and load it and check
-                #   if it's expired. If it fails, nevermind.
-                path = os.path.join(self.storage_path, fname)
-                self.acquire_lock(path)
-                try:
-                    contents = self._load(path)
-                    # _load returns None on IOError
-                    if contents is not None:
-                        data, expiration_time = contents
-                        if expiration_time < now:
-                            # Session expired: deleting it
-                            os.unlink(path)
-                finally:
-                    self.release_lock(path)
+        now = time.time()
+        for path in self._files():
+            # Only files whose mtime has passed may have expired.
+            try:
+                if os.stat(path).st_mtime >= now:
+                    continue
+            except OSError:
+                continue
+            self.acquire_lock(path)
+            try:
+                contents = self._load(path)
+                # _load returns None on IOError
+                if contents is not None:
+                    data, expiration_time = contents
+                    t = time.mktime(expiration_time.timetuple())
+                    if t < now:
+                        # Session expired: deleting it
+                        os.unlink(path)
+                    else:
+                        # Written before mtimes were expiration times.
+                        os.utime(path, (now, t))
+            finally:
+                self.release_lock(path)
     
     def __len__(self):
         """Return the number of active sessions."""
-        return len([fname for fname in os.listdir(self.storage_path)
-                    if (fname.startswith(self.SESSION_PREFIX)
-                        and not fname.endswith(self.LOCK_SUFFIX))])
+        return len(list(self._files()))
 
 
 class PostgresqlSession(Session):
@@ -507,8 +1254,6 @@ class PostgresqlSession(Session):
     You must provide your own get_db function.
     """
     
-    pickle_protocol = pickle.HIGHEST_PROTOCOL
-    
     def __init__(self, id=None, **kwargs):
         Session.__init__(self, id, **kwargs)
         self.cursor = self.db.cursor()
@@ -545,15 +1290,28 @@ class PostgresqlSession(Session):
         if not rows:
             return None
         
-        pickled_data, expiration_time = rows[0]
-        data = pickle.loads(pickled_data)
+        stored_data, expiration_time = rows[0]
+        # Kept for _changed_since_load.
+        self._stored_data = stored_data
+        data = self._serializer.loads(stored_data)
         return data, expiration_time
     
     def _save(self, expiration_time):
-        pickled_data = pickle.dumps(self._data, self.pickle_protocol)
+        stored_data = self._serializer.dumps(self._data)
         self.cursor.execute('update session set data = %s, '
                             'expiration_time = %s where id = %s',
-                            (pickled_data, expiration_time, self.id))
+                            (stored_data, expiration_time, self.id))
+    
+    def _touch(self, expiration_time):
+        self.cursor.execute('update session set expiration_time = %s '
+                            'where id = %s', (expiration_time, self.id))
+    
+    def _changed_since_load(self):
+        self.cursor.execute('select data from session where id=%s',
+                            (self.id,))
+        rows = self.cursor.fetchall()
+        current = rows and rows[0][0] or None
+        return current != getattr(self, '_stored_data', None)
     
     def _delete(self):
         self.cursor.execute('delete from session where id=%s', (self.id,))
@@ -565,12 +1323,20 @@ class PostgresqlSession(Session):
         self.cursor.execute('select id from session where id=%s for update',
                             (self.id,))
     
+    def acquire_shared_lock(self):
+        """Acquire a shared lock on the currently-loaded session data."""
+        # The "for share" clause lets other readers lock the row, too
+        self.locked = True
+        self.shared_lock = True
+        self.cursor.execute('select id from session where id=%s for share',
+                            (self.id,))
+    
     def release_lock(self):
         """Release the lock on the currently-loaded session data."""
-        # We just close the cursor and that will remove the lock
-        #   introduced by the "for update" clause
-        self.cursor.close()
+        # Row locks last until the end of the transaction
+        self.db.commit()
         self.locked = False
+        self.shared_lock = False
     
     def clean_up(self):
         """Clean up expired sessions."""
@@ -578,17 +1344,617 @@ class PostgresqlSession(Session):
                             (datetime.datetime.now(),))
 
 
-class MemcachedSession(Session):
+class ConnectionPool(object):
+    """A bounded pool of DB-API connections, shared by all threads.
+    
+    get() hands out an idle connection, or makes a new one with the
+    connect callable; once maxsize connections are out, it waits for one
+    to be put() back.
+    """
+    
+    def __init__(self, connect, maxsize=10):
+        self.connect = connect
+        self.maxsize = maxsize
+        self.idle = []
+        self.size = 0
+        self.cond = threading.Condition(threading.Lock())
+    
+    def get(self):
+        """Return a connection for the exclusive use of the caller."""
+        self.cond.acquire()
+        try:
+            while not self.idle and self.size >= self.maxsize:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.size += 1
+        finally:
+            self.cond.release()
+        try:
+            return self.connect()
+        except:
+            self.discard(None)
+            raise
+    
+    def put(self, conn):
+        """Return the given connection to the pool."""
+        self.cond.acquire()
+        try:
+            self.idle.append(conn)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+    
+    def discard(self, conn):
+        """Close the given (broken) connection, and make room for another."""
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.cond.acquire()
+        try:
+            self.size -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+    
+    def close(self):
+        """Close all idle connections."""
+        self.cond.acquire()
+        try:
+            idle, self.idle = self.idle, []
+        finally:
+            self.cond.release()
+        for conn in idle:
+            self.discard(conn)
+
+
+class DbapiSession(Session):
+    """Implementation of a generic DB-API 2.0 backend for sessions.
+    
+    get_db
+        A callable (taking no arguments) which returns a new connection;
+        if set in a subclass, it must be a staticmethod or classmethod.
+        Connections are kept in a ConnectionPool of up to pool_size, and
+        each is used by one thread at a time.
+    
+    binary
+        A callable which wraps serialized data for storage; usually the
+        driver module's Binary.
+    
+    The default SQL assumes tables like these, and 'qmark' parameters::
+    
+        create table session (
+            id varchar(40) primary key,
+            data blob,
+            expiration_time real
+        )
+        
+        create table session_item (
+            id varchar(40),
+            name blob,
+            value blob,
+            primary key (id, name)
+        )
+    
+    where expiration_time is in seconds since the epoch. The session_item
+    table is only used when per_key is True. For other databases or
+    drivers, override the sql_* attributes; sql_upsert and
+    sql_upsert_item in particular use SQLite's "insert or replace".
+    
+    Locks are held in this process only. If several processes share the
+    table, use locking='optimistic' (or 'shared'), so that a save which
+    would overwrite another request's changes is refused.
+    """
+    
+    get_db = None
+    binary = None
+    
+    per_key = False
+    """
+    If True, each key of the session is stored (serialized) in its own row
+    of the session_item table, so that saving only rewrites the keys which
+    changed (see Session.mark_dirty). The session's data column then holds
+    a version stamp, which is changed on each save."""
+    
+    pool_size = 10
+    "The maximum number of connections to open."
+    
+    clean_up_batch = 500
+    "The number of expired sessions clean_up deletes in each transaction."
+    
+    sql_create = []
+    "Statements run by setup to create the table, if any."
+    
+    sql_exists = 'select 1 from session where id = ?'
+    sql_select = 'select data, expiration_time from session where id = ?'
+    sql_upsert = ('insert or replace into session (id, data, expiration_time) '
+                  'values (?, ?, ?)')
+    sql_touch = 'update session set expiration_time = ? where id = ?'
+    sql_delete = 'delete from session where id = ?'
+    sql_clean_up = ('delete from session where id in (select id from session '
+                    'where expiration_time < ? limit ?)')
+    sql_count = 'select count(*) from session where expiration_time >= ?'
+    
+    sql_select_items = 'select name, value from session_item where id = ?'
+    sql_upsert_item = ('insert or replace into session_item (id, name, value) '
+                       'values (?, ?, ?)')
+    sql_delete_item = 'delete from session_item where id = ? and name = ?'
+    sql_delete_items = 'delete from session_item where id = ?'
+    sql_expired = 'select id from session where expiration_time < ? limit ?'
+    
+    # Class-level objects, made by setup.
+    pool = None
+    locks = None
+    
+    def setup(cls, **kwargs):
+        """Set up the storage system for DB-API sessions.
+        
+        This should only be called once per process; this will be done
+        automatically when using sessions.init (as the built-in Tool does).
+        """
+        for k, v in kwargs.items():
+            setattr(cls, k, v)
+        
+        # Not cls.get_db, which would make a plain function a method.
+        get_db = kwargs.get('get_db', cls.get_db)
+        if get_db is None:
+            raise ValueError("DbapiSession requires a 'get_db' callable.")
+        cls.pool = ConnectionPool(get_db, cls.pool_size)
+        cls.locks = RamStore()
+        
+        for sql in cls.sql_create:
+            cls._execute(sql)
+    setup = classmethod(setup)
+    
+    def _transaction(cls, func):
+        """Call func(cursor) in its own transaction; return its result."""
+        conn = cls.pool.get()
+        try:
+            cursor = conn.cursor()
+            try:
+                result = func(cursor)
+            finally:
+                cursor.close()
+            conn.commit()
+        except:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            cls.pool.discard(conn)
+            raise
+        cls.pool.put(conn)
+        return result
+    _transaction = classmethod(_transaction)
+    
+    def _execute(cls, sql, params=(), fetch=False):
+        """Run sql in its own transaction; return its rows or rowcount."""
+        def execute(cursor):
+            cursor.execute(sql, params)
+            if fetch:
+                return cursor.fetchall()
+            return cursor.rowcount
+        return cls._transaction(execute)
+    _execute = classmethod(_execute)
+    
+    def _blob(self, data):
+        if self.binary is not None:
+            data = self.binary(data)
+        return data
+    
+    def _exists(self):
+        return bool(self._execute(self.sql_exists, (self.id,), fetch=True))
+    
+    def _load(self):
+        def load(cursor):
+            cursor.execute(self.sql_select, (self.id,))
+            rows = cursor.fetchall()
+            if rows and self.per_key:
+                cursor.execute(self.sql_select_items, (self.id,))
+                return rows, cursor.fetchall()
+            return rows, None
+        rows, items = self._transaction(load)
+        if not rows:
+            self._stored_data = None
+            return None
+        stored_data, expiration_time = rows[0]
+        # Kept for _changed_since_load.
+        self._stored_data = stored_data = bytestr(stored_data)
+        loads = self._serializer.loads
+        if self.per_key:
+            data = {}
+            for name, value in items:
+                data[loads(bytestr(name))] = loads(bytestr(value))
+        else:
+            data = loads(stored_data)
+        return data, datetime.datetime.fromtimestamp(expiration_time)
+    
+    def _save(self, expiration_time):
+        t = self._timestamp(expiration_time)
+        if not self.per_key:
+            stored_data = self._blob(self._serializer.dumps(self._data))
+            self._execute(self.sql_upsert, (self.id, stored_data, t))
+            return
+        
+        dumps = self._serializer.dumps
+        def save(cursor):
+            keys = self._changed_keys
+            if keys is None:
+                cursor.execute(self.sql_delete_items, (self.id,))
+                keys = self._data.keys()
+            for key in keys:
+                name = self._blob(dumps(key))
+                if key in self._data:
+                    value = self._blob(dumps(self._data[key]))
+                    cursor.execute(self.sql_upsert_item,
+                                   (self.id, name, value))
+                else:
+                    cursor.execute(self.sql_delete_item, (self.id, name))
+            version = self._blob(random20().encode('ascii'))
+            cursor.execute(self.sql_upsert, (self.id, version, t))
+        self._transaction(save)
+    
+    def _touch(self, expiration_time):
+        self._execute(self.sql_touch, (self._timestamp(expiration_time),
+                                       self.id))
+    
+    def _changed_since_load(self):
+        rows = self._execute(self.sql_select, (self.id,), fetch=True)
+        current = rows and bytestr(rows[0][0]) or None
+        return current != getattr(self, '_stored_data', None)
+    
+    def _delete(self):
+        def delete(cursor):
+            if self.per_key:
+                cursor.execute(self.sql_delete_items, (self.id,))
+            cursor.execute(self.sql_delete, (self.id,))
+        self._transaction(delete)
+    
+    def acquire_lock(self):
+        """Acquire an exclusive lock on the currently-loaded session data."""
+        self.locks.acquire_lock(self.id)
+        self.locked = True
+    
+    def acquire_shared_lock(self):
+        """Acquire a shared lock on the currently-loaded session data."""
+        self.locks.acquire_lock(self.id, shared=True)
+        self.locked = True
+        self.shared_lock = True
+    
+    def release_lock(self):
+        """Release the lock on the currently-loaded session data."""
+        self.locks.release_lock(self.id, self.shared_lock)
+        self.locked = False
+        self.shared_lock = False
+    
+    def clean_up(self):
+        """Clean up expired sessions, a batch per transaction."""
+        now = time.time()
+        def clean_up(cursor):
+            if not self.per_key:
+                cursor.execute(self.sql_clean_up, (now, self.clean_up_batch))
+                return cursor.rowcount
+            cursor.execute(self.sql_expired, (now, self.clean_up_batch))
+            ids = [(row[0],) for row in cursor.fetchall()]
+            if ids:
+                cursor.executemany(self.sql_delete_items, ids)
+                cursor.executemany(self.sql_delete, ids)
+            return len(ids)
+        while True:
+            count = self._transaction(clean_up)
+            if count < self.clean_up_batch:
+                break
+    
+    def __len__(self):
+        """Return the number of active sessions."""
+        return self._execute(self.sql_count, (time.time(),), fetch=True)[0][0]
+
+
+class SqliteSession(DbapiSession):
+    """Implementation of the SQLite backend for sessions.
+    
+    This needs no server, yet persists sessions, and lets several
+    processes on the same machine share them (see DbapiSession on
+    locking).
+    
+    database
+        The path of the database file. If None (the default), the file
+        'sessions.db' in storage_path is used. The table is created if
+        it does not exist, and the database is put in WAL mode, so that
+        readers don't block the writer.
+    """
+    
+    database = None
     
-    # The most popular memcached client for Python isn't thread-safe.
-    # Wrap all .get and .set operations in a single lock.
-    mc_lock = threading.RLock()
+    busy_timeout = 5
+    "Seconds to wait for another connection's write to finish."
     
-    # This is a seperate set of locks per session id.
-    locks = {}
+    sql_create = [
+        'create table if not exists session (id varchar(40) primary key, '
+        'data blob, expiration_time real)',
+        'create index if not exists session_expiration_time '
+        'on session (expiration_time)',
+        'create table if not exists session_item (id varchar(40), '
+        'name blob, value blob, primary key (id, name))',
+        ]
+    
+    def setup(cls, **kwargs):
+        """Set up the storage system for SQLite sessions.
+        
+        This should only be called once per process; this will be done
+        automatically when using sessions.init (as the built-in Tool does).
+        """
+        import sqlite3
+        
+        for k, v in kwargs.items():
+            setattr(cls, k, v)
+        
+        database = cls.database
+        if database is None:
+            storage_path = getattr(cls, 'storage_path', None)
+            if not storage_path:
+                raise ValueError("SqliteSession requires a 'database' file "
+                                 "or a 'storage_path' directory.")
+            database = os.path.join(os.path.abspath(storage_path),
+                                    'sessions.db')
+        busy_timeout = cls.busy_timeout
+        def get_db():
+            conn = sqlite3.connect(database, timeout=busy_timeout,
+                                   check_same_thread=False)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            return conn
+        
+        kwargs.setdefault('get_db', get_db)
+        kwargs.setdefault('binary', sqlite3.Binary)
+        super(SqliteSession, cls).setup(**kwargs)
+    setup = classmethod(setup)
+
+
+class MemcachedError(Exception):
+    """A memcached server returned an error, or an unexpected reply."""
+    pass
+
+
+class _MemcachedConnection(object):
+    """A socket to one memcached server, speaking its text protocol."""
+    
+    def __init__(self, host, port, timeout=None):
+        err = None
+        for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+            af, socktype, proto, canonname, sa = res
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                if timeout is not None:
+                    sock.settimeout(timeout)
+                sock.connect(sa)
+            except socket.error:
+                err = sys.exc_info()[1]
+                if sock is not None:
+                    sock.close()
+                continue
+            break
+        else:
+            raise err or socket.error("getaddrinfo returns an empty list")
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+    
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+    
+    def send(self, line, data=None):
+        line = line.encode('ascii') + ntob('\r\n')
+        if data is not None:
+            line += data + ntob('\r\n')
+        self.sock.sendall(line)
+    
+    def readline(self):
+        line = self.rfile.readline()
+        if not line.endswith(ntob('\r\n')):
+            raise MemcachedError("Connection closed by memcached.")
+        line = line[:-2]
+        if (line == ntob('ERROR') or line.startswith(ntob('CLIENT_ERROR'))
+            or line.startswith(ntob('SERVER_ERROR'))):
+            raise MemcachedError(line)
+        return line
+    
+    def read_values(self):
+        """Read VALUE lines up to END; return {key: (data, cas unique)}."""
+        values = {}
+        while True:
+            line = self.readline()
+            if line == ntob('END'):
+                return values
+            parts = line.split()
+            if parts[0] != ntob('VALUE'):
+                raise MemcachedError(line)
+            length = int(parts[3])
+            cas = None
+            if len(parts) > 4:
+                cas = int(parts[4])
+            data = self.rfile.read(length + 2)[:-2]
+            values[str(parts[1].decode('ascii'))] = (data, cas)
+
+
+class MemcachedClient(object):
+    """A small, thread-safe client for memcached's text protocol.
+    
+    Keys are spread over the given servers ('host:port' strings) by
+    consistent hashing, so that adding or removing a server only moves
+    the keys near it. Only the part of a key before any '.' is hashed, so
+    that related keys (such as 'x', 'x.lock' and 'x.expires') live on
+    the same server and can be fetched together with gets_many. Each
+    server has its own ConnectionPool of up to pool_size sockets; a
+    socket is used by one thread at a time, and dropped if a command on
+    it fails. Values are stored with the given serializer (by default,
+    with pickle).
+    """
+    
+    points_per_server = 160
+    """The number of points each server gets on the hash ring."""
+    
+    pickle_protocol = None
+    """
+    If not None, the pickle protocol to store values with when no serializer
+    is given."""
+    
+    def __init__(self, servers, pool_size=10, timeout=5, serializer=None):
+        if serializer is None:
+            serializer = get_serializer(pickle_protocol=self.pickle_protocol)
+        self.serializer = serializer
+        self.pools = {}
+        ring = []
+        for server in servers:
+            host, port = server.split(':')
+            self.pools[server] = ConnectionPool(
+                self._connector(host, int(port), timeout), pool_size)
+            for i in range(self.points_per_server):
+                ring.append((self._hash('%s-%s' % (server, i)), server))
+        ring.sort()
+        self._points = [point for point, server in ring]
+        self._servers = [server for point, server in ring]
+    
+    def _connector(self, host, port, timeout):
+        def connect():
+            return _MemcachedConnection(host, port, timeout)
+        return connect
+    
+    def _hash(self, key):
+        return int(md5(ntob(key)).hexdigest()[:8], 16)
+    
+    def server_for(self, key):
+        """Return the server (of those given) which holds the given key."""
+        key = key.split('.', 1)[0]
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._servers[i]
+    
+    def _call(self, key, func):
+        pool = self.pools[self.server_for(key)]
+        conn = pool.get()
+        try:
+            result = func(conn)
+        except:
+            pool.discard(conn)
+            raise
+        pool.put(conn)
+        return result
+    
+    def _store(self, cmd, key, value, time=0, cas=None):
+        data = self.serializer.dumps(value)
+        line = '%s %s 0 %d %d' % (cmd, key, time, len(data))
+        if cas is not None:
+            line += ' %d' % cas
+        def store(conn):
+            conn.send(line, data)
+            return conn.readline()
+        return self._call(key, store)
+    
+    def get(self, key):
+        """Return the value stored for the given key, or None."""
+        return self.gets(key)[0]
+    
+    def gets(self, key):
+        """Return (value, cas unique) for the given key, or (None, None)."""
+        return self.gets_many([key])[0]
+    
+    def gets_many(self, keys):
+        """Return a list of (value, cas unique) or (None, None), one for
+        each of the given keys, fetched with a single command.
+        
+        The keys must live on the same server; see server_for.
+        """
+        def gets(conn):
+            conn.send('gets %s' % ' '.join(keys))
+            return conn.read_values()
+        values = self._call(keys[0], gets)
+        result = []
+        for key in keys:
+            value = values.get(key)
+            if value is None:
+                result.append((None, None))
+            else:
+                result.append((self.serializer.loads(value[0]), value[1]))
+        return result
+    
+    def set(self, key, value, time=0):
+        """Store the given value; return True if it was stored."""
+        return self._store('set', key, value, time) == ntob('STORED')
+    
+    def add(self, key, value, time=0):
+        """Store the given value, only if the key is not already stored."""
+        return self._store('add', key, value, time) == ntob('STORED')
+    
+    def cas(self, key, value, cas, time=0):
+        """Store the given value, only if nobody has since the given gets.
+        
+        Return True if it was stored, False if it was changed (or deleted)
+        by someone else.
+        """
+        return self._store('cas', key, value, time, cas) == ntob('STORED')
+    
+    def delete(self, key):
+        """Delete the given key; return True if it was stored."""
+        def delete(conn):
+            conn.send('delete %s' % key)
+            return conn.readline()
+        return self._call(key, delete) == ntob('DELETED')
+    
+    def touch(self, key, time):
+        """Set a new expiration time for the given key, without its value."""
+        def touch(conn):
+            conn.send('touch %s %d' % (key, time))
+            return conn.readline()
+        return self._call(key, touch) == ntob('TOUCHED')
+
+
+class MemcachedSession(Session):
+    """Implementation of the memcached backend for sessions.
+    
+    servers
+        A list of 'host:port' strings. Sessions are spread over them with
+        the built-in MemcachedClient, whose pooled connections let all
+        threads use memcached at once.
+    
+    Locks are kept in memcached too, so they hold across processes. A
+    lock is a key 'add'ed next to the session's, which lapses after
+    lock_timeout seconds, and which is removed with 'cas', so that only
+    its holder can. The lock is reentrant within one Session instance
+    (that is, one request), but not across them. In the 'shared' and
+    'optimistic' locking modes, a save fails if the session's cas unique
+    changed since it was loaded.
+    
+    Refreshing the expiration time of unchanged data only 'touch'es the
+    session's key, and records the new time in a small '.expires' key
+    beside it, which is read along with the data.
+    
+    Sessions are stored under 'session-' + id, as (data, expiration
+    timestamp). Earlier versions stored (data, expiration datetime) under
+    the bare id; while legacy_keys is True, a session which isn't found
+    under its new key is looked for there too, and moved on its next save.
+    """
     
     servers = ['127.0.0.1:11211']
     
+    pool_size = 10
+    "The maximum number of connections to each server."
+    
+    lock_timeout = 30
+    "The number of seconds after which an abandoned lock is broken."
+    
+    legacy_keys = True
+    "If True, read sessions stored under the bare id by earlier versions."
+    
+    _legacy = False
+    
+    _lock_depth = 0
+    
+    # Class-level objects, made by setup.
+    cache = None
+    
     def setup(cls, **kwargs):
         """Set up the storage system for memcached-based sessions.
         
@@ -598,45 +1964,116 @@ class MemcachedSession(Session):
         for k, v in kwargs.items():
             setattr(cls, k, v)
         
-        import memcache
-        cls.cache = memcache.Client(cls.servers)
+        serializer = get_serializer(cls.serializer, cls.compress_threshold,
+                                    cls.compress_level, cls.pickle_protocol)
+        cls.cache = MemcachedClient(cls.servers, cls.pool_size,
+                                    serializer=serializer)
     setup = classmethod(setup)
     
+    def _key(self):
+        # memcached keys are limited to 250 characters, and may not
+        # contain spaces or control characters.
+        id = self.id
+        if len(id) > 200 or not id.isalnum() or max(id) > 'z':
+            id = md5(ntob(id, 'utf-8')).hexdigest()
+        return 'session-' + id
+    
     def _exists(self):
-        self.mc_lock.acquire()
-        try:
-            return bool(self.cache.get(self.id))
-        finally:
-            self.mc_lock.release()
+        return self.cache.get(self._key()) is not None
+    
+    def _legacy_key(self):
+        # Earlier versions used the id itself, when it was a valid key.
+        id = self.id
+        if (self.legacy_keys and len(id) <= 200 and id.isalnum()
+            and max(id) <= 'z'):
+            return id
+        return None
     
     def _load(self):
-        self.mc_lock.acquire()
-        try:
-            return self.cache.get(self.id)
-        finally:
-            self.mc_lock.release()
+        key = self._key()
+        stored, expires = self.cache.gets_many([key, key + '.expires'])
+        value, self._cas = stored
+        touched = expires[0]
+        self._legacy = False
+        if value is None:
+            legacy_key = self._legacy_key()
+            if legacy_key is None:
+                return None
+            try:
+                value = self.cache.get(legacy_key)
+            except (MemcachedError, EnvironmentError):
+                raise
+            except Exception:
+                # Not something this serializer can read.
+                value = None
+            if not isinstance(value, tuple) or len(value) != 2:
+                return None
+            self._legacy = True
+        data, expiration_time = value
+        if isinstance(expiration_time, datetime.datetime):
+            expiration_time = self._timestamp(expiration_time)
+        if touched is not None:
+            expiration_time = max(expiration_time, touched)
+        return data, datetime.datetime.fromtimestamp(expiration_time)
     
     def _save(self, expiration_time):
-        # Send the expiration time as "Unix time" (seconds since 1/1/1970)
-        td = int(time.mktime(expiration_time.timetuple()))
-        self.mc_lock.acquire()
-        try:
-            if not self.cache.set(self.id, (self._data, expiration_time), td):
-                raise AssertionError("Session data for id %r not set." % self.id)
-        finally:
-            self.mc_lock.release()
+        # Send the expiration time as "Unix time" (seconds since 1/1/1970),
+        # rounded up, so that memcached doesn't drop the data early.
+        t = self._timestamp(expiration_time)
+        if not self.cache.set(self._key(), (self._data, t), int(t) + 1):
+            raise AssertionError("Session data for id %r not set." % self.id)
+        if self._legacy:
+            self.cache.delete(self._legacy_key())
+            self._legacy = False
+    
+    def _touch(self, expiration_time):
+        if self._legacy:
+            # Move the session to its new key.
+            self._save(expiration_time)
+            return
+        t = self._timestamp(expiration_time)
+        key = self._key()
+        if self.cache.touch(key, int(t) + 1):
+            self.cache.set(key + '.expires', t, int(t) + 1)
+    
+    def _changed_since_load(self):
+        value, cas = self.cache.gets(self._key())
+        return cas != getattr(self, '_cas', None)
     
     def _delete(self):
-        self.cache.delete(self.id)
+        key = self._key()
+        self.cache.delete(key)
+        self.cache.delete(key + '.expires')
+        legacy_key = self._legacy_key()
+        if legacy_key is not None:
+            self.cache.delete(legacy_key)
     
     def acquire_lock(self):
         """Acquire an exclusive lock on the currently-loaded session data."""
+        if self.locked:
+            self._lock_depth += 1
+            return
+        key = self._key() + '.lock'
+        token = random20()
+        delay = 0.001
+        while not self.cache.add(key, token, self.lock_timeout):
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        self._lock_token = token
+        self._lock_depth = 1
         self.locked = True
-        self.locks.setdefault(self.id, threading.RLock()).acquire()
     
     def release_lock(self):
         """Release the lock on the currently-loaded session data."""
-        self.locks[self.id].release()
+        if self._lock_depth > 1:
+            self._lock_depth -= 1
+            return
+        key = self._key() + '.lock'
+        token, cas = self.cache.gets(key)
+        if token == self._lock_token:
+            # A negative time expires the key at once.
+            self.cache.cas(key, None, cas, -1)
+        self._lock_depth = 0
         self.locked = False
     
     def __len__(self):
@@ -662,7 +2099,7 @@ def save():
     if response.stream:
         # If the body is being streamed, we have to save the data
         #   *after* the response has been written out
-        request.hooks.attach('on_end_request', cherrypy.session.save)
+        request.hooks.attach('on_end_request', _save_streamed)
     else:
         # If the body is not being streamed, we save the data now
         # (so we can release the lock).
@@ -671,6 +2108,19 @@ def save():
         cherrypy.session.save()
 save.failsafe = True
 
+def _save_streamed():
+    """Save the session after a streamed response has been written out."""
+    sess = cherrypy.serving.session
+    try:
+        sess.save()
+    except cherrypy.HTTPError:
+        if sys.exc_info()[1].status != 409:
+            raise
+        # Too late to send the 409; at least leave a trace.
+        cherrypy.log('Session %r was changed by another request while this '
+                     'one streamed its response; its changes were not saved.'
+                     % sess.id, 'TOOLS.SESSIONS', severity=logging.WARNING)
+
 def close():
     """Close the session object for this request."""
     sess = getattr(cherrypy.serving, "session", None)
@@ -687,7 +2137,8 @@ def init(storage_type='ram', path=None, path_header=None, name='session_id',
     """Initialize session object (using cookies).
     
     storage_type
-        One of 'ram', 'file', 'postgresql'. This will be used
+        One of 'ram', 'file', 'postgresql', 'dbapi', 'sqlite', 'memcached'.
+        This will be used
         to look up the corresponding class in cherrypy.lib.sessions
         globals. For example, 'file' will use the FileSession class.
     
@@ -756,10 +2207,6 @@ def init(storage_type='ram', path=None, path_header=None, name='session_id',
     kwargs['clean_freq'] = clean_freq
     cherrypy.serving.session = sess = storage_class(id, **kwargs)
     sess.debug = debug
-    def update_cookie(id):
-        """Update the cookie every time the session id changes."""
-        cherrypy.serving.response.cookie[name] = id
-    sess.id_observers.append(update_cookie)
     
     # Create cherrypy.session which will proxy to cherrypy.serving.session
     if not hasattr(cherrypy, "session"):
@@ -771,8 +2218,16 @@ def init(storage_type='ram', path=None, path_header=None, name='session_id',
         # See http://support.microsoft.com/kb/223799/EN-US/
         # and http://support.mozilla.com/en-US/kb/Cookies
         cookie_timeout = None
-    set_response_cookie(path=path, path_header=path_header, name=name,
-                        timeout=cookie_timeout, domain=domain, secure=secure)
+    def update_cookie(id):
+        """Update the cookie every time the session id changes."""
+        if id is not None:
+            set_response_cookie(path=path, path_header=path_header, name=name,
+                                timeout=cookie_timeout, domain=domain,
+                                secure=secure)
+    sess.id_observers.append(update_cookie)
+    # Don't echo the client's id until it is known to be in storage.
+    if sess.verified:
+        update_cookie(sess.id)
 
 
 def set_response_cookie(path=None, path_header=None, name='session_id',
@@ -6,17 +6,450 @@ mimetypes.types_map['.ico']='image/x-icon'
 mimetypes.types_map['.bz2']='application/x-bzip2'
 mimetypes.types_map['.gz']='application/x-gzip'
 
+import mmap
 import os
 import re
 import stat
+import threading
 import time
 
 import cherrypy
-from cherrypy._cpcompat import ntob, unquote
-from cherrypy.lib import cptools, httputil, file_generator_limited
+from cherrypy._cpcompat import BytesIO, ntob, unquote
+from cherrypy.lib import cptools, httputil, file_generator, file_generator_limited
+from cherrypy.lib import set_vary_header
 
 
-def serve_file(path, content_type=None, disposition=None, name=None, debug=False):
+#                        Precompressed static content                        #
+
+compressible_types = ['text/*', 'application/javascript',
+                      'application/x-javascript', 'application/json',
+                      'application/xml', 'image/svg+xml']
+"""The Content-Types which serve_file will gzip itself (when precompressed
+is True but no '.gz' sibling exists). Entries ending in '/*' match any
+subtype."""
+
+
+class GzipCache(object):
+    """A bounded, in-memory store of gzipped static file contents.
+    
+    Entries are keyed by path, and are only reused while the file's mtime
+    and size are unchanged, so a modified file is recompressed on its
+    next request. When full, the least recently used entries are evicted
+    first, as in StatCache.
+    """
+    
+    maxobj_size = 1000000
+    """Files larger than this (uncompressed, in bytes) are not compressed."""
+    
+    maxsize = 10000000
+    """The maximum size of all compressed contents in bytes; defaults to 10 MB."""
+    
+    compress_level = 9
+    """The zlib compression level. The result is reused, so spend the CPU."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+    
+    def clear(self):
+        """Reset the cache to its initial, empty state."""
+        self.lock.acquire()
+        try:
+            # Maps each path to its node in the LRU list. Each node is a
+            # list of [prev, next, path, mtime, size, data], where mtime and
+            # size are those of the uncompressed file. self.lru is the root:
+            # root[1] is the most recently used node, and root[0] the least.
+            self.store = {}
+            self.lru = root = []
+            root[:] = [root, root, None, None, None, None]
+            self.cursize = 0
+        finally:
+            self.lock.release()
+    
+    def _link(self, node):
+        """Make the given node the most recently used. Caller holds self.lock."""
+        root = self.lru
+        first = root[1]
+        node[0] = root
+        node[1] = first
+        first[0] = root[1] = node
+    
+    def _unlink(self, node):
+        """Take the given node out of the LRU list. Caller holds self.lock."""
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+    
+    def _remove(self, node):
+        """Unstore and unlink the given node. Caller holds self.lock."""
+        del self.store[node[2]]
+        self._unlink(node)
+        self.cursize -= len(node[5])
+    
+    def get(self, path, st):
+        """Return the gzipped contents of the given path (or None if too big).
+        
+        The 'st' argument must be the result of os.stat(path).
+        """
+        self.lock.acquire()
+        try:
+            node = self.store.get(path)
+            if (node is not None and node[3] == st.st_mtime and
+                node[4] == st.st_size):
+                self._unlink(node)
+                self._link(node)
+                return node[5]
+        finally:
+            self.lock.release()
+        
+        if st.st_size > self.maxobj_size:
+            return None
+        
+        # Compress outside the lock. Two threads may race to compress
+        # the same file the first time; the last one in wins.
+        from cherrypy.lib.encoding import compress
+        data = ntob('').join(compress(file_generator(open(path, 'rb')),
+                                      self.compress_level))
+        
+        self.lock.acquire()
+        try:
+            old = self.store.get(path)
+            if old is not None:
+                self._remove(old)
+            if len(data) <= self.maxsize:
+                root = self.lru
+                while (root[0] is not root and
+                       self.cursize + len(data) > self.maxsize):
+                    self._remove(root[0])
+                node = [None, None, path, st.st_mtime, st.st_size, data]
+                self.store[path] = node
+                self._link(node)
+                self.cursize += len(data)
+        finally:
+            self.lock.release()
+        return data
+
+gzip_cache = GzipCache()
+
+
+#                           File metadata cache                            #
+
+class MappedFile(object):
+    """A read-only memory map of a whole file, shared between requests.
+    
+    Iterating over it (or over chunks(start, stop)) yields buffer objects
+    which point into the mapping, so ranges are served without any seek()
+    or read() calls, and without copying the file into Python strings.
+    The mapping is released when the last of those views is.
+    """
+    
+    chunk_size = 65536
+    """The size of each view yielded; a partial send copies at most this."""
+    
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+    
+    def __len__(self):
+        return len(self.map)
+    
+    def __iter__(self):
+        return self.chunks()
+    
+    def chunks(self, start=0, stop=None):
+        """Yield views of the mapped bytes from start up to (not incl.) stop."""
+        size = len(self.map)
+        if stop is None or stop > size:
+            stop = size
+        chunk_size = self.chunk_size
+        while start < stop:
+            end = min(start + chunk_size, stop)
+            yield buffer(self.map, start, end - start)
+            start = end
+
+
+class FileInfo(object):
+    """The facts about a file which serve_file needs, computed once."""
+    
+    def __init__(self, path, st, data=None, mapped=None):
+        self.st = st
+        self.last_modified = httputil.HTTPDate(st.st_mtime)
+        self.etag = file_etag(st)
+        self.content_type = _guess_content_type(path)
+        # The contents of the file, if small enough to keep; else None.
+        self.data = data
+        # A MappedFile of larger files, if stat_cache.map_files; else None.
+        self.mapped = mapped
+        # The length of what will be served: of the contents actually read
+        # or mapped, which may differ from st if the file changed since.
+        if data is not None:
+            self.size = len(data)
+        elif mapped is not None:
+            self.size = len(mapped)
+        else:
+            self.size = st.st_size
+
+
+class StatCache(object):
+    """A bounded, in-memory store of file metadata, and small files' contents.
+    
+    serve_file consults it when its cache_files argument is True. An entry
+    (including one recording that a path is missing) is trusted for ttl
+    seconds; after that the file is stat'ed again, and its contents only
+    re-read if its mtime or size changed. Hot files are therefore served
+    without any filesystem calls, at the cost of noticing changes up to
+    ttl seconds late.
+    
+    Files and missing paths are kept in separate least-recently-used
+    lists, each with its own limit, so that requests for many nonexistent
+    paths cannot push hot files out.
+    """
+    
+    maxobjects = 1000
+    """The maximum number of existing paths to remember; defaults to 1000."""
+    
+    maxmissing = 1000
+    """The maximum number of missing paths to remember; defaults to 1000."""
+    
+    maxobj_size = 65536
+    """Files up to this size (in bytes) have their contents kept as well."""
+    
+    maxsize = 10000000
+    """The maximum size of all kept contents in bytes; defaults to 10 MB."""
+    
+    ttl = 5
+    """Seconds to trust an entry before checking the file again."""
+    
+    map_files = False
+    """If True, files too large to keep are memory-mapped instead, and the
+    mapping shared by all requests for them (it does not count against
+    maxsize). Files which are modified in place (rather than replaced by a
+    rename) must not be mapped: reading pages past a truncated end of
+    file kills the process on most platforms."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+    
+    def clear(self):
+        """Reset the cache to its initial, empty state."""
+        self.lock.acquire()
+        try:
+            # Maps each path to its node in an LRU list. Each node is a list
+            # of [prev, next, path, checked, info], where checked is when
+            # the path was last stat'ed and info its FileInfo (or None if
+            # it is missing). Each root's [1] is the most recently used
+            # node, and its [0] the least.
+            self.store = {}
+            self.lru = root = []
+            root[:] = [root, root, None, None, None]
+            self.missing_lru = root = []
+            root[:] = [root, root, None, None, None]
+            self.count = 0
+            self.missing = 0
+            self.cursize = 0
+        finally:
+            self.lock.release()
+    
+    def _link(self, node):
+        """Make the given node the most recently used in its list. Caller
+        holds self.lock."""
+        if node[4] is None:
+            root = self.missing_lru
+        else:
+            root = self.lru
+        first = root[1]
+        node[0] = root
+        node[1] = first
+        first[0] = root[1] = node
+    
+    def _unlink(self, node):
+        """Take the given node out of its LRU list. Caller holds self.lock."""
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+    
+    def _add(self, node):
+        """Store and link the given node. Caller holds self.lock."""
+        self.store[node[2]] = node
+        self._link(node)
+        info = node[4]
+        if info is None:
+            self.missing += 1
+        else:
+            self.count += 1
+            if info.data is not None:
+                self.cursize += len(info.data)
+    
+    def _remove(self, node):
+        """Unstore and unlink the given node. Caller holds self.lock."""
+        del self.store[node[2]]
+        self._unlink(node)
+        info = node[4]
+        if info is None:
+            self.missing -= 1
+        else:
+            self.count -= 1
+            if info.data is not None:
+                self.cursize -= len(info.data)
+    
+    def get(self, path):
+        """Return a FileInfo for the given path, or None if it doesn't exist."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            node = self.store.get(path)
+            if node is not None:
+                if node[3] + self.ttl > now:
+                    self._unlink(node)
+                    self._link(node)
+                    return node[4]
+                info = node[4]
+            else:
+                info = None
+        finally:
+            self.lock.release()
+        
+        try:
+            st = os.stat(path)
+        except OSError:
+            info = None
+        else:
+            if (info is None or info.st.st_mtime != st.st_mtime or
+                info.st.st_size != st.st_size or info.st.st_ino != st.st_ino):
+                data = mapped = None
+                regular = stat.S_ISREG(st.st_mode)
+                if regular and st.st_size <= self.maxobj_size:
+                    try:
+                        f = open(path, 'rb')
+                        try:
+                            data = f.read()
+                        finally:
+                            f.close()
+                    except IOError:
+                        pass
+                elif regular and self.map_files:
+                    try:
+                        mapped = MappedFile(path)
+                    except EnvironmentError:
+                        pass
+                info = FileInfo(path, st, data, mapped)
+        
+        self.lock.acquire()
+        try:
+            old = self.store.get(path)
+            if old is not None:
+                self._remove(old)
+            if info is None:
+                root = self.missing_lru
+                while root[0] is not root and self.missing >= self.maxmissing:
+                    self._remove(root[0])
+                if self.missing < self.maxmissing:
+                    self._add([None, None, path, now, info])
+            else:
+                size = 0
+                if info.data is not None:
+                    size = len(info.data)
+                root = self.lru
+                if size <= self.maxsize:
+                    while root[0] is not root and (
+                            self.count >= self.maxobjects or
+                            self.cursize + size > self.maxsize):
+                        self._remove(root[0])
+                    if self.count < self.maxobjects:
+                        self._add([None, None, path, now, info])
+        finally:
+            self.lock.release()
+        return info
+
+stat_cache = StatCache()
+
+
+def _guess_content_type(path):
+    """Return the Content-Type for the given path's extension, or None."""
+    ext = ""
+    i = path.rfind('.')
+    if i != -1:
+        ext = path[i:].lower()
+    return mimetypes.types_map.get(ext, None)
+
+
+def _accepts_gzip(request):
+    """Return True if the request's Accept-Encoding allows gzip.
+    
+    An explicit 'gzip' (or 'x-gzip') entry takes precedence over '*'.
+    """
+    star = None
+    for coding in request.headers.elements('Accept-Encoding'):
+        if coding.value in ('gzip', 'x-gzip'):
+            return coding.qvalue > 0
+        if coding.value == '*':
+            star = coding
+    return star is not None and star.qvalue > 0
+
+def _is_compressible(content_type):
+    if not content_type:
+        return False
+    ct = content_type.split(';')[0].strip().lower()
+    for pattern in compressible_types:
+        if pattern.endswith('/*'):
+            if ct.startswith(pattern[:-1]):
+                return True
+        elif ct == pattern:
+            return True
+    return False
+
+def _gzip_variant(path, st, content_type, debug=False, cache_files=False):
+    """Return (fileobj, content_length) for a gzipped variant, or None.
+    
+    If cache_files is True, the '.gz' sibling (or its absence) is looked up
+    in stat_cache, like the file itself.
+    """
+    gzpath = path + '.gz'
+    gzinfo = None
+    if cache_files:
+        gzinfo = stat_cache.get(gzpath)
+        gzst = gzinfo and gzinfo.st
+    else:
+        try:
+            gzst = os.stat(gzpath)
+        except OSError:
+            gzst = None
+    if gzst is not None:
+        if stat.S_ISREG(gzst.st_mode) and gzst.st_mtime >= st.st_mtime:
+            if debug:
+                cherrypy.log('Serving precompressed %r' % gzpath, 'TOOLS.STATIC')
+            if gzinfo is not None and gzinfo.data is not None:
+                return BytesIO(gzinfo.data), gzinfo.size
+            return open(gzpath, 'rb'), gzst.st_size
+        if debug:
+            cherrypy.log('Ignoring stale %r' % gzpath, 'TOOLS.STATIC')
+    
+    if _is_compressible(content_type):
+        data = gzip_cache.get(path, st)
+        if data is not None:
+            if debug:
+                cherrypy.log('Serving cached gzip of %r' % path, 'TOOLS.STATIC')
+            return BytesIO(data), len(data)
+    return None
+
+
+def file_etag(st, suffix=''):
+    """Return a strong ETag for a file, from its os.stat result.
+    
+    The tag is made from the inode, size and modification time, so that
+    no content needs to be read. A suffix distinguishes other
+    representations of the same file (such as a gzipped one).
+    """
+    return '"%x-%x-%x%s"' % (st.st_ino, st.st_size,
+                             int(st.st_mtime * 1000), suffix)
+
+
+def serve_file(path, content_type=None, disposition=None, name=None, debug=False,
+               precompressed=False, cache_files=False):
     """Set status, headers, and body in order to serve the given path.
     
     The Content-Type header will be set to the content_type arg, if provided.
@@ -27,6 +460,19 @@ def serve_file(path, content_type=None, disposition=None, name=None, debug=False
     to "<disposition>; filename=<name>". If name is None, it will be set
     to the basename of path. If disposition is None, no Content-Disposition
     header will be written.
+    
+    If precompressed is True and the client accepts gzip, a gzipped variant
+    is served instead (with 'Content-Encoding: gzip'). A sibling file named
+    path + '.gz' is used if it exists and is no older than path; otherwise,
+    if the Content-Type is in compressible_types, the file is compressed
+    once and the result kept in gzip_cache. Content-Length and any Range
+    apply to the compressed representation.
+    
+    If cache_files is True, the file's metadata (and, for small files, its
+    contents) are taken from stat_cache, as are those of any '.gz' sibling;
+    they may be up to stat_cache.ttl seconds out of date. If
+    stat_cache.map_files is also True, larger files are served from a
+    memory mapping shared by all requests for them.
     """
     
     response = cherrypy.serving.response
@@ -42,12 +488,21 @@ def serve_file(path, content_type=None, disposition=None, name=None, debug=False
             cherrypy.log(msg, 'TOOLS.STATICFILE')
         raise ValueError(msg)
     
-    try:
-        st = os.stat(path)
-    except OSError:
-        if debug:
-            cherrypy.log('os.stat(%r) failed' % path, 'TOOLS.STATIC')
-        raise cherrypy.NotFound()
+    info = None
+    if cache_files:
+        info = stat_cache.get(path)
+        if info is None:
+            if debug:
+                cherrypy.log('%r not found (cached)' % path, 'TOOLS.STATIC')
+            raise cherrypy.NotFound()
+        st = info.st
+    else:
+        try:
+            st = os.stat(path)
+        except OSError:
+            if debug:
+                cherrypy.log('os.stat(%r) failed' % path, 'TOOLS.STATIC')
+            raise cherrypy.NotFound()
     
     # Check if path is a directory.
     if stat.S_ISDIR(st.st_mode):
@@ -56,18 +511,39 @@ def serve_file(path, content_type=None, disposition=None, name=None, debug=False
             cherrypy.log('%r is a directory' % path, 'TOOLS.STATIC')
         raise cherrypy.NotFound()
     
-    # Set the Last-Modified response header, so that
-    # modified-since validation code can work.
-    response.headers['Last-Modified'] = httputil.HTTPDate(st.st_mtime)
-    cptools.validate_since()
-    
     if content_type is None:
         # Set content-type based on filename extension
-        ext = ""
-        i = path.rfind('.')
-        if i != -1:
-            ext = path[i:].lower()
-        content_type = mimetypes.types_map.get(ext, None)
+        if info is not None:
+            content_type = info.content_type
+        else:
+            content_type = _guess_content_type(path)
+    
+    # Choose the gzipped variant (if any) first, so that its ETag is only
+    # used when it is actually served.
+    variant = None
+    if precompressed and _accepts_gzip(cherrypy.serving.request):
+        variant = _gzip_variant(path, st, content_type, debug=debug,
+                                cache_files=cache_files)
+    
+    # Set the Last-Modified and ETag response headers, so that
+    # conditional requests can be answered without reading the file.
+    if info is not None:
+        response.headers['Last-Modified'] = info.last_modified
+        if variant is not None:
+            response.headers['ETag'] = file_etag(st, '-gzip')
+        else:
+            response.headers['ETag'] = info.etag
+    else:
+        response.headers['Last-Modified'] = httputil.HTTPDate(st.st_mtime)
+        response.headers['ETag'] = file_etag(st, variant and '-gzip' or '')
+    try:
+        cptools.validate_since()
+        cptools.validate_etags()
+    except:
+        if variant is not None:
+            variant[0].close()
+        raise
+    
     if content_type is not None:
         response.headers['Content-Type'] = content_type
     if debug:
@@ -82,10 +558,28 @@ def serve_file(path, content_type=None, disposition=None, name=None, debug=False
     if debug:
         cherrypy.log('Content-Disposition: %r' % cd, 'TOOLS.STATIC')
     
+    if precompressed:
+        # The representation depends on Accept-Encoding whether or not
+        # we end up compressing this particular response.
+        set_vary_header(response, 'Accept-Encoding')
+        if variant is not None:
+            fileobj, content_length = variant
+            response.headers['Content-Encoding'] = 'gzip'
+            return _serve_fileobj(fileobj, content_type, content_length,
+                                  debug=debug)
+    
     # Set Content-Length and use an iterable (file object)
     #   this way CP won't load the whole file in memory
     content_length = st.st_size
-    fileobj = open(path, 'rb')
+    if info is not None and info.data is not None:
+        content_length = info.size
+        fileobj = BytesIO(info.data)
+    elif info is not None and info.mapped is not None:
+        mapped = info.mapped
+        return _serve_ranges(mapped, mapped.chunks, content_type, len(mapped),
+                             debug=debug)
+    else:
+        fileobj = open(path, 'rb')
     return _serve_fileobj(fileobj, content_type, content_length, debug=debug)
 
 def serve_fileobj(fileobj, content_type=None, disposition=None, name=None,
@@ -116,10 +610,12 @@ def serve_fileobj(fileobj, content_type=None, disposition=None, name=None,
             cherrypy.log('os has no fstat attribute', 'TOOLS.STATIC')
         content_length = None
     else:
-        # Set the Last-Modified response header, so that
-        # modified-since validation code can work.
+        # Set the Last-Modified and ETag response headers, so that
+        # conditional requests can be answered without reading the file.
         response.headers['Last-Modified'] = httputil.HTTPDate(st.st_mtime)
+        response.headers['ETag'] = file_etag(st)
         cptools.validate_since()
+        cptools.validate_etags()
         content_length = st.st_size
     
     if content_type is not None:
@@ -141,6 +637,19 @@ def serve_fileobj(fileobj, content_type=None, disposition=None, name=None,
 
 def _serve_fileobj(fileobj, content_type, content_length, debug=False):
     """Internal. Set response.body to the given file object, perhaps ranged."""
+    def part(start, stop):
+        fileobj.seek(start)
+        return file_generator_limited(fileobj, stop - start)
+    return _serve_ranges(fileobj, part, content_type, content_length,
+                         debug=debug)
+
+def _serve_ranges(body, part, content_type, content_length, debug=False):
+    """Internal. Set response.body to body, or to the requested range(s) of it.
+    
+    The 'part' argument must be a callable which, given (start, stop),
+    returns an iterable of the bytes in that range. For multipart
+    responses it is only called as each part is reached.
+    """
     response = cherrypy.serving.response
     
     # HTTP/1.0 didn't have Range/Accept-Ranges headers, or the 206 code
@@ -156,11 +665,10 @@ def _serve_fileobj(fileobj, content_type, content_length, debug=False):
             raise cherrypy.HTTPError(416, message)
         
         if r:
+            r = [(start, min(stop, content_length)) for start, stop in r]
             if len(r) == 1:
                 # Return a single-part response.
                 start, stop = r[0]
-                if stop > content_length:
-                    stop = content_length
                 r_len = stop - start
                 if debug:
                     cherrypy.log('Single part; start: %r, stop: %r' % (start, stop),
@@ -169,8 +677,7 @@ def _serve_fileobj(fileobj, content_type, content_length, debug=False):
                 response.headers['Content-Range'] = (
                     "bytes %s-%s/%s" % (start, stop - 1, content_length))
                 response.headers['Content-Length'] = r_len
-                fileobj.seek(start)
-                response.body = file_generator_limited(fileobj, r_len)
+                response.body = part(start, stop)
             else:
                 # Return a multipart/byteranges response.
                 response.status = "206 Partial Content"
@@ -178,31 +685,36 @@ def _serve_fileobj(fileobj, content_type, content_length, debug=False):
                 boundary = choose_boundary()
                 ct = "multipart/byteranges; boundary=%s" % boundary
                 response.headers['Content-Type'] = ct
-                if "Content-Length" in response.headers:
-                    # Delete Content-Length header so finalize() recalcs it.
-                    del response.headers["Content-Length"]
+                
+                # Build the part headers up front, so that Content-Length
+                # can be set without finalize() collapsing the body.
+                heads = []
+                for start, stop in r:
+                    heads.append(ntob("--%s\r\nContent-type: %s\r\n"
+                                      "Content-range: bytes %s-%s/%s\r\n\r\n"
+                                      % (boundary, content_type, start,
+                                         stop - 1, content_length), 'ascii'))
+                # Apache compatibility: a leading CRLF.
+                tail = ntob("--" + boundary + "--\r\n", 'ascii')
+                length = 2 + len(tail)
+                for head, (start, stop) in zip(heads, r):
+                    length += len(head) + (stop - start) + 2
+                response.headers['Content-Length'] = length
                 
                 def file_ranges():
                     # Apache compatibility:
                     yield ntob("\r\n")
                     
-                    for start, stop in r:
+                    for head, (start, stop) in zip(heads, r):
                         if debug:
                             cherrypy.log('Multipart; start: %r, stop: %r' % (start, stop),
                                          'TOOLS.STATIC')
-                        yield ntob("--" + boundary, 'ascii')
-                        yield ntob("\r\nContent-type: %s" % content_type, 'ascii')
-                        yield ntob("\r\nContent-range: bytes %s-%s/%s\r\n\r\n"
-                                   % (start, stop - 1, content_length), 'ascii')
-                        fileobj.seek(start)
-                        for chunk in file_generator_limited(fileobj, stop-start):
+                        yield head
+                        for chunk in part(start, stop):
                             yield chunk
                         yield ntob("\r\n")
-                    # Final boundary
-                    yield ntob("--" + boundary + "--", 'ascii')
-                    
-                    # Apache compatibility:
-                    yield ntob("\r\n")
+                    # Final boundary (and a trailing CRLF, for Apache compatibility)
+                    yield tail
                 response.body = file_ranges()
             return response.body
         else:
@@ -212,7 +724,7 @@ def _serve_fileobj(fileobj, content_type, content_length, debug=False):
     # Set Content-Length and use an iterable (file object)
     #   this way CP won't load the whole file in memory
     response.headers['Content-Length'] = content_length
-    response.body = fileobj
+    response.body = body
     return response.body
 
 def serve_download(path, name=None):
@@ -221,7 +733,8 @@ def serve_download(path, name=None):
     return serve_file(path, "application/x-download", "attachment", name)
 
 
-def _attempt(filename, content_types, debug=False):
+def _attempt(filename, content_types, debug=False, precompressed=False,
+             cache_files=False):
     if debug:
         cherrypy.log('Attempting %r (content_types %r)' %
                      (filename, content_types), 'TOOLS.STATICDIR')
@@ -232,7 +745,8 @@ def _attempt(filename, content_types, debug=False):
         if content_types:
             r, ext = os.path.splitext(filename)
             content_type = content_types.get(ext[1:], None)
-        serve_file(filename, content_type=content_type, debug=debug)
+        serve_file(filename, content_type=content_type, debug=debug,
+                   precompressed=precompressed, cache_files=cache_files)
         return True
     except cherrypy.NotFound:
         # If we didn't find the static file, continue handling the
@@ -242,7 +756,7 @@ def _attempt(filename, content_types, debug=False):
         return False
 
 def staticdir(section, dir, root="", match="", content_types=None, index="",
-              debug=False):
+              debug=False, precompressed=False, cache_files=False):
     """Serve a static resource from the given (root +) dir.
     
     match
@@ -260,6 +774,14 @@ def staticdir(section, dir, root="", match="", content_types=None, index="",
         serve for directory requests. For example, if the dir argument is
         '/home/me', the Request-URI is 'myapp', and the index arg is
         'index.html', the file '/home/me/myapp/index.html' will be sought.
+    
+    precompressed
+        If True, serve gzipped variants of files to clients which accept
+        them. See :func:`serve_file` for details.
+    
+    cache_files
+        If True, take file metadata (and small files) from stat_cache
+        rather than the filesystem. See :func:`serve_file` for details.
     """
     request = cherrypy.serving.request
     if request.method not in ('GET', 'HEAD'):
@@ -305,16 +827,20 @@ def staticdir(section, dir, root="", match="", content_types=None, index="",
     if not os.path.normpath(filename).startswith(os.path.normpath(dir)):
         raise cherrypy.HTTPError(403) # Forbidden
     
-    handled = _attempt(filename, content_types)
+    handled = _attempt(filename, content_types, precompressed=precompressed,
+                       cache_files=cache_files)
     if not handled:
         # Check for an index file if a folder was requested.
         if index:
-            handled = _attempt(os.path.join(filename, index), content_types)
+            handled = _attempt(os.path.join(filename, index), content_types,
+                               precompressed=precompressed,
+                               cache_files=cache_files)
             if handled:
                 request.is_index = filename[-1] in (r"\/")
     return handled
 
-def staticfile(filename, root=None, match="", content_types=None, debug=False):
+def staticfile(filename, root=None, match="", content_types=None, debug=False,
+               precompressed=False, cache_files=False):
     """Serve a static resource from the given (root +) filename.
     
     match
@@ -327,6 +853,13 @@ def staticfile(filename, root=None, match="", content_types=None, debug=False):
         a string (e.g. "gif") and 'content-type' is the value to write
         out in the Content-Type response header (e.g. "image/gif").
     
+    precompressed
+        If True, serve gzipped variants of files to clients which accept
+        them. See :func:`serve_file` for details.
+    
+    cache_files
+        If True, take file metadata (and small files) from stat_cache
+        rather than the filesystem. See :func:`serve_file` for details.
     """
     request = cherrypy.serving.request
     if request.method not in ('GET', 'HEAD'):
@@ -349,4 +882,5 @@ def staticfile(filename, root=None, match="", content_types=None, debug=False):
             raise ValueError(msg)
         filename = os.path.join(root, filename)
     
-    return _attempt(filename, content_types, debug=debug)
+    return _attempt(filename, content_types, debug=debug,
+                    precompressed=precompressed, cache_files=cache_files)
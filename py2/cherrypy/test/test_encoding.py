@@ -76,6 +76,11 @@ class EncodingTests(helper.CPWebCase):
                 yield "Here be dragons"
             noshow_stream.exposed = True
             noshow_stream._cp_config = {'response.stream': True}
+            
+            def adaptive(self, size):
+                return "x" * int(size)
+            adaptive.exposed = True
+            adaptive._cp_config = {'tools.gzip.adaptive': True}
         
         class Decode:
             def extra_charset(self, *args, **kwargs):
@@ -96,10 +101,33 @@ class EncodingTests(helper.CPWebCase):
                 'tools.decode.encoding': 'utf-16',
                 }
         
+        class Decompress:
+            def reqparams(self, *args, **kwargs):
+                return ', '.join([": ".join((k, v)) for k, v
+                                  in sorted(cherrypy.request.params.items())])
+            reqparams.exposed = True
+            
+            def raw(self):
+                return cherrypy.request.body.read()
+            raw.exposed = True
+            
+            def upload(self, myfile):
+                return myfile.file.read()
+            upload.exposed = True
+            
+            def tiny(self, *args, **kwargs):
+                return 'Got %d bytes' % len(cherrypy.request.params['q'])
+            tiny.exposed = True
+            tiny._cp_config = {'request.body.maxbytes': 1000}
+        
         root = Root()
         root.gzip = GZIP()
         root.decode = Decode()
-        cherrypy.tree.mount(root, config={'/gzip': {'tools.gzip.on': True}})
+        root.decompress = Decompress()
+        cherrypy.tree.mount(root, config={
+            '/gzip': {'tools.gzip.on': True},
+            '/decompress': {'request.body.decompress': True},
+            })
     setup_server = staticmethod(setup_server)
 
     def test_query_string_decoding(self):
@@ -357,6 +385,141 @@ class EncodingTests(helper.CPWebCase):
                               '/gzip/noshow_stream',
                               headers=[("Accept-Encoding", "gzip")])
 
+    def test_adaptive_gzip(self):
+        from cherrypy.lib import encoding
+        
+        # Statistics are only collected once turned on.
+        self.assertEqual(encoding.gzipstats['Enabled'], False)
+        encoding.gzipstats['Enabled'] = True
+        try:
+            # Bodies smaller than an MTU aren't worth compressing.
+            skipped = encoding.gzipstats['Skipped (Small Body)']
+            self.getPage('/gzip/adaptive?size=100',
+                         headers=[("Accept-Encoding", "gzip")])
+            self.assertStatus(200)
+            self.assertHeader("Vary", "Accept-Encoding")
+            self.assertNoHeader("Content-Encoding")
+            self.assertBody("x" * 100)
+            self.assertEqual(encoding.gzipstats['Skipped (Small Body)'],
+                             skipped + 1)
+            
+            stats = encoding.gzipstats
+            responses = stats['Responses'](stats)
+            self.getPage('/gzip/adaptive?size=10000',
+                         headers=[("Accept-Encoding", "gzip")])
+            self.assertStatus(200)
+            self.assertHeader("Content-Encoding", "gzip")
+            self.assertEqual(encoding.decompress(self.body),
+                             ntob("x" * 10000))
+            self.assertEqual(stats['Responses'](stats), responses + 1)
+        finally:
+            encoding.gzipstats['Enabled'] = False
+        
+        level = encoding.adaptive_compress_level
+        self.assertEqual(level(9, 100, 'text/html', 0.0), 0)
+        self.assertEqual(level(9, 10000, 'text/html', None), 9)
+        self.assertEqual(level(9, 10000, 'text/html', 0.0), 9)
+        self.assertEqual(level(9, 10000, 'text/html', 0.5), 5)
+        self.assertEqual(level(9, 10000, 'text/html', 1.0), 1)
+        self.assertEqual(level(9, None, 'application/json', 0.0), 9)
+        self.assertEqual(level(9, 10000000, 'text/html', 0.0), 6)
+        self.assertEqual(level(9, 10000, 'application/octet-stream', 0.0), 3)
+        
+        # The load is the busy fraction of all threads, however many the
+        # pool has grown to.
+        httpserver = cherrypy.server.httpserver
+        pool = httpserver.requests
+        class GrownPool(object):
+            min, threads, idle, qsize = 10, 20, 10, 0
+        httpserver.requests = GrownPool()
+        try:
+            self.assertEqual(encoding.worker_load(), 0.5)
+        finally:
+            httpserver.requests = pool
+    
+    def test_gzip_request_body(self):
+        from cherrypy.lib import encoding
+        def gz(data):
+            return ntob('').join(encoding.compress([ntob(data)], 9))
+        
+        body = gz("q=\xc2\xa3&r=2")
+        self.getPage('/decompress/reqparams', method='POST',
+                     headers=[("Content-Type", "application/x-www-form-urlencoded"),
+                              ("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(body)))],
+                     body=body)
+        self.assertStatus(200)
+        self.assertBody(ntob("q: \xc2\xa3, r: 2"))
+        
+        body = gz('\r\n'.join(['--X',
+                                'Content-Disposition: form-data; name="myfile"; '
+                                'filename="hello.txt"',
+                                'Content-Type: text/plain',
+                                '',
+                                'Hello, ' * 10000,
+                                '--X--']))
+        self.getPage('/decompress/upload', method='POST',
+                     headers=[("Content-Type", "multipart/form-data;boundary=X"),
+                              ("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(body)))],
+                     body=body)
+        self.assertStatus(200)
+        self.assertBody('Hello, ' * 10000)
+        
+        # Unprocessed bodies are inflated, too.
+        body = gz("x" * 100000)
+        self.getPage('/decompress/raw', method='POST',
+                     headers=[("Content-Type", "application/octet-stream"),
+                              ("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(body)))],
+                     body=body)
+        self.assertStatus(200)
+        self.assertBody("x" * 100000)
+        
+        # The limit applies to the decompressed size.
+        body = gz("q=" + "x" * 100000)
+        self.assertEqual(len(body) < 1000, True)
+        self.getPage('/decompress/tiny', method='POST',
+                     headers=[("Content-Type", "application/x-www-form-urlencoded"),
+                              ("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(body)))],
+                     body=body)
+        self.assertStatus(413)
+        body = gz("q=" + "x" * 100)
+        self.getPage('/decompress/tiny', method='POST',
+                     headers=[("Content-Type", "application/x-www-form-urlencoded"),
+                              ("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(body)))],
+                     body=body)
+        self.assertBody('Got 100 bytes')
+        
+        body = ntob("this is not gzipped")
+        self.getPage('/decompress/reqparams', method='POST',
+                     headers=[("Content-Type", "application/x-www-form-urlencoded"),
+                              ("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(body)))],
+                     body=body)
+        self.assertStatus(400)
+        
+        # A body cut off before the gzip trailer is rejected, not shortened.
+        body = gz("x" * 1000)[:-4]
+        self.getPage('/decompress/raw', method='POST',
+                     headers=[("Content-Type", "application/octet-stream"),
+                              ("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(body)))],
+                     body=body)
+        self.assertStatus(400)
+        
+        # Concatenated gzip members are all inflated.
+        body = gz("x" * 1000) + gz("y" * 1000)
+        self.getPage('/decompress/raw', method='POST',
+                     headers=[("Content-Type", "application/octet-stream"),
+                              ("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(body)))],
+                     body=body)
+        self.assertStatus(200)
+        self.assertBody("x" * 1000 + "y" * 1000)
+    
     def test_UnicodeHeaders(self):
         self.getPage('/cookies_and_headers')
         self.assertBody('Any content')
@@ -1,11 +1,14 @@
+import datetime
+import logging
 import os
+import shutil
 localDir = os.path.dirname(__file__)
 import sys
 import threading
 import time
 
 import cherrypy
-from cherrypy._cpcompat import copykeys, HTTPConnection, HTTPSConnection
+from cherrypy._cpcompat import copykeys, HTTPConnection, HTTPSConnection, ntob
 from cherrypy.lib import sessions
 from cherrypy.lib.httputil import response_codes
 
@@ -108,6 +111,40 @@ def setup_server():
             return str(len(cherrypy.session))
         length.exposed = True
         
+        def listappend(self, item, mark=False):
+            items = cherrypy.session.setdefault('items', [])
+            items.append(item)
+            if mark:
+                cherrypy.session.mark_dirty()
+            return ",".join(items)
+        listappend.exposed = True
+        listappend._cp_config = {'tools.sessions.timeout': 60}
+        
+        def slowread(self):
+            time.sleep(0.5)
+            return str(cherrypy.session.get('counter'))
+        slowread.exposed = True
+        slowread._cp_config = {'tools.sessions.locking': 'shared'}
+        
+        def streamconflict(self):
+            sess = cherrypy.session
+            sess['counter'] = sess.get('counter', 0) + 1
+            def body():
+                # Another request saves the session while this one streams.
+                other = sessions.RamSession(sess.id)
+                other['counter'] = 100
+                other.save()
+                yield "streamed"
+            return body()
+        streamconflict.exposed = True
+        streamconflict._cp_config = {'response.stream': True,
+                                     'tools.sessions.locking': 'optimistic'}
+        
+        def unused(self):
+            return "unused"
+        unused.exposed = True
+        unused._cp_config = {'tools.sessions.locking': 'explicit'}
+        
         def session_cookie(self):
             # Must load() to start the clean thread.
             cherrypy.session.load()
@@ -262,6 +299,100 @@ class SessionTest(helper.CPWebCase):
             print(e)
         self.assertEqual(hitcount, expected)
     
+    def test_1_shared_locking(self):
+        self.getPage('/setsessiontype/ram')
+        self.getPage('/testStr')
+        cookies = self.cookies
+        
+        results = []
+        def request():
+            if self.scheme == 'https':
+                c = HTTPSConnection('%s:%s' % (self.interface(), self.PORT))
+            else:
+                c = HTTPConnection('%s:%s' % (self.interface(), self.PORT))
+            c.putrequest('GET', '/slowread')
+            for k, v in cookies:
+                c.putheader(k, v)
+            c.endheaders()
+            response = c.getresponse()
+            results.append((response.status, response.read()))
+        
+        # Readers holding a shared lock don't wait for each other.
+        start = time.time()
+        ts = [threading.Thread(target=request) for i in range(4)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertEqual(results, [(200, ntob('1'))] * 4)
+        self.assert_(time.time() - start < 1.5)
+    
+    def test_1_optimistic_locking(self):
+        class OptimisticSession(sessions.RamSession):
+            cache = sessions.RamStore()
+            locking = 'optimistic'
+            clean_freq = 0
+        
+        first = OptimisticSession()
+        first['counter'] = 1
+        first.save()
+        a = OptimisticSession(first.id)
+        b = OptimisticSession(first.id)
+        a['counter'] = a['counter'] + 1
+        b['counter'] = b['counter'] + 1
+        a.save()
+        self.assertEqual(OptimisticSession.cache[first.id][0], {'counter': 2})
+        try:
+            b.save()
+        except cherrypy.HTTPError:
+            self.assertEqual(sys.exc_info()[1].status, 409)
+        else:
+            self.fail("The conflicting save was not refused.")
+        self.assertEqual(OptimisticSession.cache[first.id][0], {'counter': 2})
+        self.assertEqual(b.locked, False)
+        
+        # Implicit-mode sessions save the stored dict itself; that is a
+        # change, too.
+        class ImplicitSession(OptimisticSession):
+            locking = 'implicit'
+        c = ImplicitSession(first.id)
+        d = OptimisticSession(first.id)
+        c['counter'] = c['counter'] + 1
+        d['counter'] = d['counter'] + 1
+        c.save()
+        self.assertRaises(cherrypy.HTTPError, d.save)
+        self.assertEqual(OptimisticSession.cache[first.id][0], {'counter': 3})
+    
+    def test_1_optimistic_locking_streamed(self):
+        # A streamed response is sent before its session is saved, so a
+        # conflict can't become a 409; it must be logged instead.
+        records = []
+        class Collector(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        collector = Collector()
+        cherrypy.log.error_log.addHandler(collector)
+        try:
+            self.getPage('/testStr')
+            self.assertBody('1')
+            self.getPage('/streamconflict', self.cookies)
+            self.assertStatus(200)
+            self.assertBody('streamed')
+            # The response is finished, but on_end_request may still be
+            # running; wait for its log record.
+            for trial in range(50):
+                if records:
+                    break
+                time.sleep(0.1)
+        finally:
+            cherrypy.log.error_log.removeHandler(collector)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].levelno, logging.WARNING)
+        self.assert_("changes were not saved" in records[0].getMessage())
+        # The other request's data was kept.
+        self.getPage('/testStr', self.cookies)
+        self.assertBody('101')
+    
     def test_3_Redirect(self):
         # Start a new session
         self.getPage('/testStr')
@@ -347,118 +478,522 @@ class SessionTest(helper.CPWebCase):
                 self.fail("The second session did not time out.")
             else:
                 self.fail("Unknown session id in cache: %r", cache)
-
-
-import socket
-try:
-    import memcache
-    
-    host, port = '127.0.0.1', 11211
-    for res in socket.getaddrinfo(host, port, socket.AF_UNSPEC,
-                                  socket.SOCK_STREAM):
-        af, socktype, proto, canonname, sa = res
-        s = None
+    
+    def test_8_ram_store(self):
+        store = sessions.RamStore(shards=4, bucket_size=60)
+        now = datetime.datetime.now()
+        for i in range(20):
+            store['old%d' % i] = ({}, now - datetime.timedelta(seconds=i))
+            store['new%d' % i] = ({}, now + datetime.timedelta(seconds=i + 1))
+        self.assertEqual(len(store), 40)
+        
+        # Moving a session to a later bucket takes it out of the old one.
+        store['old0'] = ({'a': 1}, now + datetime.timedelta(hours=1))
+        store.expire(now)
+        self.assertEqual(sorted(store.keys()),
+                         sorted(['old0'] + ['new%d' % i for i in range(20)]))
+        self.assertEqual(store.get('old0')[0], {'a': 1})
+        self.assertEqual(sum([len(s.bucket_of) for s in store._shards]), 21)
+        
+        # Locks are discarded once released.
+        store.acquire_lock('new1')
+        store.acquire_lock('new1')
+        store.release_lock('new1')
+        self.assertEqual(sum([len(s.locks) for s in store._shards]), 1)
+        store.release_lock('new1')
+        self.assertEqual(sum([len(s.locks) for s in store._shards]), 0)
+    
+    def test_9_dirty_tracking(self):
+        self.getPage('/setsessiontype/file')
+        self.getPage('/listappend?item=a')
+        self.assertBody('a')
+        path = os.path.join(localDir, "session-" +
+                            self.cookies[0][1].split(";", 1)[0].split("=", 1)[1])
+        mtime = os.stat(path).st_mtime
+        
+        # Changes inside a mutable value aren't saved...
+        time.sleep(1.1)
+        self.getPage('/listappend?item=b', self.cookies)
+        self.assertBody('a,b')
+        self.assertEqual(os.stat(path).st_mtime, mtime)
+        # ...unless the session is marked dirty.
+        self.getPage('/listappend?item=c&mark=1', self.cookies)
+        self.assertBody('a,c')
+        self.assertNotEqual(os.stat(path).st_mtime, mtime)
+        self.getPage('/listappend?item=d', self.cookies)
+        self.assertBody('a,c,d')
+    
+    def test_9_single_lookup(self):
+        calls = []
+        class CountingSession(sessions.RamSession):
+            cache = sessions.RamStore()
+            def _exists(self):
+                calls.append('exists')
+                return sessions.RamSession._exists(self)
+            def _load(self):
+                calls.append('load')
+                return sessions.RamSession._load(self)
+        
+        expiry = datetime.datetime.now() + datetime.timedelta(minutes=5)
+        CountingSession.cache['known'] = ({'a': 1}, expiry)
+        sess = CountingSession('known', clean_freq=0)
+        self.assertEqual(sess.get('a'), 1)
+        self.assertEqual(sess.id, 'known')
+        self.assertEqual(calls, ['load'])
+        
+        # Unknown ids are replaced when the (missing) data is loaded.
+        sess = CountingSession('unknown', clean_freq=0)
+        self.assertEqual(sess.get('a'), None)
+        self.assertNotEqual(sess.id, 'unknown')
+        self.assert_(sess.missing)
+        
+        # Unknown ids are replaced before they are locked, too.
+        storage_path = os.path.join(localDir, 'verifiedsessions')
         try:
-            s = socket.socket(af, socktype, proto)
-            # See http://groups.google.com/group/cherrypy-users/
-            #        browse_frm/thread/bbfe5eb39c904fe0
-            s.settimeout(1.0)
-            s.connect((host, port))
-            s.close()
-        except socket.error:
-            if s:
-                s.close()
-            raise
-        break
-except (ImportError, socket.error):
-    class MemcachedSessionTest(helper.CPWebCase):
-        setup_server = staticmethod(setup_server)
-        
-        def test(self):
-            return self.skip("memcached not reachable ")
-else:
-    class MemcachedSessionTest(helper.CPWebCase):
-        setup_server = staticmethod(setup_server)
-        
-        def test_0_Session(self):
-            self.getPage('/setsessiontype/memcached')
-            
-            self.getPage('/testStr')
-            self.assertBody('1')
-            self.getPage('/testGen', self.cookies)
-            self.assertBody('2')
-            self.getPage('/testStr', self.cookies)
-            self.assertBody('3')
-            self.getPage('/length', self.cookies)
-            self.assertErrorPage(500)
-            self.assertInBody("NotImplementedError")
-            self.getPage('/delkey?key=counter', self.cookies)
-            self.assertStatus(200)
+            sess = sessions.FileSession('unknown', storage_path=storage_path,
+                                        shard_levels=1, clean_freq=0)
+            sess.acquire_lock()
+            self.assertNotEqual(sess.id, 'unknown')
+            self.assert_(sess.missing)
+            shard = os.path.dirname(sess._get_file_path())
+            sess.release_lock()
+            # Only the new id's shard directory was made.
+            self.assertEqual(os.listdir(storage_path),
+                             [os.path.basename(shard)])
+        finally:
+            shutil.rmtree(storage_path)
+        
+        # The client's id isn't echoed in the cookie unless it is known.
+        self.getPage('/unused', [('Cookie', 'session_id=unknown')])
+        self.assertBody('unused')
+        self.assertEqual([v for k, v in self.headers
+                          if k.lower() == 'set-cookie'], [])
+        self.getPage('/keyin?key=a', [('Cookie', 'session_id=unknown')])
+        self.assertEqual(len(self.cookies), 1)
+        self.assert_('unknown' not in self.cookies[0][1])
+    
+    def test_9_file_shards(self):
+        storage_path = os.path.join(localDir, 'shardedsessions')
+        def make(timeout):
+            sess = sessions.FileSession(storage_path=storage_path,
+                                        shard_levels=2, timeout=timeout,
+                                        clean_freq=0)
+            sess.acquire_lock()
+            sess['a'] = 1
+            sess.save()
+            return sess
+        try:
+            live = make(60)
+            path = live._get_file_path()
+            self.assertEqual(len(path[len(storage_path):].split(os.sep)), 4)
+            # The file's mtime is its expiration time.
+            self.assert_(os.stat(path).st_mtime > time.time() + 3000)
             
-            # Wait for the session.timeout (1 second)
-            time.sleep(1.25)
-            self.getPage('/')
-            self.assertBody('1')
+            dead = make(0.001)
+            self.assertEqual(len(live), 2)
+            time.sleep(0.1)
+            live.clean_up()
+            self.assertEqual(len(live), 1)
+            self.assertEqual(os.path.exists(dead._get_file_path()), False)
+            self.assertEqual(os.path.exists(dead._get_file_path() +
+                                            live.LOCK_SUFFIX), False)
             
-            # Test session __contains__
-            self.getPage('/keyin?key=counter', self.cookies)
-            self.assertBody("True")
+            # Unchanged sessions are touched, not rewritten.
+            sess = sessions.FileSession(live.id, storage_path=storage_path,
+                                        shard_levels=2, timeout=120,
+                                        clean_freq=0)
+            self.assertEqual(sess['a'], 1)
+            contents = open(path, 'rb').read()
+            sess.save()
+            self.assertEqual(open(path, 'rb').read(), contents)
+            self.assert_(os.stat(path).st_mtime > time.time() + 6000)
+        finally:
+            shutil.rmtree(storage_path)
+    
+    def test_9_sqlite(self):
+        # The database file must be known.
+        class NowhereSession(sessions.SqliteSession):
+            pass
+        self.assertRaises(ValueError, NowhereSession.setup)
+        
+        storage_path = os.path.join(localDir, 'sqlitesessions')
+        os.mkdir(storage_path)
+        class TestSession(sessions.SqliteSession):
+            clean_freq = 0
+            clean_up_batch = 2
+            pool_size = 2
+        TestSession.setup(storage_path=storage_path)
+        try:
+            sess = TestSession()
+            sess['a'] = 1
+            sess.save()
+            sess = TestSession(sess.id)
+            self.assertEqual(sess['a'], 1)
+            self.assertEqual(sess.missing, False)
             
-            # Test session delete
-            self.getPage('/delete', self.cookies)
-            self.assertBody("done")
-        
-        def test_1_Concurrency(self):
-            client_thread_count = 5
-            request_count = 30
+            for i in range(5):
+                dead = TestSession(timeout=0.001)
+                dead['b'] = 2
+                dead.save()
+            self.assertEqual(TestSession.pool.size, 1)
+            time.sleep(0.1)
+            self.assertEqual(len(sess), 1)
+            sess.clean_up()
+            count = TestSession._execute('select count(*) from session',
+                                         fetch=True)[0][0]
+            self.assertEqual(count, 1)
             
-            # Get initial cookie
-            self.getPage("/")
-            self.assertBody("1")
-            cookies = self.cookies
+            # Changed data is refused if someone else saved first.
+            sess.locking = 'optimistic'
+            sess['a'] = 2
+            other = TestSession(sess.id)
+            other['a'] = 3
+            other.save()
+            self.assertRaises(cherrypy.HTTPError, sess.save)
+            self.assertEqual(TestSession(sess.id)['a'], 3)
+        finally:
+            TestSession.pool.close()
+            shutil.rmtree(storage_path)
+    
+    def test_9_serializers(self):
+        for name in ('pickle', 'marshal', 'json'):
+            serializer = sessions.get_serializer(name, 100)
+            for value in ({'a': 1}, {'big': 'x' * 1000}):
+                data = serializer.dumps(value)
+                self.assertEqual(serializer.loads(data), value)
+            self.assert_(len(data) < 100)
+            # Uncompressed data can still be read.
+            plain = sessions.serializers[name].dumps({'a': 1})
+            self.assertEqual(serializer.loads(plain), {'a': 1})
+        self.assertRaises(ValueError, sessions.get_serializer, 'yaml')
+        
+        # pickle_protocol still picks the protocol of the pickle serializer.
+        sess = sessions.FileSession(storage_path=localDir, pickle_protocol=0,
+                                    clean_freq=0)
+        self.assertEqual(sess._serializer.protocol, 0)
+        self.assertEqual(sess._serializer.dumps({'a': 1}),
+                         sessions.pickle.dumps({'a': 1}, 0))
+        client = sessions.MemcachedClient([])
+        self.assertEqual(client.serializer, sessions.serializers['pickle'])
+        
+        storage_path = os.path.join(localDir, 'sqlitesessions')
+        os.mkdir(storage_path)
+        class TestSession(sessions.SqliteSession):
+            clean_freq = 0
+            per_key = True
+            serializer = 'json'
+            compress_threshold = 100
+        TestSession.setup(storage_path=storage_path)
+        def items():
+            rows = TestSession._execute('select name, value from session_item',
+                                        fetch=True)
+            return [(bytes(name), bytes(value)) for name, value in rows]
+        try:
+            sess = TestSession()
+            sess['profile'] = 'x' * 1000
+            sess['count'] = 1
+            sess.save()
+            self.assertEqual(len(items()), 2)
             
-            data_dict = {}
+            # Only the changed key is rewritten.
+            before = dict(items())
+            sess = TestSession(sess.id)
+            sess['count'] += 1
+            del sess['profile']
+            self.assertEqual(sess._changed_keys, set(['count', 'profile']))
+            sess.save()
+            after = dict(items())
+            self.assertEqual(len(after), 1)
+            for name in after:
+                self.assertNotEqual(after[name], before[name])
             
-            def request(index):
-                for i in range(request_count):
-                    self.getPage("/", cookies)
-                    # Uncomment the following line to prove threads overlap.
+            sess = TestSession(sess.id)
+            self.assertEqual(list(sess.items()), [('count', 2)])
+            sess.clear()
+            sess.save()
+            self.assertEqual(items(), [])
+            sess.delete()
+        finally:
+            TestSession.pool.close()
+            shutil.rmtree(storage_path)
+
+
+import socket
+
+class FakeMemcached(object):
+    """Enough of a memcached server, on a local port, to test against."""
+    
+    def __init__(self):
+        self.store = {}
+        self.last_cas = 0
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self._spawn(self.serve)
+    
+    def _spawn(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.setDaemon(True)
+        t.start()
+    
+    def serve(self):
+        while True:
+            conn, addr = self.sock.accept()
+            self._spawn(self.handle, conn)
+    
+    def handle(self, conn):
+        rfile = conn.makefile('rb')
+        while True:
+            line = rfile.readline()
+            if not line:
+                break
+            parts = [str(p) for p in line.decode('ascii').split()]
+            data = None
+            if parts[0] in ('set', 'add', 'cas'):
+                data = rfile.read(int(parts[4]) + 2)[:-2]
+            self.lock.acquire()
+            try:
+                reply = self.command(parts, data)
+            finally:
+                self.lock.release()
+            conn.sendall(reply)
+        conn.close()
+    
+    def command(self, parts, data):
+        cmd, key = parts[0], parts[1]
+        now = time.time()
+        for k, (d, expires, cas) in list(self.store.items()):
+            if expires is not None and expires <= now:
+                del self.store[k]
+        if cmd in ('get', 'gets'):
+            reply = ntob('')
+            for key in parts[1:]:
+                if key in self.store:
+                    d, expires, cas = self.store[key]
+                    line = 'VALUE %s 0 %d' % (key, len(d))
+                    if cmd == 'gets':
+                        line += ' %d' % cas
+                    reply += ntob(line + '\r\n') + d + ntob('\r\n')
+            return reply + ntob('END\r\n')
+        if cmd == 'delete':
+            if self.store.pop(key, None) is None:
+                return ntob('NOT_FOUND\r\n')
+            return ntob('DELETED\r\n')
+        if cmd == 'touch':
+            exptime = int(parts[2])
+        else:
+            exptime = int(parts[3])
+        if exptime == 0:
+            expires = None
+        elif exptime < 0:
+            expires = now
+        elif exptime > 60 * 60 * 24 * 30:
+            expires = exptime
+        else:
+            expires = now + exptime
+        if cmd == 'touch':
+            if key not in self.store:
+                return ntob('NOT_FOUND\r\n')
+            d, old, cas = self.store[key]
+            self.store[key] = (d, expires, cas)
+            return ntob('TOUCHED\r\n')
+        if cmd == 'add' and key in self.store:
+            return ntob('NOT_STORED\r\n')
+        if cmd == 'cas':
+            if key not in self.store:
+                return ntob('NOT_FOUND\r\n')
+            if self.store[key][2] != int(parts[5]):
+                return ntob('EXISTS\r\n')
+        self.last_cas += 1
+        self.store[key] = (data, expires, self.last_cas)
+        return ntob('STORED\r\n')
+
+
+def setup_memcached_server():
+    fake = FakeMemcached()
+    sessions.MemcachedSession.servers = ['127.0.0.1:%s' % fake.port]
+    setup_server()
+
+
+class MemcachedSessionTest(helper.CPWebCase):
+    setup_server = staticmethod(setup_memcached_server)
+    
+    def test_client(self):
+        servers = ['127.0.0.1:%s' % FakeMemcached().port for i in range(3)]
+        client = sessions.MemcachedClient(servers, pool_size=2)
+        keys = ['key%d' % i for i in range(60)]
+        for key in keys:
+            self.assert_(client.set(key, [key]))
+        
+        # Keys are spread over all the servers; related keys are kept
+        # together, and can be fetched with one command.
+        used = set([client.server_for(key) for key in keys])
+        self.assertEqual(used, set(servers))
+        for key in keys:
+            self.assertEqual(client.server_for(key + '.lock'),
+                             client.server_for(key))
+        self.assert_(client.set('key7.extra', 'extra'))
+        values = client.gets_many(['key7', 'key7.extra', 'key7.missing'])
+        self.assertEqual([v for v, cas in values], [['key7'], 'extra', None])
+        
+        # Removing a server only moves the keys it held.
+        fewer = sessions.MemcachedClient(servers[:2])
+        for key in keys:
+            if client.server_for(key) != servers[2]:
+                self.assertEqual(fewer.server_for(key), client.server_for(key))
+        
+        value, cas = client.gets('key1')
+        self.assert_(client.set('key1', 'changed'))
+        self.assertEqual(client.cas('key1', 'mine', cas), False)
+        value, cas = client.gets('key1')
+        self.assert_(client.cas('key1', 'mine', cas))
+        self.assertEqual(client.get('key1'), 'mine')
+        self.assertEqual(client.add('key1', 'again'), False)
+        self.assert_(client.delete('key1'))
+        self.assertEqual(client.get('key1'), None)
+    
+    def test_touch_and_lock(self):
+        class TestSession(sessions.MemcachedSession):
+            clean_freq = 0
+        TestSession.setup()
+        
+        first = TestSession()
+        first['a'] = 1
+        first.save()
+        key = first._key()
+        saved = TestSession.cache.get(key)
+        
+        # Unchanged data is only touched, and the new expiration time
+        # is seen by the next load.
+        second = TestSession(first.id, timeout=120)
+        second.load()
+        second.save()
+        self.assertEqual(TestSession.cache.get(key), saved)
+        third = TestSession(first.id)
+        third.load()
+        self.assertEqual(third['a'], 1)
+        self.assert_(abs(third._timestamp(third._expiration) -
+                         second._timestamp(second._expiration)) < 0.01)
+        
+        # The lock is reentrant within one session instance.
+        third.acquire_lock()
+        third.acquire_lock()
+        third.release_lock()
+        self.assertEqual(third.locked, True)
+        self.assertNotEqual(TestSession.cache.get(key + '.lock'), None)
+        third.release_lock()
+        self.assertEqual(third.locked, False)
+        self.assertEqual(TestSession.cache.get(key + '.lock'), None)
+    
+    def test_legacy_keys(self):
+        class TestSession(sessions.MemcachedSession):
+            clean_freq = 0
+        TestSession.setup()
+        
+        # Earlier versions stored (data, datetime) under the bare id.
+        id = 'legacy0123456789abcdef'
+        expires = datetime.datetime.now() + datetime.timedelta(minutes=5)
+        self.assert_(TestSession.cache.set(id, ({'a': 1}, expires)))
+        sess = TestSession(id)
+        sess.load()
+        self.assertEqual(sess.id, id)
+        self.assertEqual(sess['a'], 1)
+        
+        # The next save moves it to the new key.
+        sess['b'] = 2
+        sess.save()
+        self.assertEqual(TestSession.cache.get(id), None)
+        again = TestSession(id)
+        again.load()
+        self.assertEqual(sorted(again.items()), [('a', 1), ('b', 2)])
+        
+        TestSession.legacy_keys = False
+        self.assert_(TestSession.cache.set(id + 'x', ({'a': 1}, expires)))
+        sess = TestSession(id + 'x')
+        sess.load()
+        self.assertNotEqual(sess.id, id + 'x')
+    
+    def test_0_Session(self):
+        self.getPage('/setsessiontype/memcached')
+        
+        self.getPage('/testStr')
+        self.assertBody('1')
+        self.getPage('/testGen', self.cookies)
+        self.assertBody('2')
+        self.getPage('/testStr', self.cookies)
+        self.assertBody('3')
+        self.getPage('/length', self.cookies)
+        self.assertErrorPage(500)
+        self.assertInBody("NotImplementedError")
+        self.getPage('/delkey?key=counter', self.cookies)
+        self.assertStatus(200)
+        
+        # Wait for the session.timeout (1 second)
+        time.sleep(1.25)
+        self.getPage('/')
+        self.assertBody('1')
+        
+        # Test session __contains__
+        self.getPage('/keyin?key=counter', self.cookies)
+        self.assertBody("True")
+        
+        # Test session delete
+        self.getPage('/delete', self.cookies)
+        self.assertBody("done")
+    
+    def test_1_Concurrency(self):
+        client_thread_count = 5
+        request_count = 30
+        
+        # Get initial cookie
+        self.getPage("/")
+        self.assertBody("1")
+        cookies = self.cookies
+        
+        data_dict = {}
+        
+        def request(index):
+            for i in range(request_count):
+                self.getPage("/", cookies)
+                # Uncomment the following line to prove threads overlap.
 ##                    sys.stdout.write("%d " % index)
-                if not self.body.isdigit():
-                    self.fail(self.body)
-                data_dict[index] = v = int(self.body)
-            
-            # Start <request_count> concurrent requests from
-            # each of <client_thread_count> clients
-            ts = []
-            for c in range(client_thread_count):
-                data_dict[c] = 0
-                t = threading.Thread(target=request, args=(c,))
-                ts.append(t)
-                t.start()
-            
-            for t in ts:
-                t.join()
-            
-            hitcount = max(data_dict.values())
-            expected = 1 + (client_thread_count * request_count)
-            self.assertEqual(hitcount, expected)
+            if not self.body.isdigit():
+                self.fail(self.body)
+            data_dict[index] = v = int(self.body)
         
-        def test_3_Redirect(self):
-            # Start a new session
-            self.getPage('/testStr')
-            self.getPage('/iredir', self.cookies)
-            self.assertBody("memcached")
+        # Start <request_count> concurrent requests from
+        # each of <client_thread_count> clients
+        ts = []
+        for c in range(client_thread_count):
+            data_dict[c] = 0
+            t = threading.Thread(target=request, args=(c,))
+            ts.append(t)
+            t.start()
         
-        def test_5_Error_paths(self):
-            self.getPage('/unknown/page')
-            self.assertErrorPage(404, "The path '/unknown/page' was not found.")
-            
-            # Note: this path is *not* the same as above. The above
-            # takes a normal route through the session code; this one
-            # skips the session code's before_handler and only calls
-            # before_finalize (save) and on_end (close). So the session
-            # code has to survive calling save/close without init.
-            self.getPage('/restricted', self.cookies, method='POST')
-            self.assertErrorPage(405, response_codes[405])
+        for t in ts:
+            t.join()
+        
+        hitcount = max(data_dict.values())
+        expected = 1 + (client_thread_count * request_count)
+        self.assertEqual(hitcount, expected)
+    
+    def test_3_Redirect(self):
+        # Start a new session
+        self.getPage('/testStr')
+        self.getPage('/iredir', self.cookies)
+        self.assertBody("memcached")
+    
+    def test_5_Error_paths(self):
+        self.getPage('/unknown/page')
+        self.assertErrorPage(404, "The path '/unknown/page' was not found.")
+        
+        # Note: this path is *not* the same as above. The above
+        # takes a normal route through the session code; this one
+        # skips the session code's before_handler and only calls
+        # before_finalize (save) and on_end (close). So the session
+        # code has to survive calling save/close without init.
+        self.getPage('/restricted', self.cookies, method='POST')
+        self.assertErrorPage(405, response_codes[405])
 
@@ -522,6 +522,23 @@ def format_exc(exc=None):
     import traceback
     return "".join(traceback.format_exception(*exc))
 
+def fingerprint_exc(exc=None):
+    """Return a key for the site of exc (or sys.exc_info if None).
+    
+    The key is made of the exception type and the file and line of each
+    frame in the traceback, so that the same error raised from the same
+    place has the same key (whatever its message), without the cost of
+    formatting the traceback.
+    """
+    if exc is None:
+        exc = _exc_info()
+    exc_type, value, tb = exc
+    key = [exc_type]
+    while tb is not None:
+        key.append((tb.tb_frame.f_code.co_filename, tb.tb_lineno))
+        tb = tb.tb_next
+    return tuple(key)
+
 def bare_error(extrabody=None):
     """Produce status, headers, body for a critical error.
     
@@ -97,6 +97,49 @@ Since "log.*" config entries simply set attributes on the log object, you can
 add custom attributes to your heart's content. Note that these handlers are
 used ''instead'' of the default, simple handlers outlined above (so don't set
 the "log.error_file" config entry, for example).
+
+
+Asynchronous access logging
+===========================
+
+Set ``log.access_async`` to True to take access logging off the request
+thread. Each request then only queues its raw fields, and a background
+:class:`AccessLogWriter` formats and writes them in batches: every
+``log.access_flush_interval`` seconds, or sooner if many are waiting. Each
+message still reaches the access log's handlers as its own record; the
+handlers' locks are held across a batch, so it is written out together.
+If more than ``log.access_queue_size`` records are waiting, further ones are
+dropped; the number dropped is reported in the error log.
+
+
+Structured access logs
+======================
+
+Set ``log.access_log_fields`` to a list of field names to write each access
+message as a JSON object (or, with ``log.access_log_style = 'logfmt'``, as a
+line of ``name=value`` pairs) holding those fields, instead of in
+``access_log_format``. The available fields are the keys of
+:data:`structured_fields`, to which you may add your own; any request header
+is also available as ``'header.<Name>'``. For example::
+
+    log.access_log_fields = ['time', 'remote_addr', 'method', 'path',
+                             'status', 'bytes_sent', 'total_time',
+                             'header.X-Request-Id']
+
+The list is compiled, when it is set, into a single function which pulls
+the raw values out of the request; all formatting is done afterward (in the
+background, if ``log.access_async`` is also set).
+
+
+Repeated tracebacks
+===================
+
+When something an application depends on fails, every request may log the
+same traceback. Set ``log.traceback_window`` to a number of seconds to log
+each traceback in full only once in that time for each place it was raised
+from (see :func:`_cperror.fingerprint_exc<cherrypy._cperror.fingerprint_exc>`).
+Repeats are only counted, and a "repeated N times" summary is logged when the
+window ends.
 """
 
 import datetime
@@ -105,10 +148,113 @@ import logging
 logging.Logger.manager.emittedNoHandlerWarning = 1
 logfmt = logging.Formatter("%(message)s")
 import os
+import re
 import sys
+import threading
+import time
+from collections import deque
 
 import cherrypy
-from cherrypy import _cperror
+from cherrypy import _cperror, _cpreqbody
+from cherrypy._cpcompat import json_encode, ntob, set_daemon
+
+
+structured_fields = {
+    'time': 'now',
+    'remote_addr': 'request.remote.ip',
+    'remote_host': 'request.remote.name or request.remote.ip',
+    'login': 'request.login',
+    'method': 'request.method',
+    'path': 'request.script_name + request.path_info',
+    'query_string': 'request.query_string',
+    'request_line': 'request.request_line',
+    'status': '_status(response.output_status)',
+    'bytes_read': '_bytes_read(request)',
+    'bytes_sent': '_bytes_sent(request)',
+    'referer': 'dict.get(inheaders, "Referer")',
+    'user_agent': 'dict.get(inheaders, "User-Agent")',
+    'thread': '_thread_name()',
+    'queue_wait': '_queue_wait(request)',
+    'handler_time': 'request.handler_time',
+    'total_time': 'now - response.time',
+    }
+"""A map from structured access log field names to Python expressions,
+which may use the names 'request', 'response', 'inheaders', 'outheaders'
+and 'now' (the current time.time()). Times are in seconds.
+
+bytes_read counts the request body bytes read off the socket (before any
+decompression), and bytes_sent the bytes the WSGI server wrote for the
+response, status line and headers included. Access messages which use
+bytes_sent are written when the request closes, once the body is out."""
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _status(output_status):
+    if output_status is None:
+        return None
+    return _int(output_status[:3])
+
+def _thread_name():
+    return threading.currentThread().getName()
+
+def _queue_wait(request):
+    environ = getattr(request, 'wsgi_environ', None)
+    if environ is None:
+        return None
+    return environ.get('wsgiserver.queue_wait')
+
+def _bytes_read(request):
+    body = getattr(request, 'body', None)
+    count = 0
+    fp = getattr(body, 'fp', None)
+    while fp is not None:
+        # The innermost SizedReader counts the bytes on the wire.
+        if isinstance(fp, _cpreqbody.SizedReader):
+            count = fp.bytes_read
+        fp = getattr(fp, 'fp', None)
+    return count
+
+def _bytes_sent(request):
+    environ = getattr(request, 'wsgi_environ', None)
+    if environ is None:
+        return None
+    bytes_sent = environ.get('wsgiserver.bytes_sent')
+    if bytes_sent is None:
+        return None
+    return bytes_sent()
+
+_field_name = re.compile(r'^[A-Za-z_][A-Za-z0-9_.-]*$')
+
+def compile_access_fields(fields):
+    """Return a function of (request, response) which returns a tuple of
+    the raw values of the given structured access log fields."""
+    exprs = []
+    for name in fields:
+        if not _field_name.match(name):
+            raise ValueError("Invalid access log field name %r." % name)
+        if name.startswith('header.'):
+            expr = 'dict.get(inheaders, %r)' % name[7:].title()
+        else:
+            try:
+                expr = structured_fields[name]
+            except KeyError:
+                raise ValueError("Unknown access log field %r." % name)
+        exprs.append('(%s)' % expr)
+    source = ('def extract(request, response):\n'
+              '    now = _time()\n'
+              '    inheaders = request.headers\n'
+              '    outheaders = response.headers\n'
+              '    return (%s,)\n' % ', '.join(exprs))
+    namespace = {'_time': time.time, '_int': _int, '_status': _status,
+                 '_thread_name': _thread_name, '_queue_wait': _queue_wait,
+                 '_bytes_read': _bytes_read, '_bytes_sent': _bytes_sent}
+    exec(source, namespace)
+    return namespace['extract']
 
 
 class LogManager(object):
@@ -130,6 +276,32 @@ class LogManager(object):
     access_log_format = \
         '{h} {l} {u} {t} "{r}" {s} {b} "{f}" "{a}"'
     
+    access_async = False
+    """If True, access messages are formatted and written by a background
+    :class:`AccessLogWriter`, instead of on the request thread."""
+    
+    access_queue_size = 10000
+    """The number of access records which may wait for the background
+    writer; records beyond this are dropped."""
+    
+    access_flush_interval = 0.5
+    """The number of seconds between writes by the background writer."""
+    
+    access_writer = None
+    """The :class:`AccessLogWriter`, once access_async has been used."""
+    
+    access_log_style = 'json'
+    """The format of structured access messages: 'json' or 'logfmt'."""
+    
+    traceback_window = None
+    """If not None, the number of seconds for which a traceback is only
+    logged once for each place it was raised from; repeats are counted,
+    and summarized when the window ends."""
+    
+    _access_fields = None
+    _access_extractor = None
+    _access_when_closed = False
+    
     logger_root = None
     """The "top-level" logger name.
     
@@ -152,10 +324,18 @@ class LogManager(object):
             self.access_log = logging.getLogger("%s.access.%s" % (logger_root, appid))
         self.error_log.setLevel(logging.INFO)
         self.access_log.setLevel(logging.INFO)
+        self._writer_lock = threading.Lock()
+        # {fingerprint: [window start, repeats, severity, context, site]}
+        self._tracebacks = {}
+        self._tracebacks_lock = threading.Lock()
         cherrypy.engine.subscribe('graceful', self.reopen_files)
+        cherrypy.engine.subscribe('stop', self.stop_access_writer)
+        cherrypy.engine.subscribe('main', self.summarize_tracebacks)
+        cherrypy.engine.subscribe('stop', self._summarize_all_tracebacks)
     
     def reopen_files(self):
         """Close and reopen all file handlers."""
+        self.flush_access()
         for log in (self.error_log, self.access_log):
             for h in log.handlers:
                 if isinstance(h, logging.FileHandler):
@@ -171,12 +351,70 @@ class LogManager(object):
         to log application-specific information.
         
         If ``traceback`` is True, the traceback of the current exception
-        (if any) will be appended to ``msg``.
+        (if any) will be appended to ``msg`` (but see ``traceback_window``).
         """
+        if not self.error_log.isEnabledFor(severity):
+            # Don't format what won't be written.
+            return
         if traceback:
+            if self.traceback_window and self._repeated(severity, context):
+                return
             msg += _cperror.format_exc()
         self.error_log.log(severity, ' '.join((self.time(), context, msg)))
     
+    def _repeated(self, severity, context):
+        """Return True (and count it) if the current exception's traceback
+        was already logged in this window."""
+        exc = sys.exc_info()
+        if exc[0] is None:
+            return False
+        key = _cperror.fingerprint_exc(exc)
+        now = time.time()
+        self._tracebacks_lock.acquire()
+        try:
+            entry = self._tracebacks.get(key)
+            if entry is not None and now < entry[0] + self.traceback_window:
+                entry[1] += 1
+                return True
+            site = getattr(exc[0], '__name__', str(exc[0]))
+            if len(key) > 1:
+                site += ' at %s:%s' % key[-1]
+            self._tracebacks[key] = [now, 0, severity, context, site]
+        finally:
+            self._tracebacks_lock.release()
+        if entry is not None:
+            self._log_repeats(entry)
+        return False
+    
+    def _log_repeats(self, entry):
+        start, repeats, severity, context, site = entry
+        if repeats:
+            msg = ('Traceback for %s repeated %d more times in %d seconds.'
+                   % (site, repeats, self.traceback_window or 0))
+            self.error_log.log(severity, ' '.join((self.time(), context, msg)))
+    
+    def summarize_tracebacks(self, force=False):
+        """Log a summary of the tracebacks repeated in each window which
+        has ended (or in every window, if force is True)."""
+        if not self._tracebacks:
+            return
+        now = time.time()
+        window = self.traceback_window or 0
+        ended = []
+        self._tracebacks_lock.acquire()
+        try:
+            for key, entry in list(self._tracebacks.items()):
+                if force or now >= entry[0] + window:
+                    del self._tracebacks[key]
+                    ended.append(entry)
+        finally:
+            self._tracebacks_lock.release()
+        for entry in ended:
+            self._log_repeats(entry)
+    
+    def _summarize_all_tracebacks(self):
+        self.summarize_tracebacks(force=True)
+    
     def __call__(self, *args, **kwargs):
         """An alias for ``error``."""
         return self.error(*args, **kwargs)
@@ -197,26 +435,84 @@ class LogManager(object):
         of the raw byte. Exceptions from this rule are " and \\, which are
         escaped by prepending a backslash, and all whitespace characters,
         which are written in their C-style notation (\\n, \\t, etc).
+        
+        If ``access_async`` is True, the message is only queued, to be
+        formatted and written by the :attr:`access_writer`. If the
+        structured :attr:`access_log_fields` include bytes_sent, this waits
+        for the request to close, when the response body has been written.
+        
+        Nothing is logged for requests whose WSGI environ has
+        ``cherrypy.log.access`` set to False (such as the caching tool's
+        background refreshes, which no client made).
+        """
+        request = cherrypy.serving.request
+        environ = getattr(request, 'wsgi_environ', None)
+        if environ and environ.get('cherrypy.log.access') is False:
+            return
+        if self._access_when_closed and not request.closed:
+            request.hooks.attach('on_end_request', self._write_access,
+                                 failsafe=True, priority=100)
+            return
+        self._write_access()
+    
+    def _write_access(self):
+        fields = self.access_fields()
+        if self.access_async:
+            writer = self.access_writer
+            if writer is None or not writer.running:
+                writer = self.start_access_writer()
+            writer.put(fields)
+            return
+        
+        msg = self.format_access(fields)
+        try:
+            self.access_log.log(logging.INFO, msg)
+        except:
+            self(traceback=True)
+    
+    def access_fields(self):
+        """Return a tuple of the raw values which the access log needs.
+        
+        This is all the work done on the request thread when logging
+        asynchronously, so it does no formatting at all.
         """
         request = cherrypy.serving.request
-        remote = request.remote
         response = cherrypy.serving.response
+        if self._access_extractor is not None:
+            return self._access_extractor(request, response)
+        remote = request.remote
         outheaders = response.headers
         inheaders = request.headers
-        if response.output_status is None:
+        return (remote.name or remote.ip,
+                getattr(request, "login", None),
+                datetime.datetime.now(),
+                request.request_line,
+                response.output_status,
+                dict.get(outheaders, 'Content-Length', ''),
+                dict.get(inheaders, 'Referer', ''),
+                dict.get(inheaders, 'User-Agent', ''),
+                )
+    
+    def format_access(self, fields):
+        """Return an access message for the given access_fields()."""
+        if self._access_extractor is not None:
+            return self.format_structured(fields)
+        (host, login, now, request_line, output_status, content_length,
+         referer, user_agent) = fields
+        if output_status is None:
             status = "-"
         else:
-            status = str(response.output_status.split(b" ", 1)[0], 'ISO-8859-1')
+            status = str(output_status.split(b" ", 1)[0], 'ISO-8859-1')
         
-        atoms = {'h': remote.name or remote.ip,
+        atoms = {'h': host,
                  'l': '-',
-                 'u': getattr(request, "login", None) or "-",
-                 't': self.time(),
-                 'r': request.request_line,
+                 'u': login or "-",
+                 't': self.time(now),
+                 'r': request_line,
                  's': status,
-                 'b': dict.get(outheaders, 'Content-Length', '') or "-",
-                 'f': dict.get(inheaders, 'Referer', ''),
-                 'a': dict.get(inheaders, 'User-Agent', ''),
+                 'b': content_length or "-",
+                 'f': referer,
+                 'a': user_agent,
                  }
         for k, v in atoms.items():
             if not isinstance(v, str):
@@ -234,14 +530,71 @@ class LogManager(object):
             # Escape double-quote.
             atoms[k] = v
         
-        try:
-            self.access_log.log(logging.INFO, self.access_log_format.format(**atoms))
-        except:
-            self(traceback=True)
+        return self.access_log_format.format(**atoms)
+    
+    def _get_access_log_fields(self):
+        return self._access_fields
+    def _set_access_log_fields(self, fields):
+        if fields is None:
+            self._access_extractor = None
+            self._access_fields = None
+            self._access_when_closed = False
+        else:
+            fields = tuple(fields)
+            self._access_extractor = compile_access_fields(fields)
+            self._access_fields = fields
+            self._access_when_closed = 'bytes_sent' in fields
+    access_log_fields = property(_get_access_log_fields,
+                                 _set_access_log_fields,
+        doc="""The fields of structured access messages (see
+        :data:`structured_fields`), or None for access_log_format.
+        
+        Setting this compiles the fields into a function which collects
+        them all at once.
+        """)
     
-    def time(self):
-        """Return now() in Apache Common Log Format (no timezone)."""
-        now = datetime.datetime.now()
+    def format_structured(self, values):
+        """Return a structured access message for the given field values."""
+        pairs = []
+        if self.access_log_style == 'logfmt':
+            for name, value in zip(self._access_fields, values):
+                pairs.append('%s=%s' % (name, _logfmt_value(value)))
+            return ' '.join(pairs)
+        for name, value in zip(self._access_fields, values):
+            pairs.append('"%s": %s' % (name, _json_value(value)))
+        return '{%s}' % ', '.join(pairs)
+    
+    def start_access_writer(self):
+        """Start (if need be) and return the background access writer."""
+        self._writer_lock.acquire()
+        try:
+            writer = self.access_writer
+            if writer is None or not writer.running:
+                writer = AccessLogWriter(self, self.access_queue_size,
+                                         self.access_flush_interval)
+                writer.start()
+                self.access_writer = writer
+            return writer
+        finally:
+            self._writer_lock.release()
+    
+    def stop_access_writer(self):
+        """Stop the background access writer, writing out what it holds."""
+        writer = self.access_writer
+        if writer is not None:
+            writer.stop()
+    
+    def flush_access(self):
+        """Write out any access records waiting for the background writer."""
+        writer = self.access_writer
+        if writer is not None:
+            writer.flush()
+    
+    def time(self, now=None):
+        """Return now() (or the given datetime) in Apache Common Log Format
+        (no timezone)."""
+        if now is None:
+            now = datetime.datetime.now()
         monthnames = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
                       'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
         month = monthnames[now.month - 1].capitalize()
@@ -363,6 +716,139 @@ class LogManager(object):
         """)
 
 
+def _text(value):
+    """Return the given bytes as str (from UTF-8, if it can be)."""
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf8')
+        except UnicodeDecodeError:
+            return value.decode('ISO-8859-1')
+    return value
+
+def _json_value(value):
+    if isinstance(value, float):
+        return '%.6f' % value
+    return ntob('').join(json_encode(_text(value))).decode('utf8')
+
+_logfmt_bare = re.compile(r'^[\x21\x23-\x3c\x3e-\x5b\x5d-\x7e]+$')
+
+def _logfmt_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return '%.6f' % value
+    value = _text(value)
+    if not isinstance(value, str):
+        return str(value)
+    if _logfmt_bare.match(value):
+        return value
+    # Quote (and escape) anything with spaces, quotes, '=' or other bytes.
+    return _json_value(value)
+
+
+class AccessLogWriter(object):
+    """Format and write access records for a LogManager, in the background.
+    
+    Request threads only put() a tuple of raw fields into a queue. A
+    thread wakes every ``interval`` seconds (or sooner, once ``batch_size``
+    records are waiting), formats everything queued, and logs each message
+    as its own record, holding the access log handlers' locks meanwhile so
+    the batch is written out together. Records put while ``maxsize`` are
+    waiting are dropped, and counted in ``dropped``.
+    """
+    
+    batch_size = 100
+    """The number of waiting records which wakes the writer early."""
+    
+    def __init__(self, manager, maxsize=10000, interval=0.5):
+        self.manager = manager
+        self.maxsize = maxsize
+        self.interval = interval
+        self.queue = deque()
+        self.dropped = 0
+        self.reported = 0
+        self.running = False
+        self.thread = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+    
+    def put(self, fields):
+        """Queue the given access fields (from LogManager.access_fields)."""
+        queue = self.queue
+        if len(queue) >= self.maxsize:
+            self.lock.acquire()
+            try:
+                self.dropped += 1
+            finally:
+                self.lock.release()
+            return
+        queue.append(fields)
+        if len(queue) >= self.batch_size:
+            self.ready.set()
+    
+    def start(self):
+        """Start the writer thread."""
+        self.running = True
+        self.thread = threading.Thread(target=self.run,
+                                       name="CP Access Log Writer")
+        set_daemon(self.thread, True)
+        self.thread.start()
+    
+    def stop(self):
+        """Stop the writer thread, and write out any waiting records."""
+        self.running = False
+        self.ready.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+        self.thread = None
+        self.flush()
+    
+    def run(self):
+        while self.running:
+            self.ready.wait(self.interval)
+            self.ready.clear()
+            self.flush()
+    
+    def flush(self):
+        """Format and write all waiting records, and note any dropped."""
+        self.lock.acquire()
+        try:
+            queue = self.queue
+            manager = self.manager
+            lines = []
+            while queue:
+                fields = queue.popleft()
+                try:
+                    lines.append(manager.format_access(fields))
+                except:
+                    manager.error(traceback=True)
+            dropped = self.dropped - self.reported
+            self.reported = self.dropped
+        finally:
+            self.lock.release()
+        
+        if lines:
+            access_log = manager.access_log
+            # Handler locks are reentrant, so each log() below may take
+            # them again; holding them keeps other writers out between.
+            handlers = list(access_log.handlers)
+            for h in handlers:
+                h.acquire()
+            try:
+                try:
+                    for line in lines:
+                        access_log.log(logging.INFO, line)
+                except:
+                    manager.error(traceback=True)
+            finally:
+                for h in handlers:
+                    h.release()
+        if dropped:
+            manager.error('%d access log records were dropped (queue full).'
+                          % dropped, 'ACCESS', severity=logging.WARNING)
+
+
 class WSGIErrorHandler(logging.Handler):
     "A handler class which writes logging records to environ['wsgi.errors']."
     
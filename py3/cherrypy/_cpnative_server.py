@@ -6,7 +6,7 @@ import sys
 import cherrypy
 from cherrypy._cpcompat import BytesIO
 from cherrypy._cperror import format_exc, bare_error
-from cherrypy.lib import httputil
+from cherrypy.lib import coalesce_chunks, httputil
 from cherrypy import wsgiserver
 
 
@@ -71,9 +71,14 @@ class NativeGateway(wsgiserver.Gateway):
                             qs = ir.query_string
                             rfile = BytesIO()
                     
+                    body = response.body
+                    if (response._measured_length is not None
+                        and isinstance(body, (list, tuple)) and len(body) > 1):
+                        # Only coalesce chunks finalize measured itself;
+                        # a declared Content-Length may be wrong.
+                        body = coalesce_chunks(body)
                     self.send_response(
-                        response.output_status, response.header_list,
-                        response.body)
+                        response.output_status, response.header_list, body)
                 finally:
                     app.release_serving()
         except:
@@ -30,16 +30,39 @@ as the config value. It must implement the basic methods ``get``, ``put``,
 You may set any attribute, including overriding methods, on the cache
 instance by providing them in config. The above sets the
 :attr:`delay<cherrypy.lib.caching.MemoryCache.delay>` attribute, for example.
+
+Expired responses may still be served for a while, as described in RFC 5861:
+set the ``stale_while_revalidate`` attribute (or send a Cache-Control
+``stale-while-revalidate=N`` directive in the response) to serve the stale copy
+while a single background request refreshes it, and ``stale_if_error`` (or
+``stale-if-error=N``) to serve it in place of a server error.
+
+To share one cache between several CherryPy processes on the same host, use
+:class:`FileCache<cherrypy.lib.caching.FileCache>`::
+
+    [/]
+    tools.caching.on = True
+    tools.caching.cache_class = cherrypy.lib.caching.FileCache
+    tools.caching.storage_path = "/var/cache/mysite"
 """
 
+import bisect
 import datetime
+import heapq
+import mmap
+import os
+import shutil
+import struct
 import sys
+import tempfile
 import threading
 import time
+import zlib
 
 import cherrypy
 from cherrypy.lib import cptools, httputil
-from cherrypy._cpcompat import copyitems, ntob, set_daemon, sorted
+from cherrypy._cpcompat import BytesIO, basestring, bytestr, md5, ntob, pickle, set
+from cherrypy._cpcompat import set_daemon, sorted, xrange
 
 
 class Cache(object):
@@ -60,12 +83,54 @@ class Cache(object):
     def clear(self):
         """Reset the cache to its initial, empty state."""
         raise NotImplemented
-
+    
+    def add_encoding(self, encodings, coding, body):
+        """Keep an encoded form of the current (cached) variant.
+        
+        Encoding tools call this with the request.cached_encodings they
+        were given, so that later hits can reuse the encoded body.
+        """
+        encodings[coding] = body
 
 
 # ------------------------------- Memory Cache ------------------------------- #
 
 
+def _variant_key(request, selecting_headers):
+    """Return the variant key for the current request."""
+    header_values = [request.headers.get(h, '')
+                     for h in selecting_headers
+                     if h.lower() != 'accept-encoding']
+    return tuple(sorted(header_values))
+
+
+def _cache_directives(headers):
+    """Return a dict of the Cache-Control directives in the given headers."""
+    directives = {}
+    for atom in (dict.get(headers, 'Cache-Control') or '').split(','):
+        atoms = atom.strip().split('=', 1)
+        if atoms[0]:
+            directives[atoms[0].lower()] = (atoms[1:] or [None])[0]
+    return directives
+
+
+def _stale_windows(cache, headers):
+    """Return (stale_while_revalidate, stale_if_error) seconds for a response.
+    
+    The stale-while-revalidate and stale-if-error Cache-Control directives
+    of the given response headers override the cache's own defaults.
+    """
+    windows = []
+    directives = _cache_directives(headers)
+    for name in ('stale-while-revalidate', 'stale-if-error'):
+        value = directives.get(name)
+        if value is not None and value.isdigit():
+            windows.append(int(value))
+        else:
+            windows.append(getattr(cache, name.replace('-', '_'), 0))
+    return tuple(windows)
+
+
 class AntiStampedeCache(dict):
     """A storage system for cached items which reduces stampede collisions."""
     
@@ -127,6 +192,48 @@ class AntiStampedeCache(dict):
             existing.set()
 
 
+class SpilledBody(object):
+    """A cached response body kept in a memory-mapped file.
+    
+    Iterating over it yields the body in chunks of chunk_size bytes straight
+    from the mapping, so serving it never loads the whole body onto the heap.
+    Where the platform allows it, the file is unlinked as soon as it has been
+    mapped, so that it is removed as soon as the last reference goes away.
+    """
+    
+    chunk_size = 65536
+    
+    def __init__(self, data, dir):
+        fd, self.path = tempfile.mkstemp(dir=dir, prefix='spill-')
+        f = os.fdopen(fd, 'w+b')
+        try:
+            f.write(data)
+            f.flush()
+            self.map = mmap.mmap(f.fileno(), len(data),
+                                 access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.discard()
+    
+    def __len__(self):
+        return len(self.map)
+    
+    def __iter__(self):
+        m, size = self.map, self.chunk_size
+        for start in xrange(0, len(m), size):
+            yield m[start:start + size]
+    
+    def discard(self):
+        """Remove the backing file (if it hasn't been already)."""
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+                self.path = None
+            except OSError:
+                # Windows won't remove a mapped file; try again on eviction.
+                pass
+
+
 class MemoryCache(Cache):
     """An in-memory cache for varying response content.
     
@@ -140,6 +247,25 @@ class MemoryCache(Cache):
     The items contained in ``self.store[uri]`` have keys which are tuples of
     request header values (in the same order as the names in its
     selecting_headers), and values which are the actual responses.
+    
+    Accept-Encoding is never used as a selecting header: responses are
+    stored without any content-coding, and their encoded forms (such as
+    the gzipped body) are kept alongside them; see :func:`tee_output`.
+    
+    Expiration times are kept in a heap, so each sweep only looks at the
+    entries which are actually due. When the cache is full, the least
+    recently used entries are evicted to make room for new ones.
+    
+    If ``spill_path`` is set, responses too large for ``maxobj_size`` are
+    stored in memory-mapped files in that directory instead (see
+    :class:`SpilledBody`), up to ``spill_maxobj_size`` each and
+    ``spill_maxsize`` in all. Both tiers share the ``maxobjects`` limit
+    and the LRU order, but each is evicted to make room in that tier.
+    
+    Handlers may label their responses with :func:`tag`; the cached
+    variants can then be removed by tag with :meth:`purge_tags`, or by
+    URI prefix with :meth:`purge_prefix`. Both use an index (of tags, and
+    a sorted list of URIs respectively) rather than scanning the store.
     """
     
     maxobjects = 1000
@@ -151,9 +277,27 @@ class MemoryCache(Cache):
     maxsize = 10000000
     """The maximum size of the entire cache in bytes; defaults to 10 MB."""
     
+    spill_path = None
+    """The directory in which to keep objects larger than maxobj_size in
+    memory-mapped files; if None (the default), they are not cached."""
+    
+    spill_maxobj_size = 100000000
+    """The maximum size of each spilled object in bytes; defaults to 100 MB."""
+    
+    spill_maxsize = 1000000000
+    """The maximum size of all spilled objects in bytes; defaults to 1 GB."""
+    
     delay = 600
     """Seconds until the cached content expires; defaults to 600 (10 minutes)."""
     
+    stale_while_revalidate = 0
+    """Seconds past ``delay`` during which an expired response is still served
+    while a single background request refreshes it; defaults to 0."""
+    
+    stale_if_error = 0
+    """Seconds past ``delay`` during which an expired response is served in
+    place of a server error from the handler; defaults to 0."""
+    
     antistampede_timeout = 5
     """Seconds to wait for other threads to release a cache lock."""
     
@@ -163,6 +307,7 @@ class MemoryCache(Cache):
     debug = False
     
     def __init__(self):
+        self.lock = threading.RLock()
         self.clear()
         
         # Run self.expire_cache in a separate daemon thread.
@@ -173,14 +318,138 @@ class MemoryCache(Cache):
     
     def clear(self):
         """Reset the cache to its initial, empty state."""
-        self.store = {}
-        self.expirations = {}
-        self.tot_puts = 0
-        self.tot_gets = 0
-        self.tot_hist = 0
-        self.tot_expires = 0
-        self.tot_non_modified = 0
-        self.cursize = 0
+        self.lock.acquire()
+        try:
+            self.store = {}
+            # The keys of self.store, sorted (for purge_prefix).
+            self.uris = []
+            # Maps each tag to the set of (uri, variant key) tagged with it.
+            self.tags = {}
+            # A heap of (expiration_time, (uri, variant key)) tuples.
+            self.expirations = []
+            # Maps (uri, variant key) to its node in the LRU list. Each node
+            # is a list of [prev, next, key, size, expiration_time, spilled,
+            # tags], where spilled is a list of the entry's SpilledBody
+            # objects (or None if it is held in RAM). self.lru is the root:
+            # root[1] is the most recently used node, and root[0] the least.
+            self.entries = {}
+            self.lru = root = []
+            root[:] = [root, root, None, 0, None, None, ()]
+            self.tot_puts = 0
+            self.tot_gets = 0
+            self.tot_hist = 0
+            self.tot_expires = 0
+            self.tot_evictions = 0
+            self.tot_non_modified = 0
+            self.cursize = 0
+            self.spillsize = 0
+        finally:
+            self.lock.release()
+    
+    def _link(self, node):
+        """Make the given node the most recently used. Caller holds self.lock."""
+        root = self.lru
+        first = root[1]
+        node[0] = root
+        node[1] = first
+        first[0] = root[1] = node
+    
+    def _unlink(self, node):
+        """Take the given node out of the LRU list. Caller holds self.lock."""
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+    
+    def _forget(self, key):
+        """Stop tracking the given entry. Caller holds self.lock."""
+        node = self.entries.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+            if node[5] is None:
+                self.cursize -= node[3]
+            else:
+                self.spillsize -= node[3]
+                for body in node[5]:
+                    body.discard()
+            for tag in node[6]:
+                keys = self.tags[tag]
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+    
+    def _make_room(self, size, spilled, objects=1):
+        """Evict the least recently used entries until there's room for
+        the given number of new objects of the given total size. Caller
+        holds self.lock.
+        
+        Entries are only taken from the tier the new size goes into
+        (spilled or not), unless there are too many objects altogether.
+        """
+        if spilled is None:
+            maxsize = self.maxsize
+        else:
+            maxsize = self.spill_maxsize
+        root = self.lru
+        node = root[0]
+        while node is not root:
+            full = len(self.entries) + objects > self.maxobjects
+            if spilled is None:
+                full_tier = self.cursize + size >= maxsize
+            else:
+                full_tier = self.spillsize + size >= maxsize
+            if not (full or full_tier):
+                break
+            prev = node[0]
+            if full or (node[5] is None) == (spilled is None):
+                self._remove(node[2])
+                self.tot_evictions += 1
+            node = prev
+    
+    def _store_uri(self, uri, uricache):
+        """Set self.store[uri], keeping self.uris. Caller holds self.lock."""
+        if uri not in self.store:
+            bisect.insort(self.uris, uri)
+        self.store[uri] = uricache
+    
+    def _drop_uri(self, uri):
+        """Pop self.store[uri], keeping self.uris. Caller holds self.lock."""
+        uricache = self.store.pop(uri, None)
+        if uricache is not None:
+            i = bisect.bisect_left(self.uris, uri)
+            if i < len(self.uris) and self.uris[i] == uri:
+                del self.uris[i]
+        return uricache
+    
+    def _remove(self, key):
+        """Remove the given (uri, variant key) from the cache. Caller holds self.lock."""
+        self._forget(key)
+        uri, variant_key = key
+        uricache = self.store.get(uri)
+        if uricache is not None:
+            # Leave a stampede sentinel alone; another thread is filling it.
+            existing = uricache.get(variant_key)
+            if existing is not None and not isinstance(existing, threading._Event):
+                del uricache[variant_key]
+            if not uricache:
+                self._drop_uri(uri)
+    
+    def expire(self, now=None):
+        """Remove all entries whose expiration time has passed."""
+        if now is None:
+            now = time.time()
+        expirations = self.expirations
+        self.lock.acquire()
+        try:
+            while expirations and expirations[0][0] <= now:
+                expiration_time, key = heapq.heappop(expirations)
+                node = self.entries.get(key)
+                # The entry may have been replaced, evicted or deleted since
+                # this expiration was pushed; if so, skip it.
+                if node is not None and node[4] == expiration_time:
+                    self._remove(key)
+                    self.tot_expires += 1
+        finally:
+            self.lock.release()
     
     def expire_cache(self):
         """Continuously examine cached objects, expiring stale ones.
@@ -192,20 +461,7 @@ class MemoryCache(Cache):
         # arbitrarily, so we check "while time" to avoid exceptions.
         # See tickets #99 and #180 for more information.
         while time:
-            now = time.time()
-            # Must make a copy of expirations so it doesn't change size
-            # during iteration
-            for expiration_time, objects in copyitems(self.expirations):
-                if expiration_time <= now:
-                    for obj_size, uri, sel_header_values in objects:
-                        try:
-                            del self.store[uri][tuple(sel_header_values)]
-                            self.tot_expires += 1
-                            self.cursize -= obj_size
-                        except KeyError:
-                            # the key may have been deleted elsewhere
-                            pass
-                    del self.expirations[expiration_time]
+            self.expire()
             time.sleep(self.expire_freq)
     
     def get(self):
@@ -218,49 +474,822 @@ class MemoryCache(Cache):
         if uricache is None:
             return None
         
-        header_values = [request.headers.get(h, '')
-                         for h in uricache.selecting_headers]
-        variant = uricache.wait(key=tuple(sorted(header_values)),
+        variant_key = _variant_key(request, uricache.selecting_headers)
+        variant = uricache.wait(key=variant_key,
                                 timeout=self.antistampede_timeout,
                                 debug=self.debug)
         if variant is not None:
             self.tot_hist += 1
+            self.lock.acquire()
+            try:
+                node = self.entries.get((uri, variant_key))
+                if node is not None:
+                    self._unlink(node)
+                    self._link(node)
+            finally:
+                self.lock.release()
         return variant
     
+    def _spill(self, variant):
+        """Return a copy of the given variant with its bodies spilled."""
+        variant = list(variant)
+        spilled = [SpilledBody(variant[2], self.spill_path)]
+        variant[2] = spilled[0]
+        if len(variant) > 4:
+            encodings = {}
+            for coding, body in variant[4].items():
+                encodings[coding] = SpilledBody(body, self.spill_path)
+                spilled.append(encodings[coding])
+            # With no encoded forms, give the encoding tools None, so they
+            # don't encode the body onto the heap and add it to the entry.
+            variant[4] = encodings or None
+        return tuple(variant), spilled
+    
     def put(self, variant, size):
         """Store the current variant in the cache."""
         request = cherrypy.serving.request
         response = cherrypy.serving.response
         
         uri = cherrypy.url(qs=request.query_string)
-        uricache = self.store.get(uri)
-        if uricache is None:
-            uricache = AntiStampedeCache()
-            uricache.selecting_headers = [
-                e.value for e in response.headers.elements('Vary')]
-            self.store[uri] = uricache
         
-        if len(self.store) < self.maxobjects:
-            total_size = self.cursize + size
+        spilled = None
+        if size >= self.maxobj_size or size >= self.maxsize:
+            if (self.spill_path and size < self.spill_maxobj_size
+                and size < self.spill_maxsize):
+                # Write the files before taking the lock.
+                variant, spilled = self._spill(variant)
+        
+        self.lock.acquire()
+        try:
+            uricache = self.store.get(uri)
+            if uricache is None:
+                uricache = AntiStampedeCache()
+                uricache.selecting_headers = [
+                    e.value for e in response.headers.elements('Vary')]
+                self._store_uri(uri, uricache)
+            variant_key = _variant_key(request, uricache.selecting_headers)
+            key = (uri, variant_key)
+            
+            # Drop any previous copy so its size isn't counted twice.
+            self._forget(key)
+            
+            if spilled is None:
+                if size >= self.maxobj_size or size >= self.maxsize:
+                    self._remove(key)
+                    return
+            
+            self._make_room(size, spilled)
+            
+            # Keep the entry past its freshness lifetime if it may be served stale.
+            expiration_time = (response.time + self.delay +
+                               max(_stale_windows(self, response.headers)))
+            tags = tuple(getattr(request, 'cache_tags', ()))
+            node = [None, None, key, size, expiration_time, spilled, tags]
+            self._link(node)
+            self.entries[key] = node
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            if spilled is None:
+                self.cursize += size
+            else:
+                self.spillsize += size
+            heapq.heappush(self.expirations, (expiration_time, key))
             
-            # checks if there's space for the object
-            if (size < self.maxobj_size and total_size < self.maxsize):
-                # add to the expirations list
-                expiration_time = response.time + self.delay
-                bucket = self.expirations.setdefault(expiration_time, [])
-                bucket.append((size, uri, uricache.selecting_headers))
-                
-                # add to the cache
-                header_values = [request.headers.get(h, '')
-                                 for h in uricache.selecting_headers]
-                uricache[tuple(sorted(header_values))] = variant
-                self.tot_puts += 1
-                self.cursize = total_size
+            # add to the cache (eviction may have dropped an emptied uricache)
+            self._store_uri(uri, uricache)
+            uricache[variant_key] = variant
+            self.tot_puts += 1
+        finally:
+            self.lock.release()
+    
+    def add_encoding(self, encodings, coding, body):
+        """Keep an encoded form of the current variant, counting its size.
+        
+        Nothing is kept if the variant is no longer in the cache, or if
+        its size would then exceed maxobj_size; other entries are evicted
+        if need be to keep the cache within maxsize.
+        """
+        request = cherrypy.serving.request
+        uri = cherrypy.url(qs=request.query_string)
+        size = len(body)
+        self.lock.acquire()
+        try:
+            uricache = self.store.get(uri)
+            if uricache is None:
+                return
+            variant_key = _variant_key(request, uricache.selecting_headers)
+            variant = uricache.get(variant_key)
+            node = self.entries.get((uri, variant_key))
+            if (node is None or node[5] is not None or variant is None
+                or isinstance(variant, threading._Event)
+                or len(variant) < 5 or variant[4] is not encodings):
+                # Replaced or dropped since it was served (or spilled).
+                return
+            if node[3] + size >= self.maxobj_size or size >= self.maxsize:
+                return
+            
+            # Take the entry out of the LRU list so it isn't evicted itself.
+            self._unlink(node)
+            self._make_room(size, None, objects=0)
+            self._link(node)
+            node[3] += size
+            self.cursize += size
+            encodings[coding] = body
+        finally:
+            self.lock.release()
     
     def delete(self):
         """Remove ALL cached variants of the current resource."""
         uri = cherrypy.url(qs=cherrypy.serving.request.query_string)
-        self.store.pop(uri, None)
+        self.lock.acquire()
+        try:
+            uricache = self._drop_uri(uri)
+            if uricache is not None:
+                for variant_key in list(uricache.keys()):
+                    self._forget((uri, variant_key))
+        finally:
+            self.lock.release()
+    
+    def purge_tags(self, *tags):
+        """Remove all cached variants tagged with any of the given tags.
+        
+        Return the number of variants removed.
+        """
+        count = 0
+        self.lock.acquire()
+        try:
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+                    count += 1
+        finally:
+            self.lock.release()
+        return count
+    
+    def purge_prefix(self, prefix):
+        """Remove all cached variants of URIs which start with the given prefix.
+        
+        The prefix may be an absolute URL, or a path which will be passed to
+        cherrypy.url. Return the number of variants removed.
+        """
+        if '://' not in prefix:
+            prefix = cherrypy.url(prefix)
+        count = 0
+        self.lock.acquire()
+        try:
+            uris = self.uris
+            i = bisect.bisect_left(uris, prefix)
+            end = i
+            while end < len(uris) and uris[end].startswith(prefix):
+                end += 1
+            for uri in uris[i:end]:
+                uricache = self._drop_uri(uri)
+                for variant_key in list(uricache.keys()):
+                    if (uri, variant_key) in self.entries:
+                        self._forget((uri, variant_key))
+                        count += 1
+        finally:
+            self.lock.release()
+        return count
+
+
+# -------------------------------- File Cache -------------------------------- #
+
+
+class FileCache(Cache):
+    """A cache for varying response content, shared by all local processes.
+    
+    Responses are pickled into files below ``storage_path``, which every
+    process must be configured to share. Each URI gets its own directory,
+    holding a ``vary`` file with its selecting header names, and one file
+    per variant. Files are written under a temporary name and renamed into
+    place, so a reader never sees a partial entry. The modification time
+    of each variant file is its expiration time, and its access time is
+    bumped on every hit, so that :meth:`sweep` can expire entries and
+    evict the least recently used ones without reading them.
+    
+    While a process calculates a missing variant, it holds a lock file
+    beside it; other processes poll for the finished entry for up to
+    ``antistampede_timeout`` seconds rather than calculating it themselves.
+    """
+    
+    storage_path = None
+    """The directory in which to store cached responses (required)."""
+    
+    maxobj_size = 100000
+    """The maximum size of each cached object in bytes; defaults to 100 KB."""
+    
+    maxsize = 10000000
+    """The maximum size of the entire cache in bytes; defaults to 10 MB."""
+    
+    delay = 600
+    """Seconds until the cached content expires; defaults to 600 (10 minutes)."""
+    
+    stale_while_revalidate = 0
+    """Seconds past ``delay`` during which an expired response is still served
+    while a single background request refreshes it; defaults to 0."""
+    
+    stale_if_error = 0
+    """Seconds past ``delay`` during which an expired response is served in
+    place of a server error from the handler; defaults to 0."""
+    
+    antistampede_timeout = 5
+    """Seconds to wait for other processes to release a cache lock."""
+    
+    poll_freq = 0.05
+    """Seconds to sleep between checks for a variant another process holds."""
+    
+    expire_freq = 5
+    """Seconds to sleep between sweeps of the storage directory."""
+    
+    LOCK_SUFFIX = '.lock'
+    TEMP_PREFIX = '.tmp-'
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+    debug = False
+    
+    def __init__(self):
+        # Don't touch the files here: other processes may be using them.
+        self._reset_counters()
+        
+        # Run self.expire_cache in a separate daemon thread.
+        t = threading.Thread(target=self.expire_cache, name='expire_cache')
+        self.expiration_thread = t
+        set_daemon(t, True)
+        t.start()
+    
+    def _reset_counters(self):
+        # These count the operations of this process only.
+        self.tot_puts = 0
+        self.tot_gets = 0
+        self.tot_hist = 0
+        self.tot_expires = 0
+        self.tot_evictions = 0
+        self.tot_non_modified = 0
+        # Updated by each sweep.
+        self.cursize = 0
+    
+    def clear(self):
+        """Reset the cache to its initial, empty state."""
+        self._reset_counters()
+        if self.storage_path and os.path.isdir(self.storage_path):
+            for fname in os.listdir(self.storage_path):
+                shutil.rmtree(os.path.join(self.storage_path, fname), True)
+    
+    def _uri_dir(self, uri):
+        return os.path.join(self.storage_path,
+                            md5(ntob(uri, 'utf-8')).hexdigest())
+    
+    def _variant_path(self, uridir, variant_key):
+        return os.path.join(uridir,
+                            md5(ntob(repr(variant_key), 'utf-8')).hexdigest())
+    
+    def _load(self, path):
+        try:
+            f = open(path, "rb")
+            try:
+                return pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError):
+            return None
+    
+    def _publish(self, path, obj, mtime=None):
+        """Atomically replace the file at the given path with obj."""
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix=self.TEMP_PREFIX)
+        f = os.fdopen(fd, "wb")
+        try:
+            pickle.dump(obj, f, self.pickle_protocol)
+        finally:
+            f.close()
+        if mtime is not None:
+            os.utime(tmppath, (time.time(), mtime))
+        try:
+            os.rename(tmppath, path)
+        except OSError:
+            # Windows won't rename over an existing file.
+            self._unlink(path)
+            os.rename(tmppath, path)
+    
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+            return True
+        except OSError:
+            return False
+    
+    def _acquire(self, path):
+        """Try to take the lock for calculating the given variant."""
+        lockpath = path + self.LOCK_SUFFIX
+        try:
+            os.close(os.open(lockpath, os.O_CREAT|os.O_WRONLY|os.O_EXCL))
+            return True
+        except OSError:
+            pass
+        
+        # A lock older than the antistampede_timeout is considered
+        # abandoned (its response may not have been cacheable at all),
+        # so remove it and let the next comer try again.
+        try:
+            if os.stat(lockpath).st_mtime + self.antistampede_timeout < time.time():
+                self._unlink(lockpath)
+        except OSError:
+            pass
+        return False
+    
+    def _wait(self, path):
+        """Return the unexpired variant at the given path, or None.
+        
+        If another process is calculating the variant, wait up to
+        antistampede_timeout seconds for it. If None is returned, the
+        caller holds the lock (if one could be taken) and should
+        calculate the variant itself.
+        """
+        timeout = self.antistampede_timeout
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            entry = self._load(path)
+            if entry is not None:
+                expiration_time, variant = entry
+                now = time.time()
+                if expiration_time > now:
+                    try:
+                        os.utime(path, (now, expiration_time))
+                    except OSError:
+                        pass
+                    return variant
+                if self._unlink(path):
+                    self.tot_expires += 1
+            
+            if timeout is None:
+                # Ignore any other process and recalc it ourselves.
+                return None
+            if self._acquire(path):
+                return None
+            if time.time() >= deadline:
+                if self.debug:
+                    cherrypy.log('Timed out', 'TOOLS.CACHING')
+                return None
+            time.sleep(self.poll_freq)
+    
+    def get(self):
+        """Return the current variant if in the cache, else None."""
+        request = cherrypy.serving.request
+        self.tot_gets += 1
+        
+        uridir = self._uri_dir(cherrypy.url(qs=request.query_string))
+        selecting_headers = self._load(os.path.join(uridir, 'vary'))
+        if selecting_headers is None:
+            return None
+        
+        path = self._variant_path(uridir,
+                                  _variant_key(request, selecting_headers))
+        variant = self._wait(path)
+        if variant is not None:
+            self.tot_hist += 1
+        return variant
+    
+    def put(self, variant, size):
+        """Store the current variant in the cache."""
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        
+        uridir = self._uri_dir(cherrypy.url(qs=request.query_string))
+        try:
+            if not os.path.isdir(uridir):
+                try:
+                    os.makedirs(uridir)
+                except OSError:
+                    # Another process may have just made it.
+                    if not os.path.isdir(uridir):
+                        raise
+            
+            varypath = os.path.join(uridir, 'vary')
+            selecting_headers = self._load(varypath)
+            if selecting_headers is None:
+                selecting_headers = [e.value for e in
+                                     response.headers.elements('Vary')]
+                self._publish(varypath, selecting_headers)
+            
+            path = self._variant_path(uridir,
+                                      _variant_key(request, selecting_headers))
+            try:
+                if size < self.maxobj_size and size < self.maxsize:
+                    expiration_time = (response.time + self.delay +
+                                       max(_stale_windows(self, response.headers)))
+                    self._publish(path, (expiration_time, variant),
+                                  expiration_time)
+                    self.tot_puts += 1
+            finally:
+                self._unlink(path + self.LOCK_SUFFIX)
+        except (IOError, OSError):
+            # The directory may have been deleted out from under us.
+            if self.debug:
+                cherrypy.log('Could not store %r' % uridir, 'TOOLS.CACHING')
+    
+    def delete(self):
+        """Remove ALL cached variants of the current resource."""
+        uri = cherrypy.url(qs=cherrypy.serving.request.query_string)
+        shutil.rmtree(self._uri_dir(uri), True)
+    
+    def sweep(self, now=None):
+        """Remove expired entries, then the least recently used ones
+        until the total size is no more than maxsize.
+        
+        The directory of a URI (and its ``vary`` file) is removed along
+        with its last variant.
+        """
+        if now is None:
+            now = time.time()
+        live = []
+        cursize = 0
+        # {uridir: [number of live variants, size of its vary file]}
+        uridirs = {}
+        for dirname in os.listdir(self.storage_path):
+            uridir = os.path.join(self.storage_path, dirname)
+            try:
+                fnames = os.listdir(uridir)
+            except OSError:
+                continue
+            count = varysize = 0
+            for fname in fnames:
+                if fname.endswith(self.LOCK_SUFFIX):
+                    continue
+                path = os.path.join(uridir, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if fname == 'vary':
+                    varysize = st.st_size
+                elif fname.startswith(self.TEMP_PREFIX):
+                    # Left behind by a process which died mid-write.
+                    if st.st_mtime + self.delay < now:
+                        self._unlink(path)
+                elif st.st_mtime <= now:
+                    if self._unlink(path):
+                        self.tot_expires += 1
+                else:
+                    live.append((st.st_atime, st.st_size, path))
+                    cursize += st.st_size
+                    count += 1
+            if count:
+                uridirs[uridir] = [count, varysize]
+                cursize += varysize
+            else:
+                self._remove_uri_dir(uridir)
+        
+        if cursize > self.maxsize:
+            live.sort()
+            for atime, size, path in live:
+                if cursize <= self.maxsize:
+                    break
+                if self._unlink(path):
+                    self.tot_evictions += 1
+                cursize -= size
+                uridir = os.path.dirname(path)
+                entry = uridirs[uridir]
+                entry[0] -= 1
+                if not entry[0]:
+                    self._remove_uri_dir(uridir)
+                    cursize -= entry[1]
+        self.cursize = cursize
+    
+    def _remove_uri_dir(self, uridir):
+        """Remove the vary file and directory of a URI with no variants."""
+        self._unlink(os.path.join(uridir, 'vary'))
+        try:
+            # This fails (harmlessly) if another process is storing a
+            # variant in it, or holds a lock there; its put will store
+            # a new vary file.
+            os.rmdir(uridir)
+        except OSError:
+            pass
+    
+    def expire_cache(self):
+        """Continuously sweep the storage directory.
+        
+        This function is designed to be run in its own daemon thread,
+        referenced at ``self.expiration_thread``.
+        """
+        # It's possible that "time" will be set to None
+        # arbitrarily, so we check "while time" to avoid exceptions.
+        # See tickets #99 and #180 for more information.
+        while time:
+            if self.storage_path and os.path.isdir(self.storage_path):
+                try:
+                    self.sweep()
+                except OSError:
+                    pass
+            time.sleep(self.expire_freq)
+
+
+# ----------------------------- Validator Cache ------------------------------ #
+
+
+class ValidatorCache(object):
+    """Remembers the last ETag and Last-Modified sent for each variant.
+    
+    Each key in self.store is a URI, and each value is a tuple of
+    (selecting_headers, variants), where variants maps the variant key
+    (see :func:`_variant_key`) to a tuple of (etag, last_modified,
+    expiration_time). Unlike MemoryCache, no response bodies are kept.
+    
+    Expiration times are kept in a heap, from which expired validators
+    are forgotten on each put; when the cache is full, those which expire
+    soonest make room for new ones.
+    """
+    
+    maxobjects = 10000
+    """The maximum number of remembered variants; defaults to 10000."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+    
+    def clear(self):
+        """Forget all validators."""
+        self.store = {}
+        self.count = 0
+        # A heap of (expiration_time, uri, variant key) tuples.
+        self.expirations = []
+    
+    def _drop(self, item):
+        """Forget the validators of the given heap item, unless they were
+        replaced or forgotten since it was pushed. Caller holds self.lock.
+        
+        Return True if they were forgotten.
+        """
+        expiration_time, uri, variant_key = item
+        entry = self.store.get(uri)
+        if entry is None:
+            return False
+        variants = entry[1]
+        validators = variants.get(variant_key)
+        if validators is None or validators[2] != expiration_time:
+            return False
+        del variants[variant_key]
+        self.count -= 1
+        if not variants:
+            del self.store[uri]
+        return True
+    
+    def _expire(self, now):
+        """Forget all expired validators. Caller holds self.lock."""
+        expirations = self.expirations
+        while expirations and expirations[0][0] <= now:
+            self._drop(heapq.heappop(expirations))
+    
+    def _evict(self):
+        """Forget the validators which expire soonest. Caller holds self.lock.
+        
+        Return False if there were none to forget.
+        """
+        expirations = self.expirations
+        while expirations:
+            if self._drop(heapq.heappop(expirations)):
+                return True
+        return False
+    
+    def get(self, uri):
+        """Return (etag, last_modified) for the current request, or None."""
+        entry = self.store.get(uri)
+        if entry is None:
+            return None
+        selecting_headers, variants = entry
+        validators = variants.get(_variant_key(cherrypy.serving.request,
+                                               selecting_headers))
+        if validators is None or validators[2] <= time.time():
+            return None
+        return validators[:2]
+    
+    def put(self, uri, etag, last_modified, ttl):
+        """Remember the given validators for the current variant.
+        
+        If maxobjects variants are already remembered, those which expire
+        soonest are forgotten to make room.
+        """
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self._expire(now)
+            entry = self.store.get(uri)
+            if entry is None:
+                selecting_headers = [e.value for e in
+                                     response.headers.elements('Vary')]
+            else:
+                selecting_headers = entry[0]
+            variant_key = _variant_key(request, selecting_headers)
+            if entry is None or variant_key not in entry[1]:
+                while self.count >= self.maxobjects and self._evict():
+                    pass
+                self.count += 1
+                # Eviction may have dropped the entry for this uri.
+                entry = self.store.get(uri)
+                if entry is None:
+                    entry = self.store[uri] = (selecting_headers, {})
+            expiration_time = now + ttl
+            entry[1][variant_key] = (etag, last_modified, expiration_time)
+            heapq.heappush(self.expirations, (expiration_time, uri, variant_key))
+        finally:
+            self.lock.release()
+    
+    def delete(self, uri=None):
+        """Forget the validators of all variants of the given URI.
+        
+        The uri may be an absolute URL, or a path which will be passed to
+        cherrypy.url. If None, the current resource is forgotten.
+        """
+        if uri is None:
+            uri = cherrypy.url(qs=cherrypy.serving.request.query_string)
+        elif '://' not in uri:
+            uri = cherrypy.url(uri)
+        self.lock.acquire()
+        try:
+            entry = self.store.pop(uri, None)
+            if entry is not None:
+                self.count -= len(entry[1])
+        finally:
+            self.lock.release()
+
+
+validator_cache = ValidatorCache()
+
+
+def validate(ttl=60, invalid_methods=("POST", "PUT", "DELETE"), debug=False):
+    """Answer conditional GETs with 304 before the handler runs, if possible.
+    
+    The ETag and Last-Modified response headers of each GET are remembered
+    in :data:`validator_cache` for ttl seconds (by record_validators, which
+    this attaches to before_finalize after the etags tool). While they are,
+    a request whose If-None-Match (or, lacking that, If-Modified-Since)
+    header matches them gets a 304 without invoking the handler at all.
+    
+    POST, PUT, or DELETE (the invalid_methods) make it forget the validators
+    of the resource; handlers which change a resource by other means should
+    call ``validator_cache.delete(uri)`` themselves.
+    """
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    
+    if request.method in invalid_methods:
+        if debug:
+            cherrypy.log('request.method %r in invalid_methods %r' %
+                         (request.method, invalid_methods), 'TOOLS.VALIDATE')
+        validator_cache.delete()
+        return
+    if request.method not in ("GET", "HEAD"):
+        return
+    
+    request.hooks.attach('before_finalize', record_validators,
+                         priority=76, ttl=ttl)
+    
+    uri = cherrypy.url(qs=request.query_string)
+    validators = validator_cache.get(uri)
+    if validators is None:
+        if debug:
+            cherrypy.log('No validators for %r' % uri, 'TOOLS.VALIDATE')
+        return
+    
+    etag, lastmod = validators
+    conditions = [str(x) for x in request.headers.elements('If-None-Match')]
+    if conditions:
+        # If-Modified-Since is ignored when If-None-Match is present.
+        # Compare weakly, as tools.etags does.
+        matched = conditions == ["*"] or (
+            etag and cptools._opaque_tag(etag) in
+            [cptools._opaque_tag(c) for c in conditions])
+    else:
+        since = request.headers.get('If-Modified-Since')
+        matched = since and since == lastmod
+    if matched:
+        if debug:
+            cherrypy.log('Validators match; not running the handler',
+                         'TOOLS.VALIDATE')
+        request.validators_matched = True
+        if etag:
+            response.headers['ETag'] = etag
+        raise cherrypy.HTTPRedirect([], 304)
+
+
+def record_validators(ttl=60):
+    """Remember the validators of the current response. Internal."""
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    if getattr(request, 'validators_matched', False):
+        # Don't extend the ttl of validators we answered from.
+        return
+    
+    # Only a full response carries all of the validators; a 304 (from
+    # tools.etags, say) may lack its Last-Modified header.
+    if httputil.valid_status(response.status)[0] != 200:
+        return
+    etag = response.headers.get('ETag') or getattr(response, 'ETag', None)
+    lastmod = response.headers.get('Last-Modified')
+    if etag or lastmod:
+        validator_cache.put(cherrypy.url(qs=request.query_string),
+                            etag, lastmod, ttl)
+
+
+# Keys of the stale variants which are being refreshed in this process.
+_refreshing = {}
+_refreshing_lock = threading.Lock()
+
+
+def _end_refresh(key):
+    _refreshing_lock.acquire()
+    try:
+        _refreshing.pop(key, None)
+    finally:
+        _refreshing_lock.release()
+
+
+def _replay(app, environ, key):
+    """Run the given request through the app again, discarding its output.
+    
+    This is designed to be run in its own daemon thread; the caching tool
+    of the replayed request stores its fresh response in the cache.
+    """
+    try:
+        try:
+            def start_response(status, headers, exc_info=None):
+                return lambda data: None
+            output = app(environ, start_response)
+            try:
+                for chunk in output:
+                    pass
+            finally:
+                if hasattr(output, 'close'):
+                    output.close()
+        except:
+            cherrypy.log('Could not refresh %r' % (key,), 'TOOLS.CACHING',
+                         traceback=True)
+    finally:
+        _end_refresh(key)
+
+
+def _refresh_stale(headers):
+    """Make sure one refresh of the current (stale) variant is under way.
+    
+    Return True if the stale copy may be served to the current request,
+    because a refresh was already running or has been started in the
+    background. Return False if the current request cannot be replayed
+    (it has no WSGI environ), and so must refresh the variant itself.
+    """
+    request = cherrypy.serving.request
+    selecting_headers = [v.strip() for v in
+                         (dict.get(headers, 'Vary') or '').split(',')
+                         if v.strip()]
+    key = (cherrypy.url(qs=request.query_string),
+           _variant_key(request, selecting_headers))
+    _refreshing_lock.acquire()
+    try:
+        if key in _refreshing:
+            return True
+        _refreshing[key] = True
+    finally:
+        _refreshing_lock.release()
+    
+    environ = getattr(request, 'wsgi_environ', None)
+    if environ is None:
+        request.hooks.attach('on_end_request', _end_refresh, key=key)
+        return False
+    
+    # Replay a plain, unconditional GET of the same resource and variant.
+    # The server's own keys belong to the original connection.
+    environ = dict([(k, v) for k, v in environ.items()
+                    if not k.startswith('wsgiserver.')])
+    for name in ('HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH',
+                 'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE',
+                 'HTTP_IF_RANGE', 'HTTP_RANGE',
+                 'HTTP_CACHE_CONTROL', 'HTTP_PRAGMA'):
+        environ.pop(name, None)
+    environ['REQUEST_METHOD'] = 'GET'
+    environ['CONTENT_LENGTH'] = '0'
+    environ['wsgi.input'] = BytesIO()
+    environ['cherrypy.caching.refresh'] = True
+    # No client made the replayed request, so it isn't in the access log.
+    environ['cherrypy.log.access'] = False
+    t = threading.Thread(target=_replay, args=(request.app, environ, key),
+                         name='refresh_cache')
+    set_daemon(t, True)
+    t.start()
+    return True
+
+
+def _restore_headers(cached_headers, age):
+    """Set response.headers to a copy of the given cached headers."""
+    # Copy the response headers. See http://www.cherrypy.org/ticket/721.
+    response = cherrypy.serving.response
+    response.headers = rh = httputil.HeaderMap()
+    for k in cached_headers:
+        dict.__setitem__(rh, k, dict.__getitem__(cached_headers, k))
+    
+    # Add the required Age header
+    rh["Age"] = str(age)
 
 
 def get(invalid_methods=("POST", "PUT", "DELETE"), debug=False, **kwargs):
@@ -284,7 +1313,13 @@ def get(invalid_methods=("POST", "PUT", "DELETE"), debug=False, **kwargs):
     otherwise:
         * sets request.cached = False
         * sets request.cacheable = True
+        * sets request.stale_cache_data if an expired copy may be served
+          in place of a server error (see serve_stale)
         * returns False
+    
+    An expired copy within its stale-while-revalidate window is served as if
+    it were fresh (with a Warning header), while one background request
+    refreshes it.
     """
     request = cherrypy.serving.request
     response = cherrypy.serving.response
@@ -314,12 +1349,20 @@ def get(invalid_methods=("POST", "PUT", "DELETE"), debug=False, **kwargs):
         request.cacheable = True
         return False
     
+    environ = getattr(request, 'wsgi_environ', None)
+    if environ and environ.get('cherrypy.caching.refresh'):
+        # A background refresh of a stale response; see _refresh_stale.
+        request.cached = False
+        request.cacheable = True
+        return False
+    
     cache_data = cherrypy._cache.get()
     request.cached = bool(cache_data)
     request.cacheable = not request.cached
     if request.cached:
         # Serve the cached copy.
         max_age = cherrypy._cache.delay
+        client_max_age = False
         for v in [e.value for e in request.headers.elements('Cache-Control')]:
             atoms = v.split('=', 1)
             directive = atoms.pop(0)
@@ -327,6 +1370,7 @@ def get(invalid_methods=("POST", "PUT", "DELETE"), debug=False, **kwargs):
                 if len(atoms) != 1 or not atoms[0].isdigit():
                     raise cherrypy.HTTPError(400, "Invalid Cache-Control header")
                 max_age = int(atoms[0])
+                client_max_age = True
                 break
             elif directive == 'no-cache':
                 if debug:
@@ -338,23 +1382,30 @@ def get(invalid_methods=("POST", "PUT", "DELETE"), debug=False, **kwargs):
         
         if debug:
             cherrypy.log('Reading response from cache', 'TOOLS.CACHING')
-        s, h, b, create_time = cache_data
+        s, h, b, create_time = cache_data[:4]
         age = int(response.time - create_time)
         if (age > max_age):
-            if debug:
-                cherrypy.log('Ignoring cache due to age > %d' % max_age,
-                             'TOOLS.CACHING')
-            request.cached = False
-            request.cacheable = True
-            return False
-        
-        # Copy the response headers. See http://www.cherrypy.org/ticket/721.
-        response.headers = rh = httputil.HeaderMap()
-        for k in h:
-            dict.__setitem__(rh, k, dict.__getitem__(h, k))
+            stale_while_revalidate, stale_if_error = _stale_windows(
+                cherrypy._cache, h)
+            if (not client_max_age and age <= max_age + stale_while_revalidate
+                and _refresh_stale(h)):
+                if debug:
+                    cherrypy.log('Serving stale response while it is refreshed',
+                                 'TOOLS.CACHING')
+            else:
+                if debug:
+                    cherrypy.log('Ignoring cache due to age > %d' % max_age,
+                                 'TOOLS.CACHING')
+                if age <= max_age + stale_if_error:
+                    # Serve it anyway if the handler fails; see serve_stale.
+                    request.stale_cache_data = cache_data
+                request.cached = False
+                request.cacheable = True
+                return False
         
-        # Add the required Age header
-        response.headers["Age"] = str(age)
+        _restore_headers(h, age)
+        if (age > max_age):
+            response.headers["Warning"] = '110 - "Response is Stale"'
         
         try:
             # Note that validate_since depends on a Last-Modified header;
@@ -370,18 +1421,58 @@ def get(invalid_methods=("POST", "PUT", "DELETE"), debug=False, **kwargs):
         # serve it & get out from the request
         response.status = s
         response.body = b
+        if isinstance(b, SpilledBody):
+            # Don't let finalize() collapse it onto the heap to measure it.
+            response.headers['Content-Length'] = str(len(b))
+        if len(cache_data) > 4:
+            # Let encoding tools (like gzip) reuse the encoded forms
+            # stored with this variant instead of re-encoding it.
+            request.cached_encodings = cache_data[4]
     else:
         if debug:
             cherrypy.log('request is not cached', 'TOOLS.CACHING')
     return request.cached
 
 
+def serve_stale():
+    """Serve the stale cached copy in place of a server error. Internal.
+    
+    The caching tool attaches this to the request hooks when a cached
+    response has expired, but is still within its stale-if-error window.
+    """
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    cache_data = getattr(request, 'stale_cache_data', None)
+    if cache_data is None or httputil.valid_status(response.status)[0] < 500:
+        return
+    
+    if getattr(cherrypy._cache, 'debug', False):
+        cherrypy.log('Serving stale response in place of %s' % response.status,
+                     'TOOLS.CACHING')
+    s, h, b, create_time = cache_data[:4]
+    _restore_headers(h, int(response.time - create_time))
+    response.headers["Warning"] = '111 - "Revalidation Failed"'
+    response.status = s
+    response.body = b
+    if isinstance(b, SpilledBody):
+        response.headers['Content-Length'] = str(len(b))
+    if len(cache_data) > 4:
+        request.cached_encodings = cache_data[4]
+    request.cached = True
+    request.cacheable = False
+
+
 def tee_output():
-    """Tee response output to cache storage. Internal."""
+    """Tee response output to cache storage. Internal.
+    
+    Cached variants are tuples of (status, headers, body, time, encodings),
+    where body has no content-coding applied, and encodings is a dict of
+    {content-coding: encoded body} which may be extended on later hits.
+    """
     # Used by CachingTool by attaching to request.hooks
     
     request = cherrypy.serving.request
-    if 'no-store' in request.headers.values('Cache-Control'):
+    if request.cached or 'no-store' in request.headers.values('Cache-Control'):
         return
     
     def tee(body):
@@ -394,18 +1485,62 @@ def tee_output():
         
         output = []
         for chunk in body:
-            output.append(chunk)
+            if isinstance(chunk, basestring):
+                output.append(chunk)
+            else:
+                # A view (onto a memory-mapped file, say); keep a copy.
+                output.append(bytestr(chunk))
             yield chunk
         
         # save the cache data
         body = ntob('').join(output)
-        cherrypy._cache.put((response.status, response.headers or {},
-                             body, response.time), len(body))
+        headers = response.headers or {}
+        encodings = {}
+        coding = headers.get('Content-Encoding')
+        if coding:
+            if coding not in ('gzip', 'x-gzip'):
+                # We only know how to store gzipped bodies unencoded.
+                return
+            # Partial content is only a piece of a gzip stream (or, for
+            # multipart/byteranges, not a gzip stream at all).
+            ct = headers.get('Content-Type', '')
+            if (httputil.valid_status(response.status)[0] != 200 or
+                'Content-Range' in headers or ct.startswith('multipart/')):
+                return
+            # Store the canonical (unencoded) body so that any client can
+            # be served from the same entry, and retain the gzipped form
+            # so that gzip-accepting clients don't cost us any zlib time.
+            from cherrypy.lib.encoding import decompress
+            encodings['gzip'] = body
+            try:
+                body = decompress(body)
+            except (IOError, EOFError, struct.error, zlib.error):
+                # A corrupt body just isn't cached.
+                return
+            headers = httputil.HeaderMap()
+            for k in response.headers:
+                if k not in ('Content-Encoding', 'Content-Length'):
+                    dict.__setitem__(headers, k,
+                                     dict.__getitem__(response.headers, k))
+        size = len(body) + len(encodings.get('gzip', ''))
+        cherrypy._cache.put((response.status, headers, body, response.time,
+                             encodings), size)
     
     response = cherrypy.serving.response
     response.body = tee(response.body)
 
 
+def tag(*tags):
+    """Label the current response with the given cache tags.
+    
+    When the response is stored by the caching tool, it is indexed under
+    each tag, so that all of the variants derived from (say) one database
+    row can be removed with ``cherrypy._cache.purge_tags(tag)``.
+    """
+    request = cherrypy.serving.request
+    request.cache_tags = tuple(getattr(request, 'cache_tags', ())) + tags
+
+
 def expires(secs=0, force=False, debug=False):
     """Tool for influencing cache mechanisms using the 'Expires' header.
 
@@ -1,6 +1,7 @@
 import datetime
 import gzip
 from itertools import count
+import logging
 import os
 curdir = os.path.join(os.getcwd(), os.path.dirname(__file__))
 import sys
@@ -31,6 +32,12 @@ class CacheTest(helper.CPWebCase):
             def __init__(self):
                 self.counter = 0
                 self.control_counter = 0
+                self.lru_counter = 0
+                self.shared_counter = 0
+                self.stale_counter = 0
+                self.stale_environs = []
+                self.large_counter = 0
+                self.tagged_counter = 0
                 self.longlock = threading.Lock()
             
             def index(self):
@@ -58,6 +65,47 @@ class CacheTest(helper.CPWebCase):
                 return 'success!'
             long_process.exposed = True
             
+            def lru(self, name):
+                self.lru_counter += 1
+                return "%s #%s" % (name, self.lru_counter)
+            lru.exposed = True
+            
+            def shared(self, name):
+                self.shared_counter += 1
+                return "%s #%s" % (name, self.shared_counter)
+            shared.exposed = True
+            
+            def stale(self, directive):
+                failure = cherrypy.request.headers.get('X-Fail')
+                if failure == 'error':
+                    raise ValueError("handler failed")
+                elif failure:
+                    raise cherrypy.HTTPError(503)
+                self.stale_counter += 1
+                self.stale_environs.append(cherrypy.request.wsgi_environ)
+                cherrypy.response.headers['Cache-Control'] = directive + '=30'
+                return "visit #%s" % self.stale_counter
+            stale.exposed = True
+            
+            def large(self, n):
+                self.large_counter += 1
+                return ntob(str(self.large_counter)) * int(n)
+            large.exposed = True
+            
+            def tagged(self, *rows):
+                from cherrypy.lib import caching
+                caching.tag(*['row-%s' % row for row in rows])
+                self.tagged_counter += 1
+                return "visit #%s" % self.tagged_counter
+            tagged.exposed = True
+            
+            def purge(self, tag=None, prefix=None):
+                if tag:
+                    return str(cherrypy._cache.purge_tags(tag))
+                return str(cherrypy._cache.purge_prefix(prefix))
+            purge.exposed = True
+            purge._cp_config = {'tools.caching.on': False}
+            
             def clear_cache(self, path):
                 cherrypy._cache.store[cherrypy.request.base + path].clear()
             clear_cache.exposed = True
@@ -120,6 +168,15 @@ class CacheTest(helper.CPWebCase):
         cherrypy.tree.mount(Root())
         cherrypy.tree.mount(UnCached(), "/expires")
         cherrypy.tree.mount(VaryHeaderCachingServer(), "/varying_headers")
+        
+        class GzStatic(object):
+            _cp_config = {'tools.caching.on': True,
+                          'tools.staticdir.on': True,
+                          'tools.staticdir.dir': 'static',
+                          'tools.staticdir.root': curdir,
+                          'tools.staticdir.precompressed': True,
+                          }
+        cherrypy.tree.mount(GzStatic(), "/gzstatic")
         cherrypy.config.update({'tools.gzip.on': True})
     setup_server = staticmethod(setup_server)
 
@@ -165,10 +222,29 @@ class CacheTest(helper.CPWebCase):
         self.assertEqual(cherrypy.lib.encoding.decompress(self.body), ntob("visit #5"))
         
         # Now check that a third request that doesn't accept gzip
-        # skips the cache (because the 'Vary' header denies it).
+        # is served the unencoded body from the same cache entry.
         self.getPage("/", method="GET")
         self.assertNoHeader('Content-Encoding')
+        self.assertHeader('Vary', 'Accept-Encoding')
+        self.assertBody('visit #5')
+        
+        # Cache an unencoded response, then check that a client which
+        # accepts gzip gets it compressed (from the same entry).
+        self.getPage("/", method="POST")
         self.assertBody('visit #6')
+        self.getPage("/", method="GET")
+        self.assertNoHeader('Content-Encoding')
+        self.assertBody('visit #7')
+        cursize = cherrypy._cache.cursize
+        for trial in range(2):
+            self.getPage("/", method="GET",
+                         headers=[('Accept-Encoding', 'gzip')])
+            self.assertHeader('Content-Encoding', 'gzip')
+            self.assertHeader('Age')
+            self.assertEqual(cherrypy.lib.encoding.decompress(self.body),
+                             ntob("visit #7"))
+        # The gzipped form the entry gained counts against the cache size.
+        self.assertEqual(cherrypy._cache.cursize, cursize + len(self.body))
     
     def testVaryHeader(self):
         self.getPage("/varying_headers/")
@@ -326,4 +402,274 @@ class CacheTest(helper.CPWebCase):
         self.assertBody('visit #4')
         self.getPage("/control")
         self.assertBody('visit #4')
-
+    
+    def test_lru_eviction(self):
+        cache = cherrypy._cache
+        cache.clear()
+        cache.maxobjects = 2
+        try:
+            self.getPage("/lru?name=a")
+            self.assertBody('a #1')
+            self.getPage("/lru?name=b")
+            self.assertBody('b #2')
+            # Touch 'a', so 'b' becomes the least recently used.
+            self.getPage("/lru?name=a")
+            self.assertBody('a #1')
+            
+            # A full cache evicts 'b' to make room for 'c'.
+            self.getPage("/lru?name=c")
+            self.assertBody('c #3')
+            self.assertEqual(cache.tot_evictions, 1)
+            self.getPage("/lru?name=c")
+            self.assertBody('c #3')
+            self.getPage("/lru?name=a")
+            self.assertBody('a #1')
+            self.getPage("/lru?name=b")
+            self.assertBody('b #4')
+            
+            self.assertEqual(len(cache.entries), 2)
+            self.assertEqual(cache.cursize,
+                             sum([node[3] for node in cache.entries.values()]))
+            
+            # Expiring everything brings the accounting back to zero.
+            cache.expire(time.time() + cache.delay + 1)
+            self.assertEqual(cache.entries, {})
+            self.assertEqual(cache.store, {})
+            self.assertEqual(cache.cursize, 0)
+            self.getPage("/lru?name=a")
+            self.assertBody('a #5')
+        finally:
+            cache.maxobjects = cherrypy.lib.caching.MemoryCache.maxobjects
+    
+    def test_gzipped_ranges(self):
+        # The cache is created by the first cached request.
+        self.getPage("/varying_headers/")
+        cache = cherrypy._cache
+        cache.clear()
+        errors = []
+        collector = logging.Handler()
+        collector.emit = errors.append
+        logging.getLogger('cherrypy.error').addHandler(collector)
+        try:
+            # Ranges of a gzipped static file are pieces of a gzip stream
+            # (or multipart/byteranges), and must not be decompressed.
+            self.getPage("/gzstatic/index.html",
+                         headers=[('Accept-Encoding', 'gzip'),
+                                  ('Range', 'bytes=0-9')])
+            self.assertStatus(206)
+            self.assertHeader('Content-Encoding', 'gzip')
+            self.assertEqual(len(self.body), 10)
+            self.getPage("/gzstatic/index.html",
+                         headers=[('Accept-Encoding', 'gzip'),
+                                  ('Range', 'bytes=0-1,-3')])
+            self.assertStatus(206)
+            # Give the server threads a moment to log any error at the end.
+            time.sleep(0.2)
+            self.assertEqual([r.getMessage() for r in errors], [])
+            self.assertEqual(cache.entries, {})
+            
+            # The whole file is stored, and served (unencoded) from cache.
+            self.getPage("/gzstatic/index.html",
+                         headers=[('Accept-Encoding', 'gzip')])
+            self.assertStatus(200)
+            self.assertNoHeader('Age')
+            # The entry is stored once the last chunk has gone out.
+            for trial in range(50):
+                if cache.entries:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(len(cache.entries), 1)
+            self.getPage("/gzstatic/index.html")
+            self.assertStatus(200)
+            self.assertHeader('Age')
+            self.assertBody('Hello, world\r\n')
+        finally:
+            logging.getLogger('cherrypy.error').removeHandler(collector)
+            cache.clear()
+    
+    def test_file_cache(self):
+        import shutil
+        import tempfile
+        from cherrypy.lib.caching import FileCache
+        
+        storage_path = tempfile.mkdtemp()
+        memcache = cherrypy._cache
+        try:
+            cherrypy._cache = cache = FileCache()
+            cache.storage_path = storage_path
+            self.getPage("/shared?name=shared")
+            self.assertBody('shared #1')
+            self.getPage("/shared?name=shared")
+            self.assertBody('shared #1')
+            self.assertEqual(cache.tot_puts, 1)
+            self.assertEqual(cache.tot_hist, 1)
+            
+            # Another process pointed at the same directory shares entries.
+            cherrypy._cache = other = FileCache()
+            other.storage_path = storage_path
+            self.getPage("/shared?name=shared")
+            self.assertBody('shared #1')
+            self.assertEqual(other.tot_hist, 1)
+            
+            # Sweeping evicts over maxsize, and expires all after the delay.
+            self.getPage("/shared?name=other")
+            self.assertBody('other #2')
+            other.sweep()
+            self.assertEqual(other.tot_evictions, 0)
+            total = other.cursize
+            other.maxsize = total - 1
+            other.sweep()
+            self.assertEqual(other.tot_evictions, 1)
+            self.assert_(other.cursize < total)
+            # The evicted URI's directory went with its last variant.
+            self.assertEqual(len(os.listdir(storage_path)), 1)
+            other.sweep(time.time() + other.delay + 1)
+            self.assertEqual(other.cursize, 0)
+            self.assertEqual(os.listdir(storage_path), [])
+            self.getPage("/shared?name=shared")
+            self.assertBody('shared #3')
+            
+            # POST invalidates the entry for everyone.
+            self.getPage("/shared?name=shared", method='POST')
+            self.assertBody('shared #4')
+            cherrypy._cache = cache
+            self.getPage("/shared?name=shared")
+            self.assertBody('shared #5')
+        finally:
+            cherrypy._cache = memcache
+            shutil.rmtree(storage_path, True)
+    
+    def test_stale(self):
+        cache = cherrypy._cache
+        cache.delay = 1
+        app = cherrypy.tree.apps['']
+        environs = app.root.stale_environs
+        del environs[:]
+        accesses = []
+        collector = logging.Handler()
+        collector.emit = accesses.append
+        app.log.access_log.addHandler(collector)
+        try:
+            # stale-while-revalidate
+            self.getPage("/stale?directive=stale-while-revalidate")
+            self.assertBody('visit #1')
+            time.sleep(2)
+            self.getPage("/stale?directive=stale-while-revalidate")
+            self.assertBody('visit #1')
+            self.assertHeader('Warning', '110 - "Response is Stale"')
+            # The background refresh replaces the stale copy.
+            for trial in range(20):
+                self.getPage("/stale?directive=stale-while-revalidate")
+                if self.body != ntob('visit #1'):
+                    break
+                time.sleep(0.1)
+            self.assertBody('visit #2')
+            self.assertNoHeader('Warning')
+            
+            # The replay is not the client's connection, and isn't logged.
+            replayed = environs[1]
+            self.assert_(replayed.get('cherrypy.caching.refresh'))
+            self.assertEqual([k for k in replayed
+                              if k.startswith('wsgiserver.')], [])
+            self.assert_('wsgiserver.bytes_sent' in environs[0])
+            self.assertEqual(len(accesses), trial + 3)
+            
+            # stale-if-error
+            self.getPage("/stale?directive=stale-if-error")
+            self.assertBody('visit #3')
+            time.sleep(2)
+            for failure in ('error', 'http'):
+                self.getPage("/stale?directive=stale-if-error",
+                             headers=[('X-Fail', failure)])
+                self.assertStatus(200)
+                self.assertBody('visit #3')
+                self.assertHeader('Warning', '111 - "Revalidation Failed"')
+            self.getPage("/stale?directive=stale-if-error")
+            self.assertBody('visit #4')
+            self.assertNoHeader('Warning')
+        finally:
+            app.log.access_log.removeHandler(collector)
+            cache.delay = cherrypy.lib.caching.MemoryCache.delay
+    
+    def test_spill(self):
+        import shutil
+        import tempfile
+        
+        cache = cherrypy._cache
+        cache.clear()
+        spill_path = tempfile.mkdtemp()
+        cache.spill_path = spill_path
+        cache.spill_maxsize = 250000
+        try:
+            self.getPage("/large?n=100000")
+            self.assertBody(ntob('1') * 100000)
+            self.assertEqual(cache.cursize, 0)
+            self.assertEqual(cache.spillsize, 100000)
+            
+            # Served from the memory-mapped file, with its length.
+            self.getPage("/large?n=100000")
+            self.assertBody(ntob('1') * 100000)
+            self.assertHeader('Content-Length', '100000')
+            
+            # Small responses still go into RAM.
+            self.getPage("/large?n=10")
+            self.assertBody(ntob('2') * 10)
+            self.assertEqual(cache.cursize, 10)
+            
+            # A full spill tier evicts its own least recently used entries.
+            self.getPage("/large?n=100001")
+            self.assertBody(ntob('3') * 100001)
+            self.getPage("/large?n=100002")
+            self.assertBody(ntob('4') * 100002)
+            self.assertEqual(cache.tot_evictions, 1)
+            self.assertEqual(cache.spillsize, 200003)
+            self.assertEqual(cache.cursize, 10)
+            self.getPage("/large?n=10")
+            self.assertBody(ntob('2') * 10)
+            self.getPage("/large?n=100000")
+            self.assertBody(ntob('5') * 100000)
+            
+            # Too big even for the spill tier.
+            self.getPage("/large?n=300000")
+            self.getPage("/large?n=300000")
+            self.assertBody(ntob('7') * 300000)
+        finally:
+            cache.clear()
+            for name in ('spill_path', 'spill_maxsize'):
+                setattr(cache, name,
+                        getattr(cherrypy.lib.caching.MemoryCache, name))
+            shutil.rmtree(spill_path, True)
+    
+    def test_purge(self):
+        cherrypy._cache.clear()
+        self.getPage("/tagged/1")
+        self.assertBody('visit #1')
+        self.getPage("/tagged/1/2")
+        self.assertBody('visit #2')
+        self.getPage("/tagged/3")
+        self.assertBody('visit #3')
+        self.getPage("/lru?name=untagged")
+        
+        # Purge by tag
+        self.getPage("/purge?tag=row-1")
+        self.assertBody('2')
+        self.getPage("/tagged/1")
+        self.assertBody('visit #4')
+        self.getPage("/tagged/1/2")
+        self.assertBody('visit #5')
+        self.getPage("/tagged/3")
+        self.assertBody('visit #3')
+        self.getPage("/purge?tag=row-1")
+        self.assertBody('2')
+        self.getPage("/purge?tag=row-1")
+        self.assertBody('0')
+        
+        # Purge by prefix
+        self.getPage("/purge?prefix=/tagged/")
+        self.assertBody('1')
+        self.getPage("/tagged/3")
+        self.assertBody('visit #6')
+        self.assertEqual(len(cherrypy._cache.entries), 2)
+        self.assertEqual(sorted(cherrypy._cache.tags.keys()), ['row-3'])
+        self.assertEqual(cherrypy._cache.uris,
+                         sorted(cherrypy._cache.store.keys()))
@@ -218,6 +218,9 @@ class CoreRequestHandlingTest(helper.CPWebCase):
             def as_refyield(self):
                 for chunk in self.as_yield():
                     yield chunk
+            
+            def as_manychunks(self):
+                return [ntob("x") * 1000] * 200 + [ntob("y") * 70000, ntob("z")]
         
         
         class Ranges(Test):
@@ -419,6 +422,15 @@ class CoreRequestHandlingTest(helper.CPWebCase):
                     "/flatten/as_refyield"]:
             self.getPage(url)
             self.assertBody('content')
+        
+        self.getPage("/flatten/as_manychunks")
+        self.assertHeader('Content-Length', str(200000 + 70001))
+        self.assertBody(ntob("x") * 200000 + ntob("y") * 70000 + ntob("z"))
+        
+        from cherrypy.lib import coalesce_chunks
+        chunks = list(coalesce_chunks([ntob("ab")] * 3 + [ntob("c") * 10],
+                                      bufsize=5))
+        self.assertEqual(chunks, [ntob("abab"), ntob("ab"), ntob("c") * 10])
     
     def testRanges(self):
         self.getPage("/ranges/get_ranges?bytes=3-6")
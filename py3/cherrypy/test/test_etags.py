@@ -1,4 +1,6 @@
 import cherrypy
+from cherrypy._cpcompat import md5, ntob
+from cherrypy.lib import cptools
 from cherrypy.test import helper
 
 
@@ -18,12 +20,48 @@ class ETagTest(helper.CPWebCase):
                     raise cherrypy.HTTPError(code)
             fail.exposed = True
             
+            def streamed(self, size, version=None):
+                if version:
+                    cherrypy.response.etag_version = version
+                def content():
+                    for i in range(int(size)):
+                        yield ntob("x") * 100
+                return content()
+            streamed.exposed = True
+            streamed._cp_config = {'response.stream': True,
+                                   'tools.etags.autotags_max_size': 1000}
+            
             def unicoded(self):
                 return 'I am a \u1ee4nicode string.'
             unicoded.exposed = True
             # In Python 3, tools.encode is on by default
             # unicoded._cp_config = {'tools.encode.on': True}
         
+        class Validated:
+            _cp_config = {'tools.validate.on': True}
+            
+            def __init__(self):
+                self.counter = 0
+            
+            def index(self):
+                self.counter += 1
+                cherrypy.response.headers['Last-Modified'] = \
+                    'Mon, 01 Jan 2001 00:00:00 GMT'
+                return "visit #%s" % self.counter
+            index.exposed = True
+            
+            def count(self):
+                return str(self.counter)
+            count.exposed = True
+            count._cp_config = {'tools.validate.on': False}
+            
+            def fixed(self):
+                cherrypy.response.headers['Last-Modified'] = \
+                    'Mon, 01 Jan 2001 00:00:00 GMT'
+                return "fixed"
+            fixed.exposed = True
+        Root.validated = Validated()
+        
         conf = {'/': {'tools.etags.on': True,
                       'tools.etags.autotags': True,
                       }}
@@ -79,4 +117,104 @@ class ETagTest(helper.CPWebCase):
         self.getPage("/unicoded", headers=[('If-Match', etag1)])
         self.assertStatus(200)
         self.assertHeader('ETag', etag1)
-
+    
+    def test_validate(self):
+        self.getPage("/validated/")
+        self.assertBody('visit #1')
+        etag = self.assertHeader('ETag')
+        
+        # Answered from the validator cache without running the handler.
+        self.getPage("/validated/", headers=[('If-None-Match', etag)])
+        self.assertStatus(304)
+        self.assertHeader('ETag', etag)
+        self.getPage("/validated/", headers=[('If-Modified-Since',
+                                              'Mon, 01 Jan 2001 00:00:00 GMT')])
+        self.assertStatus(304)
+        self.getPage("/validated/count")
+        self.assertBody('1')
+        
+        # Mismatches run the handler.
+        self.getPage("/validated/", headers=[('If-None-Match', '"bogus"')])
+        self.assertStatus(200)
+        self.assertBody('visit #2')
+        
+        # POST invalidates the validators.
+        self.getPage("/validated/", method='POST')
+        self.assertBody('visit #3')
+        from cherrypy.lib import caching
+        self.assertEqual(caching.validator_cache.count, 0)
+        self.getPage("/validated/", headers=[('If-None-Match', etag)])
+        self.assertStatus(200)
+        self.getPage("/validated/count")
+        self.assertBody('4')
+        
+        # As does expiry.
+        caching.validator_cache.put(
+            list(caching.validator_cache.store.keys())[0], etag, None, -1)
+        self.getPage("/validated/", headers=[('If-None-Match', etag)])
+        self.assertStatus(200)
+        
+        # A 304 from the handler (which lacks Last-Modified) isn't recorded.
+        self.getPage("/validated/fixed")
+        etag = self.assertHeader('ETag')
+        uri = [u for u in caching.validator_cache.store
+               if u.endswith('/validated/fixed')][0]
+        caching.validator_cache.put(uri, etag, None, -1)
+        self.getPage("/validated/fixed", headers=[('If-None-Match', etag)])
+        self.assertStatus(304)
+        self.assertEqual(caching.validator_cache.get(uri), None)
+        
+        # A full cache forgets the validators which expire soonest.
+        cache = caching.ValidatorCache()
+        cache.maxobjects = 2
+        cache.put('http://example.com/1', '"1"', None, 30)
+        cache.put('http://example.com/2', '"2"', None, 10)
+        cache.put('http://example.com/3', '"3"', None, 20)
+        self.assertEqual(cache.count, 2)
+        self.assertEqual(sorted(cache.store.keys()),
+                         ['http://example.com/1', 'http://example.com/3'])
+    
+    def test_streamed_autotags(self):
+        # Small enough to buffer: a strong tag from the content.
+        self.getPage("/streamed?size=5")
+        self.assertBody(ntob("x") * 500)
+        etag = self.assertHeader('ETag')
+        self.assertFalse(etag.startswith('W/'))
+        self.getPage("/streamed?size=5", headers=[('If-None-Match', etag)])
+        self.assertStatus(304)
+        
+        # Too big to buffer: streamed untagged, or weakly tagged by version.
+        self.getPage("/streamed?size=50")
+        self.assertBody(ntob("x") * 5000)
+        self.assertNoHeader('ETag')
+        self.getPage("/streamed?size=50&version=3")
+        self.assertBody(ntob("x") * 5000)
+        etag = self.assertHeader('ETag')
+        self.assert_(etag.startswith('W/'))
+        self.getPage("/streamed?size=50&version=3",
+                     headers=[('If-None-Match', etag)])
+        self.assertStatus(304)
+        # Weak tags never satisfy If-Match.
+        self.getPage("/streamed?size=50&version=3",
+                     headers=[('If-Match', etag)])
+        self.assertStatus(412)
+    
+    def test_autotag_keeps_body(self):
+        class Chunks(object):
+            def __iter__(self):
+                return iter([ntob("a") * 10, ntob("b") * 10])
+        class Response(object):
+            stream = False
+        expected = '"%s"' % md5(ntob("a") * 10 + ntob("b") * 10).hexdigest()
+        
+        # A body which can be iterated over again (such as a spilled cache
+        # entry) is hashed in place, not copied onto the heap.
+        response = Response()
+        response.body = body = Chunks()
+        self.assertEqual(cptools._autotag(response, None), expected)
+        self.assert_(response.body is body)
+        
+        # A one-shot iterator has to be kept in a list to be served.
+        response.body = iter(Chunks())
+        self.assertEqual(cptools._autotag(response, None), expected)
+        self.assertEqual(response.body, [ntob("a") * 10, ntob("b") * 10])
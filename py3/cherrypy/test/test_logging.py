@@ -1,9 +1,12 @@
 """Basic tests for the CherryPy core: request handling."""
 
+import logging
 import os
 localDir = os.path.dirname(__file__)
+import time
 
 import cherrypy
+from cherrypy._cpcompat import json_decode
 
 access_log = os.path.join(localDir, "access.log")
 error_log = os.path.join(localDir, "error.log")
@@ -46,6 +49,15 @@ def setup_server():
             yield "content"
         as_yield.exposed = True
         
+        def streamed(self):
+            yield "content"
+        streamed.exposed = True
+        streamed._cp_config = {'response.stream': True}
+        
+        def posted(self, **kwargs):
+            return "ok"
+        posted.exposed = True
+        
         def error(self):
             raise ValueError()
         error.exposed = True
@@ -127,6 +139,116 @@ class AccessLogTests(helper.CPWebCase, logtest.LogCase):
         self.assertStatus(200)
         # Again, note the 'r' prefix.
         self.assertLog(-1, r'"Browzuh (1.0\r\n\t\t.3)"')
+    
+    def testAsync(self):
+        log = cherrypy.tree.apps[''].log
+        log.access_async = True
+        records = []
+        collector = logging.Handler()
+        collector.emit = records.append
+        log.access_log.addHandler(collector)
+        try:
+            self.markLog("async %r" % time.time())
+            self.getPage("/as_string")
+            self.assertStatus(200)
+            self.getPage("/as_yield")
+            self.assertStatus(200)
+            self.waitForLog(2, log)
+            self.assertLog(-2, '] "GET %s/as_string HTTP/1.1" 200'
+                           % self.prefix())
+            self.assertLog(-1, '] "GET %s/as_yield HTTP/1.1" 200'
+                           % self.prefix())
+            # Each message is its own record, even when written in a batch.
+            self.assertEqual(len(records), 2)
+            self.assertEqual([r.getMessage().count('\n') for r in records],
+                             [0, 0])
+            
+            # Records beyond the queue size are dropped, and counted.
+            log.access_writer.maxsize = 0
+            self.getPage("/as_string")
+            self.assertStatus(200)
+            self.assertEqual(log.access_writer.dropped, 1)
+        finally:
+            log.access_log.removeHandler(collector)
+            log.access_async = False
+            log.stop_access_writer()
+    
+    def testStructured(self):
+        log = cherrypy.tree.apps[''].log
+        try:
+            log.access_log_fields = ['method', 'path', 'status', 'bytes_sent',
+                                     'login', 'handler_time', 'total_time',
+                                     'header.X-Request-Id']
+            self.markLog("json %r" % time.time())
+            self.getPage("/as_string", headers=[('X-Request-Id', 'abc 123')])
+            self.assertStatus(200)
+            self.waitForLog(1)
+            self.assertLog(-1, '{"method": "GET", "path": "/as_string", '
+                           '"status": 200, ')
+            self.assertLog(-1, '"login": null, "handler_time": 0.')
+            self.assertLog(-1, '"header.X-Request-Id": "abc 123"}')
+            
+            log.access_log_style = 'logfmt'
+            self.markLog("logfmt %r" % time.time())
+            self.getPage("/as_string", headers=[('X-Request-Id', 'abc 123')])
+            self.waitForLog(1)
+            self.assertLog(-1, 'method=GET path=/as_string status=200 ')
+            self.assertLog(-1, ' login= handler_time=0.')
+            self.assertLog(-1, ' header.X-Request-Id="abc 123"')
+            
+            self.assertRaises(ValueError, setattr, log,
+                              'access_log_fields', ['nonesuch'])
+        finally:
+            log.access_log_fields = None
+            log.access_log_style = 'json'
+    
+    def testStructuredByteCounts(self):
+        log = cherrypy.tree.apps[''].log
+        try:
+            log.access_log_fields = ['path', 'bytes_read', 'bytes_sent']
+            self.markLog("byte counts %r" % time.time())
+            # Neither a chunked request nor a streamed response has a
+            # Content-Length, but their bytes are still counted.
+            self.getPage("/posted", method="POST",
+                         headers=[('Content-Type',
+                                   'application/x-www-form-urlencoded'),
+                                  ('Transfer-Encoding', 'chunked')],
+                         body="7\r\na=1&b=2\r\n0\r\n\r\n")
+            self.assertStatus(200)
+            self.getPage("/streamed")
+            self.assertBody("content")
+            self.assertHeader("Transfer-Encoding", "chunked")
+            # The two requests may close (and be logged) in either order.
+            records = [json_decode(line.decode('utf-8'))
+                       for line in self.waitForLog(2)]
+            records = dict([(r['path'], r) for r in records])
+            posted, streamed = records['/posted'], records['/streamed']
+            self.assertEqual(posted['bytes_read'], 7)
+            self.assertEqual(streamed['bytes_read'], 0)
+            if cherrypy.server.using_wsgi:
+                # The status line and headers are counted too.
+                chunk = "7\r\ncontent\r\n"
+                self.assertTrue(streamed['bytes_sent'] > len(chunk))
+                self.assertTrue(posted['bytes_sent'] > len("ok"))
+        finally:
+            log.access_log_fields = None
+    
+    def waitForLog(self, count, log=None, timeout=5):
+        """Return the marked log lines, once there are ``count`` of them.
+        
+        If a LogManager is given, its background access writer is flushed
+        before each look at the log.
+        """
+        # Access messages with bytes_sent are written as the request closes,
+        # which may be just after the client has read the response.
+        endtime = time.time() + timeout
+        while True:
+            if log is not None:
+                log.flush_access()
+            lines = self._read_marked_region()
+            if len(lines) >= count or time.time() > endtime:
+                return lines
+            time.sleep(0.01)
 
 
 class ErrorLogTests(helper.CPWebCase, logtest.LogCase):
@@ -146,4 +268,35 @@ class ErrorLogTests(helper.CPWebCase, logtest.LogCase):
             self.assertLog(-3, 'raise ValueError()')
         finally:
             ignore.pop()
+    
+    def testRepeatedTracebacks(self):
+        log = cherrypy.tree.apps[''].log
+        log.traceback_window = 60
+        ignore = helper.webtest.ignored_exceptions
+        ignore.append(ValueError)
+        try:
+            self.markLog()
+            for i in range(3):
+                self.getPage("/error")
+                self.assertStatus(500)
+            # Only the first traceback was logged.
+            self.assertLog(0, 'HTTP Traceback (most recent call last):')
+            tracebacks = [line for line in self._read_marked_region()
+                          if 'Traceback (most recent call last)' in line]
+            self.assertEqual(len(tracebacks), 1)
+            
+            log.summarize_tracebacks()
+            self.assertNotInLog('repeated')
+            log.summarize_tracebacks(force=True)
+            self.assertLog(-1, 'Traceback for ValueError at ')
+            self.assertLog(-1, ' repeated 2 more times in 60 seconds.')
+            
+            # A new window logs the traceback in full again.
+            self.markLog()
+            self.getPage("/error")
+            self.assertLog(0, 'HTTP Traceback (most recent call last):')
+        finally:
+            log.traceback_window = None
+            log.summarize_tracebacks(force=True)
+            ignore.pop()
 
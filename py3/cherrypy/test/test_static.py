@@ -5,11 +5,13 @@ import os
 curdir = os.path.join(os.getcwd(), os.path.dirname(__file__))
 has_space_filepath = os.path.join(curdir, 'static', 'has space.html')
 bigfile_filepath = os.path.join(curdir, "static", "bigfile.log")
+sidecar_filepath = os.path.join(curdir, "static", "sidecar.txt")
+changing_filepath = os.path.join(curdir, "static", "changing.txt")
 BIGFILE_SIZE = 1024 * 1024
 import threading
 
 import cherrypy
-from cherrypy.lib import static
+from cherrypy.lib import encoding, static
 from cherrypy.test import helper
 
 
@@ -20,6 +22,11 @@ class StaticTest(helper.CPWebCase):
             open(has_space_filepath, 'wb').write(ntob('Hello, world\r\n'))
         if not os.path.exists(bigfile_filepath):
             open(bigfile_filepath, 'wb').write(ntob("x" * BIGFILE_SIZE))
+        if not os.path.exists(sidecar_filepath):
+            open(sidecar_filepath, 'wb').write(ntob('Plain sidecar'))
+            f = open(sidecar_filepath + '.gz', 'wb')
+            f.write(ntob('').join(encoding.compress([ntob('Gzipped sidecar')], 9)))
+            f.close()
         
         class Root:
             
@@ -80,6 +87,27 @@ class StaticTest(helper.CPWebCase):
                 'tools.staticdir.on': True,
                 'request.show_tracebacks': True,
             },
+            '/gzstatic': {
+                'tools.staticdir.on': True,
+                'tools.staticdir.root': curdir,
+                'tools.staticdir.dir': 'static',
+                'tools.staticdir.precompressed': True,
+                'tools.gzip.on': True,
+            },
+            '/gzipped': {
+                'tools.staticdir.on': True,
+                'tools.staticdir.root': curdir,
+                'tools.staticdir.dir': 'static',
+                'tools.gzip.on': True,
+            },
+            '/cachedstatic': {
+                'tools.staticdir.on': True,
+                'tools.staticdir.root': curdir,
+                'tools.staticdir.dir': 'static',
+                'tools.staticdir.index': 'index.html',
+                'tools.staticdir.cache_files': True,
+                'tools.staticdir.precompressed': True,
+            },
             }
         rootApp = cherrypy.Application(root)
         rootApp.merge(rootconf)
@@ -101,7 +129,9 @@ class StaticTest(helper.CPWebCase):
 
 
     def teardown_server():
-        for f in (has_space_filepath, bigfile_filepath):
+        for f in (has_space_filepath, bigfile_filepath,
+                  sidecar_filepath, sidecar_filepath + '.gz',
+                  changing_filepath):
             if os.path.exists(f):
                 try:
                     os.unlink(f)
@@ -189,6 +219,249 @@ class StaticTest(helper.CPWebCase):
         self.assertNoHeader("Content-Disposition")
         self.assertBody("")
     
+        # ETags come from the file's stat, not its content.
+        from cherrypy.lib.static import file_etag
+        self.getPage("/static/dirback.jpg")
+        etag = file_etag(os.stat(os.path.join(curdir, 'static', 'dirback.jpg')))
+        self.assertHeader('ETag', etag)
+        self.getPage("/static/dirback.jpg", headers=[('If-None-Match', etag)])
+        self.assertStatus(304)
+        self.assertBody("")
+        self.getPage("/static/dirback.jpg", headers=[('If-Match', '"other"')])
+        self.assertStatus(412)
+        
+        # The gzipped representation has its own ETag.
+        self.getPage("/gzstatic/index.html",
+                     headers=[("Accept-Encoding", "gzip")])
+        gzetag = self.assertHeader('ETag')
+        self.getPage("/gzstatic/index.html")
+        self.assertNotEqual(self.assertHeader('ETag'), gzetag)
+    
+    def test_precompressed(self):
+        # Compressed on the fly (and cached) when no sibling exists.
+        self.getPage("/gzstatic/index.html",
+                     headers=[("Accept-Encoding", "gzip")])
+        self.assertStatus('200 OK')
+        self.assertHeader('Content-Type', 'text/html')
+        self.assertHeader('Content-Encoding', 'gzip')
+        self.assertHeader('Vary', 'Accept-Encoding')
+        self.assertHeader('Content-Length', str(len(self.body)))
+        self.assertEqual(encoding.decompress(self.body),
+                         ntob('Hello, world\r\n'))
+        
+        # Clients which don't accept gzip get the raw file.
+        self.getPage("/gzstatic/index.html")
+        self.assertStatus('200 OK')
+        self.assertNoHeader('Content-Encoding')
+        self.assertHeader('Vary', 'Accept-Encoding')
+        self.assertBody('Hello, world\r\n')
+        
+        # An explicit gzip entry takes precedence over '*'.
+        self.getPage("/gzstatic/sidecar.txt",
+                     headers=[("Accept-Encoding", "*;q=1, gzip;q=0")])
+        self.assertNoHeader('Content-Encoding')
+        self.assertBody('Plain sidecar')
+        self.getPage("/gzstatic/sidecar.txt",
+                     headers=[("Accept-Encoding", "*;q=0, gzip")])
+        self.assertHeader('Content-Encoding', 'gzip')
+        
+        # A '.gz' sibling is preferred.
+        self.getPage("/gzstatic/sidecar.txt",
+                     headers=[("Accept-Encoding", "gzip")])
+        self.assertStatus('200 OK')
+        self.assertHeader('Content-Encoding', 'gzip')
+        self.assertEqual(encoding.decompress(self.body),
+                         ntob('Gzipped sidecar'))
+        self.getPage("/gzstatic/sidecar.txt")
+        self.assertBody('Plain sidecar')
+        
+        # Ranges apply to the compressed representation.
+        self.getPage("/gzstatic/sidecar.txt",
+                     headers=[("Accept-Encoding", "gzip"),
+                              ("Range", "bytes=0-1")])
+        self.assertStatus(206)
+        self.assertHeader('Content-Encoding', 'gzip')
+        self.assertBody(ntob('\x1f\x8b'))
+        
+        # Images are not worth compressing.
+        self.getPage("/gzstatic/dirback.jpg",
+                     headers=[("Accept-Encoding", "gzip")])
+        self.assertStatus('200 OK')
+        self.assertNoHeader('Content-Encoding')
+        # ...so they keep the plain file's ETag.
+        from cherrypy.lib.static import file_etag
+        self.assertHeader('ETag', file_etag(
+            os.stat(os.path.join(curdir, 'static', 'dirback.jpg'))))
+        
+        # tools.gzip weakens the file's strong ETag when it compresses it,
+        # which still matches conditional requests.
+        etag = file_etag(os.stat(os.path.join(curdir, 'static', 'index.html')))
+        self.getPage("/gzipped/index.html",
+                     headers=[("Accept-Encoding", "gzip")])
+        self.assertHeader('Content-Encoding', 'gzip')
+        self.assertHeader('ETag', 'W/' + etag)
+        self.getPage("/gzipped/index.html",
+                     headers=[("Accept-Encoding", "gzip"),
+                              ("If-None-Match", 'W/' + etag)])
+        self.assertStatus(304)
+        self.getPage("/gzipped/index.html")
+        self.assertHeader('ETag', etag)
+    
+    def test_cache_files(self):
+        def write(content):
+            f = open(changing_filepath, 'wb')
+            f.write(ntob(content))
+            f.close()
+        
+        write('first')
+        static.stat_cache.clear()
+        static.stat_cache.ttl = 60
+        try:
+            self.getPage("/cachedstatic/changing.txt")
+            self.assertStatus('200 OK')
+            self.assertHeader('Content-Type', 'text/plain')
+            self.assertBody('first')
+            etag = self.assertHeader('ETag')
+            info = static.stat_cache.store[changing_filepath][4]
+            self.assertEqual(info.data, ntob('first'))
+            self.getPage("/cachedstatic/changing.txt",
+                         headers=[('If-None-Match', etag)])
+            self.assertStatus(304)
+            
+            # Changes go unnoticed until the ttl runs out...
+            write('second!')
+            self.getPage("/cachedstatic/changing.txt")
+            self.assertBody('first')
+            
+            # ...when the file is stat'ed (and read) again.
+            static.stat_cache.ttl = 0
+            self.getPage("/cachedstatic/changing.txt")
+            self.assertBody('second!')
+            self.assertNotEqual(self.assertHeader('ETag'), etag)
+            
+            # Content-Length is that of the contents read, even if the file
+            # changed between the stat and the read.
+            static.stat_cache.ttl = 60
+            static.stat_cache.store[changing_filepath][4] = static.FileInfo(
+                changing_filepath, os.stat(changing_filepath), ntob('short'))
+            self.getPage("/cachedstatic/changing.txt")
+            self.assertHeader('Content-Length', '5')
+            self.assertBody('short')
+            static.stat_cache.ttl = 0
+            
+            # Missing files and index files are cached too.
+            self.getPage("/cachedstatic/nonexistent.html")
+            self.assertStatus(404)
+            self.assertEqual(static.stat_cache.store[
+                os.path.join(curdir, 'static', 'nonexistent.html')][4], None)
+            self.getPage("/cachedstatic/")
+            self.assertBody('Hello, world\r\n')
+            
+            # So are '.gz' siblings, and their absence.
+            static.stat_cache.ttl = 60
+            self.getPage("/cachedstatic/sidecar.txt",
+                         headers=[("Accept-Encoding", "gzip")])
+            self.assertHeader('Content-Encoding', 'gzip')
+            self.assertEqual(encoding.decompress(self.body),
+                             ntob('Gzipped sidecar'))
+            gzinfo = static.stat_cache.store[sidecar_filepath + '.gz'][4]
+            self.assertEqual(encoding.decompress(gzinfo.data),
+                             ntob('Gzipped sidecar'))
+            self.getPage("/cachedstatic/index.html",
+                         headers=[("Accept-Encoding", "gzip")])
+            self.assertEqual(static.stat_cache.store[
+                os.path.join(curdir, 'static', 'index.html.gz')][4], None)
+        finally:
+            static.stat_cache.ttl = static.StatCache.ttl
+            static.stat_cache.clear()
+    
+    def test_stat_cache_limits(self):
+        cache = static.StatCache()
+        cache.maxobjects = 2
+        cache.maxmissing = 2
+        index = os.path.join(curdir, 'static', 'index.html')
+        jpg = os.path.join(curdir, 'static', 'dirback.jpg')
+        cache.get(index)
+        cache.get(jpg)
+        
+        # Missing paths are limited separately, so they don't evict files.
+        for i in range(5):
+            path = os.path.join(curdir, 'static', 'missing%d.html' % i)
+            self.assertEqual(cache.get(path), None)
+        self.assertEqual(cache.missing, 2)
+        self.assertEqual(cache.count, 2)
+        self.assert_(index in cache.store and jpg in cache.store)
+        
+        # Files are evicted least recently used first.
+        cache.get(index)
+        cache.get(os.path.join(curdir, 'test_static.py'))
+        self.assert_(index in cache.store)
+        self.assert_(jpg not in cache.store)
+        self.assertEqual(cache.count, 2)
+    
+    def test_gzip_cache_lru(self):
+        paths = [os.path.join(curdir, 'static', 'index.html'),
+                 sidecar_filepath, has_space_filepath]
+        sizes = [len(static.GzipCache().get(p, os.stat(p))) for p in paths]
+        cache = static.GzipCache()
+        cache.maxsize = sizes[0] + max(sizes[1], sizes[2])
+        a, b, c = paths
+        cache.get(a, os.stat(a))
+        cache.get(b, os.stat(b))
+        # Touch a, so that b is the least recently used.
+        cache.get(a, os.stat(a))
+        cache.get(c, os.stat(c))
+        self.assert_(a in cache.store and c in cache.store)
+        self.assert_(b not in cache.store)
+        self.assertEqual(cache.cursize, sizes[0] + sizes[2])
+    
+    def test_mapped_files(self):
+        path = os.path.join(curdir, 'static', 'dirback.jpg')
+        content = open(path, 'rb').read()
+        static.stat_cache.clear()
+        static.stat_cache.maxobj_size = 100
+        static.stat_cache.map_files = True
+        static.stat_cache.ttl = 60
+        try:
+            self.getPage("/cachedstatic/dirback.jpg")
+            self.assertStatus('200 OK')
+            self.assertHeader('Content-Length', str(len(content)))
+            self.assertBody(content)
+            mapped = static.stat_cache.store[path][4].mapped
+            self.assertNotEqual(mapped, None)
+            
+            # Ranges are sliced from the same, shared mapping.
+            self.getPage("/cachedstatic/dirback.jpg",
+                         headers=[('Range', 'bytes=10-19')])
+            self.assertStatus(206)
+            self.assertHeader('Content-Range',
+                              'bytes 10-19/%s' % len(content))
+            self.assertBody(content[10:20])
+            self.assertEqual(static.stat_cache.store[path][4].mapped, mapped)
+            
+            self.getPage("/cachedstatic/dirback.jpg",
+                         headers=[('Range', 'bytes=0-1,-3')])
+            self.assertStatus(206)
+            ct = self.assertHeader("Content-Type")
+            boundary = ct[len("multipart/byteranges; boundary="):]
+            size = len(content)
+            expected = ntob("\r\n--%s\r\n"
+                            "Content-type: image/jpeg\r\n"
+                            "Content-range: bytes 0-1/%s\r\n\r\n"
+                            % (boundary, size)) + content[:2] + ntob(
+                            "\r\n--%s\r\n"
+                            "Content-type: image/jpeg\r\n"
+                            "Content-range: bytes %s-%s/%s\r\n\r\n"
+                            % (boundary, size - 3, size - 1, size)
+                            ) + content[-3:] + ntob("\r\n--%s--\r\n" % boundary)
+            self.assertBody(expected)
+            self.assertHeader('Content-Length', str(len(expected)))
+        finally:
+            static.stat_cache.maxobj_size = static.StatCache.maxobj_size
+            static.stat_cache.map_files = static.StatCache.map_files
+            static.stat_cache.ttl = static.StatCache.ttl
+            static.stat_cache.clear()
+    
     def test_755_vhost(self):
         self.getPage("/test/", [('Host', 'virt.net')])
         self.assertStatus(200)
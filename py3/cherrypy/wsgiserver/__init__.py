@@ -512,6 +512,17 @@ class HTTPRequest(object):
         self.close_connection = self.__class__.close_connection
         self.chunked_read = False
         self.chunked_write = self.__class__.chunked_write
+        # The connection's write counter when this request began.
+        self.written_at_start = getattr(conn.wfile, 'bytes_written', None)
+    
+    def bytes_sent(self):
+        """Return the number of bytes written so far for this request
+        (status line and headers included), or None if the connection's
+        wfile doesn't count them."""
+        written = getattr(self.conn.wfile, 'bytes_written', None)
+        if written is None or self.written_at_start is None:
+            return None
+        return written - self.written_at_start
     
     def parse_request(self):
         """Parse the next HTTP request start-line and message-headers."""
@@ -905,6 +916,9 @@ class FatalSSLAlert(Exception):
 
 class CP_BufferedWriter(io.BufferedWriter):
     """Faux file object attached to a socket object."""
+    
+    bytes_written = 0
+    """The number of bytes written to the socket."""
 
     def write(self, b):
         self._checkClosed()
@@ -926,6 +940,7 @@ class CP_BufferedWriter(io.BufferedWriter):
             except io.BlockingIOError as e:
                 n = e.characters_written
             del self._write_buf[:n]
+            self.bytes_written += n
 
 
 def CP_makefile(sock, mode='r', bufsize=DEFAULT_BUFFER_SIZE):
@@ -949,6 +964,13 @@ class HTTPConnection(object):
     wbufsize = DEFAULT_BUFFER_SIZE
     RequestHandlerClass = HTTPRequest
     
+    queued_at = None
+    """The time.time() at which this connection was queued for a worker."""
+    
+    queue_wait = 0.0
+    """The seconds this connection waited for a worker, before its first
+    request. Later requests (on a kept-alive connection) did not wait."""
+    
     def __init__(self, server, sock, makefile=CP_makefile):
         self.server = server
         self.socket = sock
@@ -979,6 +1001,7 @@ class HTTPConnection(object):
                 
                 request_seen = True
                 req.respond()
+                self.queue_wait = 0.0
                 if req.close_connection:
                     return
         except socket.error as e:
@@ -1112,6 +1135,8 @@ class WorkerThread(threading.Thread):
                 conn = self.server.requests.get()
                 if conn is _SHUTDOWNREQUEST:
                     return
+                if conn.queued_at is not None:
+                    conn.queue_wait = time.time() - conn.queued_at
                 
                 self.conn = conn
                 if self.server.stats['Enabled']:
@@ -1162,6 +1187,11 @@ class ThreadPool(object):
         return len([t for t in self._threads if t.conn is None])
     idle = property(_get_idle, doc=_get_idle.__doc__)
     
+    def _get_threads(self):
+        """Number of worker threads, busy or idle. Read-only."""
+        return len(self._threads)
+    threads = property(_get_threads, doc=_get_threads.__doc__)
+    
     def put(self, obj):
         self._queue.put(obj)
         if obj is _SHUTDOWNREQUEST:
@@ -1579,6 +1609,7 @@ class HTTPServer(object):
             
             conn.ssl_env = ssl_env
             
+            conn.queued_at = time.time()
             self.requests.put(conn)
         except socket.timeout:
             # The only reason for the timeout in start() is so we can
@@ -1843,6 +1874,8 @@ class WSGIGateway_10(WSGIGateway):
             # Bah. "SERVER_PROTOCOL" is actually the REQUEST protocol.
             'SERVER_PROTOCOL': req.request_protocol.decode('ISO-8859-1'),
             'SERVER_SOFTWARE': req.server.software,
+            'wsgiserver.queue_wait': req.conn.queue_wait,
+            'wsgiserver.bytes_sent': req.bytes_sent,
             'wsgi.errors': sys.stderr,
             'wsgi.input': req.rfile,
             'wsgi.multiprocess': False,